@@ -0,0 +1,92 @@
+"""Pacotes de alerta 0x4007 (documentacao/ALERT_PROTOCOLS_ANALYSIS.md).
+
+Um alerta chega como o pacote base de 128 bytes seguido de cópias
+idênticas: 256 bytes (2 cópias) para um alerta, 384 bytes (3 cópias)
+para vários. Cada cópia é um pacote completo, então o framer entrega
+uma fatia por cópia. O AlertCollapser junta as cópias consecutivas antes
+da decodificação: o pacote base é conferido, decodificado e registrado
+uma única vez, com o número de cópias em ``repetitions``.
+
+    alerts = AlertCollapser()
+    for frame, repetitions in alerts.feed(framer.feed(data), framer.buffered):
+        ...
+
+A severidade vem do número de cópias e os tipos de alerta dos bits do
+byte S3 do vstate.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+ALERT_PROTOCOL_ID = 0x4007
+_ALERT_ID_BYTES = ALERT_PROTOCOL_ID.to_bytes(2, 'big')
+PROTOCOL_ID_SLICE = slice(25, 27)
+
+# Bits do byte S3 (mais significativo) do vstate
+ALERT_TYPES = (
+    (0x01, 'ALERTA_GERAL'),
+    (0x02, 'ALTO_RPM'),
+    (0x04, 'FRENAGEM_BRUSCA'),
+    (0x08, 'VELOCIDADE_EXCESSIVA'),
+)
+
+SEVERITY_LOW = 'BAIXO'
+SEVERITY_HIGH = 'ALTO'
+SEVERITY_CRITICAL = 'CRÍTICO'
+
+
+def severity(repetitions: int) -> str:
+    """1 cópia: operação normal; 2: alerta único; 3 ou mais: múltiplos alertas."""
+    if repetitions >= 3:
+        return SEVERITY_CRITICAL
+    if repetitions == 2:
+        return SEVERITY_HIGH
+    return SEVERITY_LOW
+
+
+def alert_types(flags: int) -> List[str]:
+    return [name for bit, name in ALERT_TYPES if flags & bit]
+
+
+def is_alert(frame) -> bool:
+    return frame[PROTOCOL_ID_SLICE] == _ALERT_ID_BYTES
+
+
+class AlertCollapser:
+    """Junta cópias consecutivas e idênticas de um pacote de alerta.
+
+    A comparação é feita nas próprias memoryviews (tamanho e bytes), sem
+    decodificar as cópias. Se o lote termina em um alerta e o framer
+    ainda tem bytes pendentes, o alerta fica retido até o próximo lote,
+    porque a cópia seguinte pode ter chegado cortada. Cópias separadas
+    exatamente na fronteira de um recv saem como alertas distintos; o
+    equipamento envia a rajada inteira de uma vez, então isso é raro.
+    """
+
+    def __init__(self):
+        self._held: Optional[memoryview] = None
+        self._held_count = 0
+        self.collapsed = 0
+
+    def feed(self, frames: Iterable[memoryview], pending: int = 0) -> Iterator[Tuple[memoryview, int]]:
+        current, count = self._held, self._held_count
+        self._held = None
+        for frame in frames:
+            if current is not None:
+                if len(frame) == len(current) and frame == current and is_alert(current):
+                    count += 1
+                    self.collapsed += 1
+                    continue
+                yield current, count
+            current, count = frame, 1
+        if current is None:
+            return
+        if pending and is_alert(current):
+            self._held, self._held_count = current, count
+            return
+        yield current, count
+
+    def flush(self) -> Iterator[Tuple[memoryview, int]]:
+        """Entrega o alerta retido (fim da conexão)."""
+        if self._held is not None:
+            held, count = self._held, self._held_count
+            self._held = None
+            yield held, count
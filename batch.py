@@ -0,0 +1,169 @@
+"""Decodificação em lote (vetorizada) para reprocessamento de capturas.
+
+Em vez de um SinocastelParser por pacote, os pacotes são agrupados por
+protocol_id e as partes de tamanho fixo viram arrays estruturados do
+NumPy, montados a partir dos mesmos layouts de sinocastel.py. Escalas,
+sinais de latitude/longitude e bits de flag são aplicados como operações
+sobre arrays inteiros.
+
+    groups = decode_batch(frames)
+    login = groups[0x1001]
+    login['header']['device_id'], login['fixed']['utc_time'], login['gps']['latitude']
+"""
+from typing import Dict, Sequence
+
+import numpy as np
+
+from crc16 import CRC_TABLE
+from framer import MIN_FRAME_LEN
+from sinocastel import GPS_ITEM, HEADER, LOGIN_FIXED, LOGIN_PROTOCOL_ID, TRAILER, Layout
+
+_NUMPY_TYPES = {'B': 'u1', 'H': '<u2', 'I': '<u4'}
+# O protocol_id é o único campo big-endian do cabeçalho
+_OVERRIDES = {'protocol_id': '>u2'}
+
+
+def layout_dtype(layout: Layout) -> np.dtype:
+    """Converte um Layout de sinocastel.py em um dtype estruturado."""
+    fields = []
+    for field in layout.fields:
+        if field.name in _OVERRIDES:
+            fields.append((field.name, _OVERRIDES[field.name]))
+        elif field.fmt.endswith('s'):
+            fields.append((field.name, f'S{field.fmt[:-1]}'))
+        else:
+            fields.append((field.name, _NUMPY_TYPES[field.fmt]))
+    dtype = np.dtype(fields)
+    assert dtype.itemsize == layout.size, layout
+    return dtype
+
+
+HEADER_DTYPE = layout_dtype(HEADER)
+LOGIN_FIXED_DTYPE = layout_dtype(LOGIN_FIXED)
+GPS_ITEM_DTYPE = layout_dtype(GPS_ITEM)
+
+GPS_DTYPE = np.dtype([
+    ('frame', '<i4'),          # posição do pacote dentro do grupo
+    ('day', 'u1'), ('month', 'u1'), ('year', 'u1'),
+    ('hour', 'u1'), ('minute', 'u1'), ('second', 'u1'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('speed_cm_s', '<u2'),
+    ('direction_degrees', '<f4'),
+    ('fix_type', 'u1'),        # 0 inválido, 1 2D, 2/3 3D
+    ('satellite_count', 'u1'),
+])
+
+_LOGIN_GPS_OFFSET = HEADER.size + LOGIN_FIXED.size
+
+_CRC_TABLE = np.array(CRC_TABLE, dtype=np.uint16)
+
+
+def _join(frames: Sequence, start: int, stop: int) -> bytes:
+    return b''.join([frame[start:stop] for frame in frames])
+
+
+def check_frames(frames: Sequence) -> np.ndarray:
+    """Máscara dos pacotes íntegros (cabeçalho, protocol_length, cauda e crc).
+
+    Os pacotes são agrupados por tamanho e o crc de cada grupo é calculado
+    coluna a coluna, com a mesma tabela de crc16.py aplicada a todos os
+    pacotes do grupo de uma vez.
+    """
+    lengths = np.fromiter((len(frame) for frame in frames), dtype=np.intp, count=len(frames))
+    valid = np.zeros(len(frames), dtype=bool)
+    for size in np.unique(lengths).tolist():
+        if size < MIN_FRAME_LEN:
+            continue
+        index = np.flatnonzero(lengths == size)
+        rows = np.frombuffer(b''.join([frames[i] for i in index.tolist()]),
+                             dtype=np.uint8).reshape(len(index), size)
+        crc = np.full(len(index), 0xFFFF, dtype=np.uint16)
+        for column in rows[:, :size - 4].T:
+            crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ column) & 0xFF]
+        crc ^= 0xFFFF
+        stored = rows[:, size - 4].astype(np.uint16) | (rows[:, size - 3].astype(np.uint16) << 8)
+        declared = rows[:, 2].astype(np.intp) | (rows[:, 3].astype(np.intp) << 8)
+        valid[index] = ((rows[:, 0] == 0x40) & (rows[:, 1] == 0x40) & (declared == size) &
+                        (rows[:, size - 2] == 0x0D) & (rows[:, size - 1] == 0x0A) & (crc == stored))
+    return valid
+
+
+def decode_headers(frames: Sequence) -> np.ndarray:
+    """Cabeçalho fixo de todos os pacotes em um único array."""
+    return np.frombuffer(_join(frames, 0, HEADER.size), dtype=HEADER_DTYPE)
+
+
+def decode_gps(frames: Sequence, counts: np.ndarray, offset: int) -> np.ndarray:
+    """Achata os blocos gps_array de vários pacotes em um único array."""
+    counts = counts.astype(np.intp)
+    raw = b''.join([frame[offset:offset + count * GPS_ITEM.size]
+                    for frame, count in zip(frames, counts.tolist()) if count])
+    items = np.frombuffer(raw, dtype=GPS_ITEM_DTYPE)
+
+    gps = np.empty(len(items), dtype=GPS_DTYPE)
+    gps['frame'] = np.repeat(np.arange(len(counts)), counts)
+    for name in ('day', 'month', 'year', 'hour', 'minute', 'second'):
+        gps[name] = items[name]
+    flags = items['flags']
+    # Bit 0: 1 = leste, bit 1: 1 = norte
+    gps['latitude'] = np.where(flags & 0x02, 1.0, -1.0) * items['latitude'] / 3600000.0
+    gps['longitude'] = np.where(flags & 0x01, 1.0, -1.0) * items['longitude'] / 3600000.0
+    gps['speed_cm_s'] = items['speed']
+    gps['direction_degrees'] = items['direction'] / 10.0
+    gps['fix_type'] = (flags >> 2) & 0x03
+    gps['satellite_count'] = flags >> 4
+    return gps
+
+
+def decode_login_batch(frames: Sequence, lengths: np.ndarray) -> dict:
+    """Campos fixos e GPS de um lote de pacotes 0x1001."""
+    fixed = np.frombuffer(_join(frames, HEADER.size, _LOGIN_GPS_OFFSET), dtype=LOGIN_FIXED_DTYPE)
+    counts = fixed['gps_count']
+    # Pacotes que declaram mais GPS do que cabem no buffer (antes do crc e
+    # da cauda) ficam sem GPS
+    available = (lengths - _LOGIN_GPS_OFFSET - TRAILER.size) // GPS_ITEM.size
+    counts = np.where(counts <= available, counts, 0)
+    return {'fixed': fixed, 'gps': decode_gps(frames, counts, _LOGIN_GPS_OFFSET)}
+
+
+BATCH_DECODERS = {
+    LOGIN_PROTOCOL_ID: (_LOGIN_GPS_OFFSET, decode_login_batch),
+}
+
+
+def decode_batch(frames: Sequence, check_crc: bool = True) -> Dict[int, dict]:
+    """Decodifica um lote de pacotes agrupando por protocol_id.
+
+    Devolve ``{protocol_id: grupo}``, onde cada grupo tem ``index`` (posição
+    dos pacotes no lote original), ``header`` e, para protocolos com decoder
+    em lote, os arrays específicos (``fixed`` e ``gps`` no 0x1001). Os GPS
+    referenciam o pacote pela posição dentro do grupo (campo ``frame``).
+    Pacotes menores que o cabeçalho e, com ``check_crc``, pacotes
+    corrompidos (ver ``check_frames``) são ignorados.
+    """
+    frames = list(frames)
+    lengths = np.fromiter((len(frame) for frame in frames), dtype=np.intp, count=len(frames))
+    if check_crc:
+        positions = np.flatnonzero(check_frames(frames))
+    else:
+        positions = np.flatnonzero(lengths >= HEADER.size)
+    if len(positions) < len(frames):
+        frames = [frames[i] for i in positions.tolist()]
+        lengths = lengths[positions]
+    if not frames:
+        return {}
+    headers = decode_headers(frames)
+    protocol_ids = headers['protocol_id']
+
+    groups = {}
+    for protocol_id in np.unique(protocol_ids).tolist():
+        index = np.flatnonzero(protocol_ids == protocol_id)
+        if protocol_id in BATCH_DECODERS:
+            min_size, decoder = BATCH_DECODERS[protocol_id]
+            index = index[lengths[index] >= min_size]
+        group = {'index': positions[index], 'header': headers[index]}
+        if protocol_id in BATCH_DECODERS:
+            group.update(decoder([frames[i] for i in index.tolist()], lengths[index]))
+        groups[protocol_id] = group
+    return groups
@@ -0,0 +1,148 @@
+"""Microbenchmark do pacote de login 0x1001.
+
+Compara o parser com layouts pré-compilados (sinocastel.py) com o
+parser antigo de bkp/obd_server.py, usando o pacote de exemplo de
+bkp/hex_real.py e os pacotes reais de bkp/obd_simulator.py e bkp/code.py.
+
+    python benchmarks/bench_login.py [--seconds 1.0]
+"""
+import argparse
+import ast
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from sinocastel import HEADER, LOGIN_FIXED, SinocastelParser, decode_record
+
+STDLIB_IMPORTS = {'struct', 'json', 'datetime'}
+
+
+def load_legacy_parser(path: Path):
+    """Carrega só a classe SinocastelParser de um script de bkp/.
+
+    Os scripts antigos executam exemplos (e importam dependências) no
+    nível do módulo, então a classe é extraída da árvore sintática.
+    """
+    tree = ast.parse(path.read_text(encoding='utf-8'))
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, ast.Import) and all(alias.name in STDLIB_IMPORTS for alias in node.names):
+            nodes.append(node)
+        elif isinstance(node, ast.ImportFrom) and node.module in STDLIB_IMPORTS:
+            nodes.append(node)
+        elif isinstance(node, ast.ClassDef) and node.name == 'SinocastelParser':
+            nodes.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), str(path), 'exec'), namespace)
+    return namespace['SinocastelParser']
+
+
+# Sequência de leituras que os parsers antigos fazem, campo a campo, para
+# o cabeçalho e o bloco fixo do login (reservado incluído).
+LEGACY_FIXED_READS = [('H', 2), ('B', 1), ('H', 2),
+                      ('I', 4), ('I', 4), ('I', 4), ('I', 4), ('I', 4), ('H', 2), ('I', 4),
+                      ('B', 1), ('B', 1), ('B', 1), ('B', 1), ('B', 1), ('B', 1), ('H', 2),
+                      ('B', 1)]
+
+
+def legacy_fixed_part(parser_class):
+    """Só o cabeçalho e o bloco fixo do login, com o _read antigo."""
+    def run(raw_hex):
+        parser = parser_class(raw_hex)
+        parser.offset = 2
+        for fmt, size in LEGACY_FIXED_READS[:2]:
+            parser._read(fmt, size)
+        parser.offset += 20
+        for fmt, size in LEGACY_FIXED_READS[2:]:
+            parser._read(fmt, size)
+    return run
+
+
+def layout_fixed_part(raw_hex):
+    """O mesmo trecho com os layouts pré-compilados."""
+    raw = bytes.fromhex(raw_hex)
+    HEADER.unpack_from(raw)
+    LOGIN_FIXED.unpack_from(raw, HEADER.size)
+
+
+def load_sample_packets():
+    """Pacotes de exemplo guardados em bkp/, em hexadecimal."""
+    samples = {'hex_real': (ROOT / 'bkp' / 'hex_real.py').read_text().split()[0]}
+    simulator = ast.parse((ROOT / 'bkp' / 'obd_simulator.py').read_text(encoding='utf-8'))
+    for node in simulator.body:
+        if (isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name)
+                and node.targets[0].id == 'PACOTE_HEXADECIMAL'):
+            samples['obd_simulator'] = node.value.value
+    samples['code'] = (ROOT / 'bkp' / 'code.py').read_text().split()[0]
+    return samples
+
+
+def full_parse(parser_class):
+    def run(raw_hex):
+        parser_class(raw_hex).parse()
+    return run
+
+
+def hot_fields_dict(parser_class):
+    def run(raw_hex):
+        parsed = parser_class(raw_hex).parse()
+        parsed['device_id'], parsed['payload']['utc_time'], parsed['payload'].get('gps_info')
+    return run
+
+
+def hot_fields_record(raw_hex):
+    """device_id, utc_time e último GPS lidos do registro sob demanda."""
+    record = decode_record(bytes.fromhex(raw_hex))
+    record.device_id, record.utc_time, record.latest_gps
+
+
+def packets_per_second(decode, raw_hex, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            decode(raw_hex)
+        count += 1000
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--seconds', type=float, default=1.0,
+                            help='tempo de medição por parser')
+    args = arg_parser.parse_args()
+
+    legacy = load_legacy_parser(ROOT / 'bkp' / 'obd_server.py')
+    benchmarks = {
+        # O parser de bkp/obd_server.py é o único antigo que chega ao payload
+        # do login; ele decodifica menos campos que o novo (um GPS, sem a
+        # lista de parâmetros), então a comparação favorece o antigo.
+        'parse completo': {
+            'bkp/obd_server.py': full_parse(legacy),
+            'sinocastel.py': full_parse(SinocastelParser),
+        },
+        'cabeçalho + bloco fixo': {
+            'bkp/obd_server.py': legacy_fixed_part(legacy),
+            'sinocastel.py': layout_fixed_part,
+        },
+        # O que a maioria dos consumidores lê de cada pacote
+        'device_id + utc_time + último GPS': {
+            'bkp/obd_server.py': hot_fields_dict(legacy),
+            'sinocastel.py': hot_fields_record,
+        },
+    }
+    for sample_name, raw_hex in load_sample_packets().items():
+        for bench_name, variants in benchmarks.items():
+            print(f'# {sample_name} ({len(raw_hex) // 2} bytes) - {bench_name}')
+            results = {name: packets_per_second(decode, raw_hex, args.seconds)
+                       for name, decode in variants.items()}
+            baseline = results['bkp/obd_server.py']
+            for name, rate in results.items():
+                print(f'{name:<20} {rate:>12,.0f} pacotes/s  ({rate / baseline:.2f}x)')
+
+if __name__ == '__main__':
+    main()
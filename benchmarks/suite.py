@@ -0,0 +1,260 @@
+"""Suíte de benchmarks dos decoders e dos caminhos de ingestão.
+
+Mede três coisas e grava o resultado em JSON:
+
+- decode: custo por pacote de cada variante de parser (Decoder1001,
+  sinocastel.py e os SinocastelParser antigos de bkp/) com os pacotes
+  reais de bkp/code.py, bkp/hex_real.py e bkp/obd_simulator.py;
+- framing: vazão do SinocastelFramer com um fluxo de pacotes colados e
+  com o mesmo fluxo fragmentado;
+- ingest: vazão fim a fim de ws_server.handler com um cliente local.
+
+    python benchmarks/suite.py --output baseline.json
+    python benchmarks/suite.py --compare baseline.json --threshold 0.10
+
+Com --compare, casos mais lentos que o baseline além do limite são
+listados e o processo termina com código 1.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bench_login import load_legacy_parser, load_sample_packets
+from crc16 import frame_error, seal
+from decoder_1001 import Decoder1001
+from dedupe import UTC_TIME_SLICE, DuplicateFilter
+from framer import SinocastelFramer
+from sinocastel import SinocastelParser, decode_record
+
+
+def measure(func, seconds: float, repeat: int) -> dict:
+    """Melhor de ``repeat`` medições de ``seconds`` segundos cada."""
+    # Calibra o tamanho do lote para que a medição do relógio não pese
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= 0.02:
+            break
+        number *= 2
+    per_run = max(1, int(number * seconds / elapsed))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(per_run):
+            func()
+        elapsed = (time.perf_counter() - start) / per_run
+        best = elapsed if best is None else min(best, elapsed)
+    return {'ops_per_sec': 1.0 / best, 'ns_per_op': best * 1e9}
+
+
+def decode_cases(samples: dict) -> dict:
+    legacy = {
+        'bkp/obd_server.py': load_legacy_parser(ROOT / 'bkp' / 'obd_server.py'),
+        'bkp/new_code.py': load_legacy_parser(ROOT / 'bkp' / 'new_code.py'),
+        'bkp/geminicode.py': load_legacy_parser(ROOT / 'bkp' / 'geminicode.py'),
+    }
+    decoder = Decoder1001()
+    cases = {}
+    for sample_name, raw_hex in samples.items():
+        raw = bytes.fromhex(raw_hex)
+        # Os parsers antigos recebem hex; os novos, bytes. O de bkp/new_code.py
+        # lê o protocol_id invertido e nunca chega ao corpo do login, por isso
+        # parece mais rápido que os demais.
+        for name, parser_class in legacy.items():
+            cases[f'decode/{name}/{sample_name}'] = lambda c=parser_class, h=raw_hex: c(h).parse()
+        cases[f'decode/sinocastel.py/{sample_name}'] = lambda r=raw: SinocastelParser(r).parse()
+        cases[f'decode/decoder_1001.py/{sample_name}'] = lambda r=raw: decoder.decode(r).to_dict()
+        cases[f'decode/decode_record-hot-fields/{sample_name}'] = lambda r=raw: _hot_fields(r)
+        cases[f'validate/frame_error/{sample_name}'] = lambda r=raw: frame_error(r)
+    return cases
+
+
+def _hot_fields(raw):
+    record = decode_record(raw)
+    return record.device_id, record.utc_time, record.latest_gps
+
+
+def framing_cases(samples: dict, packets: int = 1000) -> dict:
+    frames = [bytes.fromhex(samples[name]) for name in ('obd_simulator', 'code')]
+    stream = b''.join(frames[i % len(frames)] for i in range(packets))
+    rng = random.Random(42)
+    fragments, position = [], 0
+    while position < len(stream):
+        size = rng.randint(1, 200)
+        fragments.append(stream[position:position + size])
+        position += size
+    recv_chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+
+    def run(chunks):
+        def feed_all():
+            framer = SinocastelFramer()
+            count = 0
+            for chunk in chunks:
+                count += len(framer.feed(chunk))
+            assert count == packets, count
+        return feed_all
+
+    # Cada operação processa ``packets`` pacotes
+    return {
+        'framing/concatenated': run([stream]),
+        'framing/recv-1024': run(recv_chunks),
+        'framing/fragmented-1-200': run(fragments),
+    }, packets
+
+
+def unique_packets(raw: bytes, packets: int) -> list:
+    """Cópias de ``raw`` com utc_time crescente e crc recalculado.
+
+    Pacotes idênticos seriam descartados como retransmissão (dedupe.py) e
+    o caso mediria só o descarte, não framing, conferência e decode.
+    """
+    start = int.from_bytes(raw[UTC_TIME_SLICE], 'little')
+    messages = []
+    for index in range(packets):
+        packet = bytearray(raw)
+        packet[UTC_TIME_SLICE] = (start + index).to_bytes(4, 'little')
+        seal(packet)
+        messages.append(bytes(packet))
+    return messages
+
+
+async def _ingest(messages):
+    import websockets
+    import ws_server
+
+    # Filtro novo a cada medição: as anteriores já viram os mesmos pacotes
+    ws_server.dedupe = DuplicateFilter()
+    done = asyncio.Event()
+
+    async def handler(websocket):
+        await ws_server.handler(websocket)
+        done.set()
+
+    async with websockets.serve(handler, '127.0.0.1', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        start = time.perf_counter()
+        async with websockets.connect(f'ws://127.0.0.1:{port}') as client:
+            for message in messages:
+                await client.send(message)
+        await done.wait()
+        return time.perf_counter() - start
+
+
+def ingest_case(samples: dict, packets: int, repeat: int) -> dict:
+    """Vazão de ws_server.handler (framing, decode e logs) com um cliente local."""
+    from log_pipeline import STREAMS, LogPipeline
+
+    messages = unique_packets(bytes.fromhex(samples['obd_simulator']), packets)
+    with tempfile.TemporaryDirectory() as log_dir:
+        pipeline = LogPipeline(log_dir=Path(log_dir), max_queue=packets * repeat * 2)
+        pipeline.install()
+        try:
+            best = min(asyncio.run(_ingest(messages)) for _ in range(repeat))
+        finally:
+            pipeline.stop()
+        # Cada pacote decodificado gera uma linha no log interpretado
+        text = (Path(log_dir) / STREAMS['interpreted']).read_text(encoding='utf-8')
+        decoded = text.count(' INTERPRETED: ')
+    assert pipeline.dropped == 0 and decoded == packets * repeat, (decoded, packets * repeat)
+    return {'ops_per_sec': packets / best, 'ns_per_op': best / packets * 1e9}
+
+
+def run_suite(args) -> dict:
+    samples = load_sample_packets()
+    results = {}
+    selected = args.only
+
+    if not selected or 'decode' in selected:
+        for name, func in decode_cases(samples).items():
+            results[name] = measure(func, args.seconds, args.repeat)
+            print(f'{name:<55} {results[name]["ops_per_sec"]:>14,.0f} ops/s', file=sys.stderr)
+
+    if not selected or 'framing' in selected:
+        cases, packets = framing_cases(samples)
+        for name, func in cases.items():
+            result = measure(func, args.seconds, args.repeat)
+            # Normaliza para pacotes por segundo
+            results[name] = {'ops_per_sec': result['ops_per_sec'] * packets,
+                             'ns_per_op': result['ns_per_op'] / packets}
+            print(f'{name:<55} {results[name]["ops_per_sec"]:>14,.0f} pacotes/s', file=sys.stderr)
+
+    if not selected or 'ingest' in selected:
+        try:
+            results['ingest/ws_server.handler'] = ingest_case(samples, args.ingest_packets, args.repeat)
+            print(f'{"ingest/ws_server.handler":<55} '
+                  f'{results["ingest/ws_server.handler"]["ops_per_sec"]:>14,.0f} pacotes/s',
+                  file=sys.stderr)
+        except ImportError as exc:
+            print(f'ingest: ignorado ({exc})', file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'seconds': args.seconds,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Lista os casos que ficaram mais lentos que o baseline além do limite."""
+    regressions = []
+    print(f'\n{"caso":<55} {"baseline":>14} {"atual":>14} {"razão":>7}')
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f'{name:<55} {"-":>14} {result["ops_per_sec"]:>14,.0f}    novo')
+            continue
+        ratio = result['ops_per_sec'] / before['ops_per_sec']
+        flag = '  <-- regressão' if ratio < 1 - threshold else ''
+        print(f'{name:<55} {before["ops_per_sec"]:>14,.0f} {result["ops_per_sec"]:>14,.0f} '
+              f'{ratio:>6.2f}x{flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks dos decoders e da ingestão')
+    parser.add_argument('--output', type=Path, help='grava os resultados neste arquivo JSON')
+    parser.add_argument('--compare', type=Path, help='JSON de baseline para comparação')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='queda relativa tolerada antes de acusar regressão')
+    parser.add_argument('--seconds', type=float, default=0.5, help='duração de cada medição')
+    parser.add_argument('--repeat', type=int, default=3, help='medições por caso (vale a melhor)')
+    parser.add_argument('--ingest-packets', type=int, default=5000)
+    parser.add_argument('--only', nargs='*', choices=('decode', 'framing', 'ingest'))
+    args = parser.parse_args(argv)
+
+    current = run_suite(args)
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regressão(ões) acima de {args.threshold:.0%}', file=sys.stderr)
+            sys.exit(1)
+    elif not args.output:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
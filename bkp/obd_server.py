@@ -1,8 +1,22 @@
 import socketserver
 import json
 import struct
+import sys
+import threading
 import requests
 from datetime import datetime, timedelta
+from pathlib import Path
+
+# O framer e o parser atual ficam na raiz do projeto, junto do servidor principal
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import sinocastel
+from crc16 import frame_error
+from framer import SinocastelFramer
+from sessions import SessionRegistry
+
+# Sessões dos dispositivos; o servidor atende cada conexão em uma thread
+sessions = None
+sessions_lock = threading.Lock()
 
 class SinocastelParser:
     def __init__(self, raw_hex_data, base_odometer_km=0):
@@ -134,26 +148,34 @@ class SinocastelParser:
 class TCPHandler(socketserver.BaseRequestHandler):
     def handle(self):
         print(f"\n[+] Nova conexão de: {self.client_address[0]}")
+        # O TCP pode cortar ou juntar pacotes; o framer remonta cada um
+        framer = SinocastelFramer()
+        session = None
         try:
             while True:
                 data = self.request.recv(1024)
                 if not data:
                     print(f"[-] Conexão fechada por: {self.client_address[0]}")
                     break
-                
-                hex_data = data.hex()
-                print(f"[*] Recebido {len(data)} bytes de {self.client_address[0]}")
-                
-                # Em um sistema real, o 'base_odometer_km' viria de um banco de dados
-                # associado ao ID do dispositivo que se conectou.
-                base_odometer_for_this_device = 105826.41
 
-                parser = SinocastelParser(hex_data, base_odometer_km=base_odometer_for_this_device)
-                parsed_data = parser.parse()
+                print(f"[*] Recebido {len(data)} bytes de {self.client_address[0]}")
 
-                print("--- DADOS DECODIFICADOS ---")
-                print(json.dumps(parsed_data, indent=4))
-                print("---------------------------\n")
+                for frame in framer.feed(data):
+                    reason = frame_error(frame)
+                    if reason is not None:
+                        print(f"[!] Pacote rejeitado ({reason}): {frame.hex()}")
+                        continue
+                    # O parser lê direto da fatia do buffer recebido, sem hex
+                    record = sinocastel.SinocastelParser(frame).record()
+                    # A base do odômetro vem da sessão do dispositivo
+                    # (python sessions.py set-odometer <device_id> <km>)
+                    with sessions_lock:
+                        session = sessions.observe(record, session)
+                    parsed_data = record.to_dict()
+
+                    print("--- DADOS DECODIFICADOS ---")
+                    print(json.dumps(parsed_data, indent=4))
+                    print("---------------------------\n")
 
         except Exception as e:
             print(f"[!] Erro na conexão com {self.client_address[0]}: {e}")
@@ -167,5 +189,10 @@ if __name__ == "__main__":
     print("==============================================")
     print("Aguardando conexões dos veículos...")
 
-    with socketserver.ThreadingTCPServer((HOST, PORT), TCPHandler) as server:
-        server.serve_forever()
\ No newline at end of file
+    sessions = SessionRegistry()
+    sessions.start()
+    try:
+        with socketserver.ThreadingTCPServer((HOST, PORT), TCPHandler) as server:
+            server.serve_forever()
+    finally:
+        sessions.stop()
\ No newline at end of file
@@ -0,0 +1,483 @@
+"""Captura binária dos pacotes recebidos, com leitura via mmap e replay.
+
+Cada segmento é um arquivo append-only:
+
+    MAGIC
+    registro*        kind(u8) length(u32) timestamp(f64) device(u32) remote(u32) dados
+    rodapé           JSON com o índice por device_id
+    footer_offset(u64) FOOTER_MAGIC
+
+Os registros ``KIND_FRAME`` guardam o pacote exatamente como saiu do
+framer. device_id e endereço remoto são guardados como índices; o texto
+de cada um é gravado uma vez, em um registro de definição, na primeira
+vez em que aparece. Assim um segmento sem rodapé (servidor derrubado)
+ainda pode ser lido do início ao fim; o rodapé só acelera a busca por
+dispositivo.
+
+No servidor, ``CaptureWriter.write`` só coloca o pacote em uma fila
+limitada (como o log_pipeline.py); uma thread grava em lote. Os segmentos
+são trocados por tamanho ou por tempo, e só os ``keep_segments`` mais
+recentes ficam no diretório. ``CAPTURE=0`` desliga a captura.
+
+Replay de uma captura:
+
+    python capture.py replay logs/capture --speed 10
+    python capture.py replay logs/capture --speed max --target ws://127.0.0.1:29479
+"""
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+MAGIC = b'SNCCAP01'
+FOOTER_MAGIC = b'SNCIDX01'
+SEGMENT_SUFFIX = '.sncap'
+CAPTURE_DIR = Path('logs') / 'capture'
+
+KIND_FRAME = 0
+KIND_DEVICE = 1
+KIND_REMOTE = 2
+
+RECORD = struct.Struct('<BIdII')
+FOOTER_TRAILER = struct.Struct('<Q8s')
+
+# Posição do device_id no cabeçalho fixo do pacote
+DEVICE_ID_SLICE = slice(5, 25)
+
+_STOP = object()
+
+log = logging.getLogger(__name__)
+
+
+def format_remote(remote) -> str:
+    """('1.2.3.4', 5000) -> '1.2.3.4:5000'."""
+    if isinstance(remote, tuple):
+        return f'{remote[0]}:{remote[1]}'
+    return str(remote)
+
+
+class CapturedFrame(NamedTuple):
+    timestamp: float
+    remote: str
+    device_id: str
+    frame: memoryview
+
+
+class CaptureWriter:
+    """Grava pacotes em segmentos por uma thread de fundo, rotacionando por tamanho e tempo."""
+
+    def __init__(self, directory: Path = CAPTURE_DIR, segment_bytes: int = 64 * 1024 * 1024,
+                 segment_seconds: float = 3600.0, keep_segments: int = 48,
+                 buffer_size: int = 1024 * 1024, prefix: str = 'capture',
+                 max_queue: int = 100000, batch_size: int = 1000, flush_interval: float = 0.5):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.keep_segments = keep_segments
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.file = None
+        self.frames = 0
+        self.dropped = 0
+        self.removed_segments = 0
+        self._failed = False
+        self._sequence = 0
+        self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self):
+        self._thread.start()
+
+    def _open_segment(self):
+        self._sequence += 1
+        name = f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{self._sequence:04d}{SEGMENT_SUFFIX}"
+        self.path = self.directory / name
+        self.file = open(self.path, 'wb', buffering=self.buffer_size)
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        self.opened_at = time.time()
+        self.devices: Dict[bytes, int] = {}
+        self.remotes: Dict[str, int] = {}
+        self.device_names: List[str] = []
+        self.remote_names: List[str] = []
+        self.index: Dict[int, List[int]] = {}
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.segment_frames = 0
+        self._prune()
+
+    def _prune(self):
+        """Apaga os segmentos mais antigos além de ``keep_segments``."""
+        if not self.keep_segments:
+            return
+        segments = sorted(self.directory.glob(f'{self.prefix}-*{SEGMENT_SUFFIX}'),
+                          key=lambda path: path.stat().st_mtime)
+        for path in segments[:-self.keep_segments]:
+            if path != self.path:
+                path.unlink(missing_ok=True)
+                self.removed_segments += 1
+
+    def _define(self, kind: int, number: int, text: str, timestamp: float):
+        data = text.encode('utf-8')
+        self.file.write(RECORD.pack(kind, len(data), timestamp, number, number))
+        self.file.write(data)
+        self.size += RECORD.size + len(data)
+
+    def write(self, frame: memoryview, remote, timestamp: Optional[float] = None):
+        """Enfileira um pacote; nunca bloqueia nem grava em disco."""
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            # Cópia: o pacote pode ser uma fatia do buffer da conexão
+            self.queue.put_nowait((bytes(frame), remote, timestamp))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            frames = [item for item in batch if item is not _STOP]
+            try:
+                for frame, remote, timestamp in frames:
+                    self.write_now(frame, remote, timestamp)
+                self.flush()
+                if stop:
+                    self.close_segment()
+            except OSError:
+                # Disco cheio, permissão: conta e segue; o próximo lote abre
+                # outro segmento
+                self.dropped += len(frames)
+                if not self._failed:
+                    self._failed = True
+                    log.exception('Falha ao gravar a captura em %s', self.directory)
+                self._abandon_segment()
+            if stop:
+                return
+
+    def _abandon_segment(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    def write_now(self, frame, remote, timestamp: float):
+        """Grava um pacote no segmento atual (na thread, ou sem ``start``)."""
+        if (self.file is None or self.size >= self.segment_bytes
+                or timestamp - self.opened_at >= self.segment_seconds):
+            self.close_segment()
+            self._open_segment()
+
+        device_key = bytes(frame[DEVICE_ID_SLICE])
+        device = self.devices.get(device_key)
+        if device is None:
+            device = self.devices[device_key] = len(self.device_names)
+            name = device_key.decode('ascii', errors='ignore').strip('\x00')
+            self.device_names.append(name)
+            self._define(KIND_DEVICE, device, name, timestamp)
+        remote_key = format_remote(remote)
+        remote_number = self.remotes.get(remote_key)
+        if remote_number is None:
+            remote_number = self.remotes[remote_key] = len(self.remote_names)
+            self.remote_names.append(remote_key)
+            self._define(KIND_REMOTE, remote_number, remote_key, timestamp)
+
+        self.index.setdefault(device, []).append(self.size)
+        self.file.write(RECORD.pack(KIND_FRAME, len(frame), timestamp, device, remote_number))
+        self.file.write(frame)
+        self.size += RECORD.size + len(frame)
+        self.frames += 1
+        self.segment_frames += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Grava o que está na fila, fecha o segmento e encerra a thread."""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+        else:
+            self.close_segment()
+
+    def close_segment(self):
+        """Fecha o segmento atual gravando o rodapé com o índice."""
+        if self.file is None:
+            return
+        footer = json.dumps({
+            'frames': self.segment_frames,
+            'first_timestamp': self.first_timestamp,
+            'last_timestamp': self.last_timestamp,
+            'devices': self.device_names,
+            'remotes': self.remote_names,
+            'index': {str(device): offsets for device, offsets in self.index.items()},
+        }, separators=(',', ':')).encode('utf-8')
+        self.file.write(footer)
+        self.file.write(FOOTER_TRAILER.pack(self.size, FOOTER_MAGIC))
+        self.file.close()
+        self.file = None
+
+
+class CaptureReader:
+    """Lê um segmento via mmap, entregando os pacotes sem cópia.
+
+    As memoryviews entregues apontam para o mmap: ``close`` fecha o
+    arquivo, e o mmap é fechado quando a última delas for liberada.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        # Um segmento recém-aberto pode ainda estar vazio no disco
+        if self.path.stat().st_size == 0:
+            self._map = b''
+        else:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._map)
+        if self.view and self.view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{self.path} não é um segmento de captura')
+        self.footer = self._read_footer()
+        self.end = self.footer['_offset'] if self.footer else len(self.view)
+        if self.footer:
+            self.devices = self.footer['devices']
+            self.remotes = self.footer['remotes']
+        else:
+            self.devices, self.remotes = [], []
+
+    def _read_footer(self):
+        view = self.view
+        if len(view) < len(MAGIC) + FOOTER_TRAILER.size:
+            return None
+        offset, magic = FOOTER_TRAILER.unpack_from(view, len(view) - FOOTER_TRAILER.size)
+        if magic != FOOTER_MAGIC:
+            return None
+        footer = json.loads(bytes(view[offset:len(view) - FOOTER_TRAILER.size]))
+        footer['_offset'] = offset
+        return footer
+
+    def _records(self, offset: int = len(MAGIC)):
+        view = self.view
+        end = self.end
+        while offset + RECORD.size <= end:
+            kind, length, timestamp, device, remote = RECORD.unpack_from(view, offset)
+            start = offset + RECORD.size
+            if start + length > end:
+                break  # registro incompleto no fim de um segmento não fechado
+            yield offset, kind, timestamp, device, remote, view[start:start + length]
+            offset = start + length
+
+    def __iter__(self) -> Iterator[CapturedFrame]:
+        devices, remotes = self.devices, self.remotes
+        if not self.footer:
+            # Sem rodapé, as definições vêm intercaladas com os pacotes
+            devices, remotes = self.devices, self.remotes = [], []
+        for _, kind, timestamp, device, remote, data in self._records():
+            if kind == KIND_FRAME:
+                yield CapturedFrame(timestamp, remotes[remote], devices[device], data)
+            elif not self.footer:
+                names = devices if kind == KIND_DEVICE else remotes
+                names.append(str(data, 'utf-8'))
+
+    def frames_for(self, device_id: str) -> Iterator[CapturedFrame]:
+        """Pacotes de um dispositivo, usando o índice do rodapé quando existe."""
+        if not self.footer:
+            yield from (item for item in self if item.device_id == device_id)
+            return
+        try:
+            device = self.devices.index(device_id)
+        except ValueError:
+            return
+        view = self.view
+        for offset in self.footer['index'].get(str(device), []):
+            _, length, timestamp, _, remote = RECORD.unpack_from(view, offset)
+            start = offset + RECORD.size
+            yield CapturedFrame(timestamp, self.remotes[remote], device_id, view[start:start + length])
+
+    def close(self):
+        self.view.release()
+        self._file.close()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # pacotes ainda em uso; o mmap fecha quando forem liberados
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def segment_paths(path: Path) -> List[Path]:
+    path = Path(path)
+    if path.is_dir():
+        return sorted(path.glob(f'*{SEGMENT_SUFFIX}'))
+    return [path]
+
+
+def read_capture(path: Path, device_id: Optional[str] = None) -> Iterator[CapturedFrame]:
+    """Pacotes de um segmento ou de um diretório de segmentos (todos ou de um dispositivo)."""
+    for segment in segment_paths(path):
+        with CaptureReader(segment) as reader:
+            yield from (reader if device_id is None else reader.frames_for(device_id))
+
+
+# --- Replay -----------------------------------------------------------------
+
+async def _paced(frames: Iterator[CapturedFrame], speed: Optional[float]):
+    """Entrega os pacotes respeitando o intervalo original dividido por speed."""
+    start = None
+    origin = None
+    for item in frames:
+        if speed:
+            if origin is None:
+                origin, start = item.timestamp, time.monotonic()
+            delay = (item.timestamp - origin) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield item
+
+
+async def replay_decode(frames, speed):
+    """Alimenta os decoders do servidor, sem rede.
+
+    Os pacotes passam pelas mesmas etapas de DeviceConnection: as cópias
+    de um alerta são juntadas antes da conferência e das retransmissões,
+    com um AlertCollapser por conexão de origem.
+    """
+    from alerts import AlertCollapser
+    from decryption import Decryptor
+    from ws_server import decoders, dedupe, validator
+
+    decryptor = Decryptor()
+    collapsers: Dict[str, AlertCollapser] = {}
+
+    def process(frame, repetitions):
+        if validator.check(frame) and dedupe.check(frame):
+            frame = decryptor.process(frame)
+            if frame is not None:
+                decoded = decoders.decode(frame)
+                if repetitions > 1:
+                    decoded.repetitions = repetitions
+                decoded.to_dict()
+
+    count = 0
+    async for item in _paced(frames, speed):
+        alerts = collapsers.get(item.remote)
+        if alerts is None:
+            alerts = collapsers[item.remote] = AlertCollapser()
+        # A próxima cópia pode ser o pacote seguinte da captura: o alerta
+        # fica retido até chegar um pacote diferente (ou o fim)
+        for frame, repetitions in alerts.feed((item.frame,), pending=1):
+            process(frame, repetitions)
+        count += 1
+    for alerts in collapsers.values():
+        for frame, repetitions in alerts.flush():
+            process(frame, repetitions)
+    decryptor.keys.close()
+    collapsed = sum(alerts.collapsed for alerts in collapsers.values())
+    if collapsed:
+        print(f'cópias de alerta juntadas: {collapsed}', file=sys.stderr)
+    if validator.rejected:
+        print(f'rejeitados: {dict(validator.rejected)}', file=sys.stderr)
+    print(f'por decoder: {decoders.stats()}', file=sys.stderr)
+    print(f'retransmissões: {dedupe.stats()}', file=sys.stderr)
+    return count
+
+
+async def replay_websocket(frames, speed, url):
+    import websockets
+
+    count = 0
+    async with websockets.connect(url) as websocket:
+        async for item in _paced(frames, speed):
+            await websocket.send(bytes(item.frame))
+            count += 1
+    return count
+
+
+async def replay_tcp(frames, speed, host, port):
+    count = 0
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        async for item in _paced(frames, speed):
+            writer.write(item.frame)
+            if writer.transport.get_write_buffer_size() > 1024 * 1024:
+                await writer.drain()
+            count += 1
+        await writer.drain()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return count
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == 'max':
+        return None
+    return float(value.rstrip('x'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ferramentas de captura binária')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay = commands.add_parser('replay', help='reenvia uma captura aos decoders ou ao servidor')
+    replay.add_argument('path', type=Path, help='segmento .sncap ou diretório de segmentos')
+    replay.add_argument('--speed', default='1', type=parse_speed,
+                        help='1 (tempo real), N (N vezes mais rápido) ou max')
+    replay.add_argument('--target', default='decode',
+                        help='decode, ws://host:porta ou tcp://host:porta')
+    replay.add_argument('--device', help='só os pacotes deste device_id')
+    args = parser.parse_args(argv)
+
+    frames = read_capture(args.path, args.device)
+
+    if args.target == 'decode':
+        job = replay_decode(frames, args.speed)
+    elif args.target.startswith(('ws://', 'wss://')):
+        job = replay_websocket(frames, args.speed, args.target)
+    elif args.target.startswith('tcp://'):
+        host, _, port = args.target[len('tcp://'):].rpartition(':')
+        job = replay_tcp(frames, args.speed, host, int(port))
+    else:
+        parser.error(f'alvo desconhecido: {args.target}')
+
+    start = time.perf_counter()
+    count = asyncio.run(job)
+    elapsed = time.perf_counter() - start
+    print(f'{count} pacotes em {elapsed:.2f}s ({count / elapsed if elapsed else 0:,.0f} pacotes/s)',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""CRC16 dos pacotes Sinocastel (CRC-16/X-25, tabela pré-calculada).
+
+Polinômio 0x1021 refletido (0x8408), valor inicial 0xFFFF e XOR final
+0xFFFF, calculado do cabeçalho 0x4040 até o byte anterior ao campo crc.
+O valor é gravado em little-endian logo antes da cauda 0x0D0A.
+
+O cálculo por pacote usa ``binascii.crc_hqx`` (CRC-CCITT com tabela, em
+C) sobre os bytes com os bits invertidos, o que equivale à versão
+refletida. ``FrameValidator`` confere o pacote antes de qualquer
+decodificação e conta os rejeitados por motivo:
+
+    validator = FrameValidator()
+    if validator.check(frame):
+        decode_record(frame)
+    validator.rejected   # Counter({'crc': 3, 'tail': 1})
+"""
+import binascii
+import struct
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from framer import HEADER, MIN_FRAME_LEN, TAIL
+
+_U16 = struct.Struct('<H')
+
+# Motivos de rejeição, na ordem em que são conferidos
+REJECT_TRUNCATED = 'truncated'
+REJECT_HEADER = 'header'
+REJECT_LENGTH = 'length'
+REJECT_TAIL = 'tail'
+REJECT_CRC = 'crc'
+
+
+def _build_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC_TABLE = _build_table()
+
+# Byte com a ordem dos bits invertida, para usar o crc_hqx (não refletido)
+REVERSED_BITS = bytes(int(f'{byte:08b}'[::-1], 2) for byte in range(256))
+
+_crc_hqx = binascii.crc_hqx
+
+
+def crc16(data) -> int:
+    crc = _crc_hqx(bytes(data).translate(REVERSED_BITS), 0xFFFF)
+    return ((REVERSED_BITS[crc & 0xFF] << 8) | REVERSED_BITS[crc >> 8]) ^ 0xFFFF
+
+
+def crc16_python(data) -> int:
+    """Mesmo cálculo, byte a byte em Python (referência)."""
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def seal(packet: bytearray):
+    """Recalcula e grava o crc de um pacote completo (com cauda)."""
+    _U16.pack_into(packet, len(packet) - 4, crc16(memoryview(packet)[:-4]))
+
+
+def frame_error(frame) -> Optional[str]:
+    """Motivo pelo qual o pacote é inválido, ou None se estiver íntegro.
+
+    Só olha cabeçalho, protocol_length, cauda e crc; nenhum campo do
+    payload é decodificado.
+    """
+    size = len(frame)
+    if size < MIN_FRAME_LEN:
+        return REJECT_TRUNCATED
+    if frame[:2] != HEADER:
+        return REJECT_HEADER
+    if _U16.unpack_from(frame, 2)[0] != size:
+        return REJECT_LENGTH
+    if frame[size - 2:] != TAIL:
+        return REJECT_TAIL
+    if crc16(frame[:size - 4]) != _U16.unpack_from(frame, size - 4)[0]:
+        return REJECT_CRC
+    return None
+
+
+class FrameValidator:
+    """Confere pacotes e conta os rejeitados por motivo."""
+
+    def __init__(self):
+        self.checked = 0
+        self.rejected = Counter()
+
+    @property
+    def valid(self) -> int:
+        return self.checked - sum(self.rejected.values())
+
+    def check(self, frame) -> bool:
+        return self.reject_reason(frame) is None
+
+    def reject_reason(self, frame) -> Optional[str]:
+        """Como ``check``, mas devolve o motivo da rejeição (None se válido)."""
+        self.checked += 1
+        reason = frame_error(frame)
+        if reason is not None:
+            self.rejected[reason] += 1
+        return reason
+
+    def filter(self, frames: Iterable) -> List:
+        """Modo em lote: devolve só os pacotes válidos, na ordem original."""
+        valid = []
+        rejected = self.rejected
+        for frame in frames:
+            reason = frame_error(frame)
+            if reason is None:
+                valid.append(frame)
+            else:
+                rejected[reason] += 1
+            self.checked += 1
+        return valid
@@ -1,29 +1,7 @@
-import logging
-from pathlib import Path
+from sinocastel import LoginRecord
 
 class Decoder1001:
-    def __init__(self):
-        self.log_dir = Path('logs')
-        self.log_dir.mkdir(exist_ok=True)
-        self.interp_log_file = self.log_dir / 'interpreted_1001.log'
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s %(message)s',
-            handlers=[
-                logging.FileHandler(self.interp_log_file, encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
-
-    def decode(self, data: bytes) -> dict:
-        hex_data = data.hex()
-        # Interpretação fictícia baseada no protocolo 1001.txt
-        # Aqui você pode implementar a lógica real conforme o arquivo de referência
-        interpreted = {
-            'hex': hex_data,
-            'length': len(data),
-            'raw': data,
-            'info': 'Decodificação exemplo para protocolo 1001.'
-        }
-        logging.info(f'INTERPRETED: {interpreted}')
-        return interpreted 
\ No newline at end of file
+    def decode(self, data: memoryview) -> LoginRecord:
+        # Os campos são decodificados sob demanda; o registro só é formatado
+        # quando alguém (por exemplo, o log interpretado) pede
+        return LoginRecord(memoryview(data))
@@ -0,0 +1,6 @@
+from sinocastel import GpsRecord
+
+class Decoder4001:
+    def decode(self, data: memoryview) -> GpsRecord:
+        # Bloco de estado e GPS, como no login; ver sinocastel.GpsRecord
+        return GpsRecord(memoryview(data))
@@ -0,0 +1,7 @@
+from sinocastel import AlertRecord
+
+class Decoder4007:
+    def decode(self, data: memoryview) -> AlertRecord:
+        # As cópias repetidas já foram juntadas pelo AlertCollapser; o
+        # número de cópias é anotado no registro por quem chamou
+        return AlertRecord(memoryview(data))
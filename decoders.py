@@ -0,0 +1,113 @@
+"""Registro de decoders por (protocol_version, protocol_id).
+
+Cada tipo de mensagem tem seu módulo na raiz do projeto, seguindo a
+convenção de ``decoder_1001.py``:
+
+    decoder_<protocol_id em hex, 4 dígitos>.py  ->  class Decoder<ID>
+
+    # decoder_4001.py
+    PROTOCOL_VERSIONS = (3, 4)     # opcional; sem ele, qualquer versão
+    class Decoder4001:
+        def decode(self, data: memoryview) -> SinocastelRecord: ...
+
+Os módulos só são importados na primeira vez que um pacote com aquele
+protocol_id aparece, então a partida do servidor não cresce com o número
+de decoders. Depois disso o despacho é uma única consulta em dict para
+uma instância já criada; IDs sem decoder caem no GenericDecoder, que
+decodifica só cabeçalho e trailer.
+"""
+import importlib
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Tuple
+
+from sinocastel import SinocastelRecord
+
+DECODER_DIR = Path(__file__).resolve().parent
+
+# Posições no cabeçalho fixo: protocol_version (u8) e protocol_id (u16 BE)
+VERSION_OFFSET = 4
+PROTOCOL_ID_SLICE = slice(25, 27)
+
+log = logging.getLogger(__name__)
+
+
+class GenericDecoder:
+    """Decoder de quem ainda não tem módulo próprio: cabeçalho e trailer."""
+
+    def decode(self, data: memoryview) -> SinocastelRecord:
+        return SinocastelRecord(memoryview(data))
+
+
+def module_name(protocol_id: int) -> str:
+    return f'decoder_{protocol_id:04x}'
+
+
+def available_decoders() -> Dict[int, str]:
+    """protocol_id -> módulo, listando os arquivos sem importá-los."""
+    found = {}
+    for path in DECODER_DIR.glob('decoder_*.py'):
+        try:
+            found[int(path.stem[len('decoder_'):], 16)] = path.stem
+        except ValueError:
+            continue
+    return found
+
+
+class DecoderRegistry:
+    def __init__(self):
+        self.generic = GenericDecoder()
+        self._decoders: Dict[Tuple[int, int], object] = {}
+        # Um módulo serve todas as versões que aceita; importado uma vez
+        self._modules: Dict[int, object] = {}
+        self.counts = Counter()
+
+    def register(self, protocol_version: int, protocol_id: int, decoder):
+        """Registra uma instância explicitamente (testes, decoders externos)."""
+        self._decoders[(protocol_version, protocol_id)] = decoder
+
+    def get(self, protocol_version: int, protocol_id: int):
+        key = (protocol_version, protocol_id)
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            decoder = self._decoders[key] = self._load(protocol_version, protocol_id)
+        return decoder
+
+    def _load(self, protocol_version: int, protocol_id: int):
+        if protocol_id in self._modules:
+            module = self._modules[protocol_id]
+        else:
+            name = module_name(protocol_id)
+            try:
+                module = importlib.import_module(name)
+            except ModuleNotFoundError as exc:
+                if exc.name != name:
+                    raise
+                module = None
+            self._modules[protocol_id] = module
+            if module is not None:
+                log.info('Decoder carregado: %s', name)
+        if module is None:
+            return self.generic
+        versions = getattr(module, 'PROTOCOL_VERSIONS', None)
+        if versions is not None and protocol_version not in versions:
+            return self.generic
+        return getattr(module, f'Decoder{protocol_id:04X}')()
+
+    def decode(self, frame: memoryview) -> SinocastelRecord:
+        """Despacha o pacote pelo cabeçalho fixo e conta por (versão, ID)."""
+        key = (frame[VERSION_OFFSET], int.from_bytes(frame[PROTOCOL_ID_SLICE], 'big'))
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            decoder = self.get(*key)
+        self.counts[key] += 1
+        return decoder.decode(frame)
+
+    def stats(self) -> Dict[str, int]:
+        """Pacotes por decoder, no formato 'v4/0x1001'."""
+        return {f'v{version}/0x{protocol_id:04x}': count
+                for (version, protocol_id), count in self.counts.most_common()}
+
+
+registry = DecoderRegistry()
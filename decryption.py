@@ -0,0 +1,271 @@
+"""Etapa de decifragem AES dos pacotes protocol_version 0x04.
+
+Segundo documentacao/instrucao_protocolo_sinocastel.txt, a versão 0x04
+indica payload cifrado com AES. Na prática os pacotes de login
+capturados (bkp/hex_real.py, bkp/code.py) vêm em claro mesmo com versão
+0x04: a cifragem depende da configuração do equipamento. Por isso só os
+dispositivos com chave cadastrada são decifrados; os demais passam
+direto.
+
+Fica entre o framer (e a conferência de crc, que vale para os bytes
+transmitidos) e o despacho para os decoders:
+
+    frame = decryptor.process(frame)    # None se não der para decifrar
+
+O manual não detalha o modo; usamos AES-ECB (sem IV no pacote) sobre o
+payload, do fim do cabeçalho fixo até antes do crc. Os bytes que sobram
+depois do último bloco de 16 ficam como vieram.
+
+As chaves ficam na tabela ``device_keys`` do banco de sessões:
+
+    python decryption.py set-key 218LSAB2025000002 00112233445566778899aabbccddeeff
+
+Cada alteração grava ``updated_at``; o servidor consulta as alterações a
+cada ``refresh_interval`` segundos e descarta do cache os dispositivos
+alterados, então chaves novas (ou removidas) valem sem reiniciar.
+
+Requer o pacote ``cryptography``; sem ele, pacotes de dispositivos com
+chave são descartados e contados em ``counts['no_backend']``.
+"""
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+from framer import MAX_FRAME_LEN
+from sessions import SESSIONS_DB
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # pragma: no cover - depende do ambiente
+    Cipher = None
+
+ENCRYPTED_VERSION = 0x04
+BLOCK_SIZE = 16
+
+# Posições no cabeçalho fixo e início do payload
+VERSION_OFFSET = 4
+DEVICE_ID_SLICE = slice(5, 25)
+PAYLOAD_OFFSET = 27
+TRAILER_SIZE = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_keys (
+    device_id TEXT PRIMARY KEY,
+    aes_key BLOB NOT NULL,
+    updated_at REAL
+)
+"""
+INDEX = 'CREATE INDEX IF NOT EXISTS device_keys_updated_at ON device_keys (updated_at)'
+
+log = logging.getLogger(__name__)
+
+# Marcas no cache, para não voltar ao banco a cada pacote: dispositivo
+# sem chave e dispositivo com chave mas sem o pacote cryptography
+_NO_KEY = object()
+_NO_BACKEND = object()
+
+
+class KeyStore:
+    """Chaves AES por dispositivo, no mesmo SQLite das sessões."""
+
+    def __init__(self, path: Path = SESSIONS_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(SCHEMA)
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(device_keys)')}
+        if 'updated_at' not in columns:
+            # Banco criado antes da coluna existir
+            self._db.execute('ALTER TABLE device_keys ADD COLUMN updated_at REAL')
+        self._db.execute(INDEX)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, device_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute('SELECT aes_key FROM device_keys WHERE device_id = ?',
+                                   (device_id,)).fetchone()
+        # Chave vazia: removida (ver delete)
+        return bytes(row[0]) if row and row[0] else None
+
+    def set(self, device_id: str, key: bytes):
+        if len(key) not in (16, 24, 32):
+            raise ValueError('a chave AES deve ter 16, 24 ou 32 bytes')
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO device_keys VALUES (?, ?, ?)',
+                             (device_id, key, time.time()))
+
+    def delete(self, device_id: str):
+        # A linha fica, com a chave vazia, para que servidores rodando vejam a remoção
+        with self._lock, self._db:
+            self._db.execute("UPDATE device_keys SET aes_key = X'', updated_at = ? WHERE device_id = ?",
+                             (time.time(), device_id))
+
+    def latest_change(self) -> float:
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(updated_at), 0) FROM device_keys').fetchone()[0]
+
+    def changed_since(self, mark: float) -> List[tuple]:
+        """[(device_id, updated_at)] das chaves alteradas depois de ``mark``."""
+        with self._lock:
+            return self._db.execute('SELECT device_id, updated_at FROM device_keys WHERE updated_at > ?',
+                                    (mark,)).fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+class Decryptor:
+    """Decifra pacotes versão 0x04 com cache LRU de contextos AES.
+
+    O cache guarda, por device_id (os 20 bytes crus do cabeçalho), o
+    contexto de decifragem já criado; como o ECB não encadeia blocos
+    entre chamadas, o mesmo contexto serve a todos os pacotes do
+    dispositivo. Dispositivos sem chave também ficam no cache, para que
+    o caminho normal não consulte o banco; a cada ``refresh_interval``
+    segundos uma consulta indexada descarta os que tiveram a chave
+    alterada.
+    """
+
+    def __init__(self, keys: Optional[KeyStore] = None, capacity: int = 10000,
+                 refresh_interval: float = 5.0):
+        self.keys = keys if keys is not None else KeyStore()
+        self.capacity = capacity
+        self.refresh_interval = refresh_interval
+        self._key_mark = self.keys.latest_change()
+        self._next_refresh = time.monotonic() + refresh_interval
+        self._contexts: 'OrderedDict[bytes, object]' = OrderedDict()
+        # Área de trabalho reaproveitada por todos os pacotes
+        self._scratch = bytearray(MAX_FRAME_LEN + BLOCK_SIZE)
+        self._scratch_view = memoryview(self._scratch)
+        self.counts = Counter()
+        self._warned = False
+
+    def _context(self, device_key: bytes):
+        context = self._contexts.get(device_key)
+        if context is not None:
+            self._contexts.move_to_end(device_key)
+            return context
+        device_id = device_key.decode('ascii', errors='ignore').strip('\x00')
+        key = self.keys.get(device_id)
+        if key is None:
+            context = _NO_KEY
+        elif Cipher is None:
+            context = _NO_BACKEND
+        else:
+            context = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+        self._contexts[device_key] = context
+        if len(self._contexts) > self.capacity:
+            self._contexts.popitem(last=False)
+        return context
+
+    def forget(self, device_id: str):
+        """Descarta o contexto em cache (depois de trocar a chave)."""
+        self._contexts.pop(device_id.encode('ascii').ljust(20, b'\x00'), None)
+
+    def refresh(self) -> int:
+        """Descarta do cache os dispositivos com chave alterada desde a última vez."""
+        changed = self.keys.changed_since(self._key_mark)
+        for device_id, updated_at in changed:
+            self.forget(device_id)
+            self._key_mark = max(self._key_mark, updated_at)
+        if changed:
+            self.counts['key_changes'] += len(changed)
+        return len(changed)
+
+    def process(self, frame: memoryview) -> Optional[memoryview]:
+        """Devolve o pacote com o payload em claro, ou None se não der."""
+        if frame[VERSION_OFFSET] != ENCRYPTED_VERSION:
+            return frame
+        now = time.monotonic()
+        if now >= self._next_refresh:
+            self._next_refresh = now + self.refresh_interval
+            self.refresh()
+        context = self._context(bytes(frame[DEVICE_ID_SLICE]))
+        if context is _NO_KEY:
+            self.counts['plaintext'] += 1
+            return frame
+        if context is _NO_BACKEND:
+            self.counts['no_backend'] += 1
+            if not self._warned:
+                self._warned = True
+                log.error('Há chaves AES cadastradas, mas o pacote cryptography não está instalado')
+            return None
+
+        end = len(frame) - TRAILER_SIZE
+        size = (end - PAYLOAD_OFFSET) // BLOCK_SIZE * BLOCK_SIZE
+        # O registro decodificado guarda o buffer, então cada pacote em claro
+        # precisa de memória própria: uma cópia do pacote, com o payload
+        # decifrado na área de trabalho e copiado por cima
+        plain = bytearray(frame)
+        written = context.update_into(frame[PAYLOAD_OFFSET:PAYLOAD_OFFSET + size], self._scratch)
+        plain[PAYLOAD_OFFSET:PAYLOAD_OFFSET + written] = self._scratch_view[:written]
+        self.counts['decrypted'] += 1
+        return memoryview(plain)
+
+
+# --- Lotes (replay e reprocessamento) ----------------------------------------
+
+_worker = None
+
+
+def _init_worker(db_path: str):
+    global _worker
+    _worker = Decryptor(KeyStore(Path(db_path)))
+
+
+def _decrypt_chunk(frames: List[bytes]) -> List[Optional[bytes]]:
+    results = []
+    for frame in frames:
+        plain = _worker.process(memoryview(frame))
+        results.append(None if plain is None else bytes(plain))
+    return results
+
+
+def decrypt_frames(frames: Sequence, db_path: Path = SESSIONS_DB, workers: Optional[int] = None,
+                   chunk_size: int = 2048) -> List[Optional[bytes]]:
+    """Decifra um lote de pacotes em um pool de processos.
+
+    Cada processo abre o próprio KeyStore e mantém seu cache de
+    contextos. Devolve os pacotes na ordem original, com None onde não
+    foi possível decifrar.
+    """
+    chunks = [[bytes(frame) for frame in frames[start:start + chunk_size]]
+              for start in range(0, len(frames), chunk_size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(str(db_path),)) as pool:
+        for chunk in pool.map(_decrypt_chunk, chunks):
+            results.extend(chunk)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chaves AES dos dispositivos')
+    parser.add_argument('--db', type=Path, default=SESSIONS_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+    set_key = commands.add_parser('set-key', help='cadastra a chave (hex) de um dispositivo')
+    set_key.add_argument('device_id')
+    set_key.add_argument('key')
+    delete = commands.add_parser('delete-key', help='remove a chave de um dispositivo')
+    delete.add_argument('device_id')
+    args = parser.parse_args(argv)
+
+    keys = KeyStore(args.db)
+    try:
+        if args.command == 'set-key':
+            keys.set(args.device_id, bytes.fromhex(args.key))
+        else:
+            keys.delete(args.device_id)
+    finally:
+        keys.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Descarte de pacotes retransmitidos.
+
+Depois de uma reconexão o equipamento reenvia os pacotes que tinha em
+memória, e muitos já tinham chegado antes da queda. Cada pacote é
+identificado por (device_id, protocol_id, utc_time, crc), lidos direto
+do buffer, e conferido antes da decodificação:
+
+- um conjunto pequeno por dispositivo com as chaves mais recentes, que
+  pega a retransmissão logo após a reconexão sem nenhuma chance de erro;
+- um filtro de Bloom global, de tamanho fixo, que pega reenvios mais
+  antigos que a janela por dispositivo (ou de dispositivos que já saíram
+  do LRU). Ele pode descartar um pacote novo com probabilidade da ordem
+  de ``error_rate``; duas gerações se revezam a cada ``capacity``
+  inserções, para que essa taxa não cresça com o tempo.
+
+    dedupe = DuplicateFilter()
+    if dedupe.check(frame):
+        decode(frame)
+"""
+import math
+from collections import OrderedDict, deque
+from typing import Tuple
+
+# Posições no pacote: device_id, protocol_id e utc_time do bloco de estado
+DEVICE_ID_SLICE = slice(5, 25)
+PROTOCOL_ID_SLICE = slice(25, 27)
+UTC_TIME_SLICE = slice(31, 35)
+
+
+def frame_key(frame) -> Tuple[bytes, bytes]:
+    """(device_id, protocol_id + utc_time + crc) como bytes crus."""
+    size = len(frame)
+    return (bytes(frame[DEVICE_ID_SLICE]),
+            bytes(frame[PROTOCOL_ID_SLICE]) + bytes(frame[UTC_TIME_SLICE]) + bytes(frame[size - 4:size - 2]))
+
+
+_BITS = [1 << position for position in range(512)]
+
+
+class BloomFilter:
+    """Filtro de Bloom em blocos de 64 bytes.
+
+    Todos os bits de uma chave caem no mesmo bloco (uma linha de cache),
+    escolhido por ``hash(key)``; as 7 posições dentro do bloco saem de um
+    segundo hash de 64 bits, 9 bits por posição. Com só 7 posições o
+    filtro precisa de mais bits por chave para a mesma taxa de erro, mas
+    cada consulta custa dois hashes e a leitura de um único bloco.
+    """
+
+    BLOCK_BYTES = 64
+    HASHES = 7
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        # Bits por chave para k fixo, com 25% de folga pela divisão em blocos
+        k = self.HASHES
+        bits_per_key = -k / math.log(1 - error_rate ** (1 / k)) * 1.25
+        self.blocks = max(1, math.ceil(capacity * bits_per_key / (self.BLOCK_BYTES * 8)))
+        self.bits = bytearray(self.blocks * self.BLOCK_BYTES)
+        self.count = 0
+
+    def _locate(self, key: bytes):
+        start = hash(key) % self.blocks * self.BLOCK_BYTES
+        h = hash(key + b'\x00')
+        bit = _BITS
+        mask = (bit[h & 511] | bit[(h >> 9) & 511] | bit[(h >> 18) & 511] | bit[(h >> 27) & 511] |
+                bit[(h >> 36) & 511] | bit[(h >> 45) & 511] | bit[(h >> 54) & 511])
+        return start, mask
+
+    def __contains__(self, key: bytes) -> bool:
+        start, mask = self._locate(key)
+        block = int.from_bytes(self.bits[start:start + self.BLOCK_BYTES], 'little')
+        return block & mask == mask
+
+    def add(self, key: bytes) -> bool:
+        """Insere a chave; devolve True se ela (provavelmente) já estava lá."""
+        start, mask = self._locate(key)
+        end = start + self.BLOCK_BYTES
+        block = int.from_bytes(self.bits[start:end], 'little')
+        if block & mask == mask:
+            return True
+        self.bits[start:end] = (block | mask).to_bytes(self.BLOCK_BYTES, 'little')
+        self.count += 1
+        return False
+
+
+class DuplicateFilter:
+    def __init__(self, recent_per_device: int = 64, max_devices: int = 100000,
+                 capacity: int = 1000000, error_rate: float = 1e-5):
+        self.recent_per_device = recent_per_device
+        self.max_devices = max_devices
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._recent: 'OrderedDict[bytes, Tuple[set, deque]]' = OrderedDict()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = None
+        self.checked = 0
+        self.duplicates_recent = 0
+        self.duplicates_filter = 0
+
+    @property
+    def duplicates(self) -> int:
+        return self.duplicates_recent + self.duplicates_filter
+
+    def check(self, frame) -> bool:
+        """True para pacote novo; False (e contado) para retransmissão."""
+        self.checked += 1
+        device, local = frame_key(frame)
+        recent = self._recent.get(device)
+        if recent is None:
+            recent = self._recent[device] = (set(), deque())
+            if len(self._recent) > self.max_devices:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(device)
+            if local in recent[0]:
+                self.duplicates_recent += 1
+                return False
+
+        keys, order = recent
+        keys.add(local)
+        order.append(local)
+        if len(order) > self.recent_per_device:
+            keys.discard(order.popleft())
+
+        key = device + local
+        if self._current.add(key) or (self._previous is not None and key in self._previous):
+            self.duplicates_filter += 1
+            return False
+        if self._current.count >= self.capacity:
+            self._previous, self._current = self._current, BloomFilter(self.capacity, self.error_rate)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'checked': self.checked,
+            'duplicates_recent': self.duplicates_recent,
+            'duplicates_filter': self.duplicates_filter,
+            'devices': len(self._recent),
+            'filter_fill': self._current.count,
+        }
@@ -0,0 +1,328 @@
+"""Encaminhamento dos registros decodificados para um webhook HTTP.
+
+O loop de eventos só coloca o registro em uma fila limitada; threads de
+envio juntam os registros em lotes (por quantidade ou por tempo) e fazem
+um POST por lote, com um array JSON, em conexões HTTP persistentes (uma
+por thread). Falhas são repetidas com backoff exponencial. Quando a fila
+enche, ou um lote esgota as tentativas, os registros vão para arquivos
+de spill em disco (um JSON por linha), reenviados quando o destino
+volta a dar conta. O loop de eventos nunca grava em disco: com a fila
+cheia o registro vai para um deque de transbordo, que uma thread própria
+serializa e grava em lotes; se nem ela der conta (``max_overflow``), o
+registro é descartado e contado em ``dropped``.
+
+    WEBHOOK_URL=http://127.0.0.1:3000/webhook python ws_server.py
+
+O ``teste.js`` (Express, ``POST /webhook`` na porta 3000) serve de
+destino local.
+"""
+import http.client
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+DEFAULT_URL = 'http://127.0.0.1:3000/webhook'
+SPILL_DIR = Path('logs') / 'spill'
+SPILL_SUFFIX = '.ndjson'
+
+_STOP = object()
+
+log = logging.getLogger(__name__)
+
+
+class DeliveryError(Exception):
+    pass
+
+
+class WebhookForwarder:
+    def __init__(self, url: str = DEFAULT_URL, batch_size: int = 200, batch_interval: float = 0.5,
+                 max_queue: int = 50000, max_overflow: int = 50000,
+                 connections: int = 2, timeout: float = 10.0,
+                 max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 30.0,
+                 spill_dir: Path = SPILL_DIR, spill_bytes: int = 64 * 1024 * 1024):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'URL de webhook inválida: {url}')
+        self.url = url
+        self._connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                  else http.client.HTTPConnection)
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue(maxsize=max_queue)
+        # deque: append no loop de eventos e popleft na thread de spill, sem trava
+        self.max_overflow = max_overflow
+        self._overflow = deque()
+        self._stop = threading.Event()
+        # Prazo de stop() esgotado: as threads de envio largam o que estão
+        # fazendo e o que sobrou na fila vai para o disco
+        self._abort = threading.Event()
+
+        self.spill_dir = Path(spill_dir)
+        self.spill_bytes = spill_bytes
+        self._spill_file = None
+        self._spill_size = 0
+        self._spill_sequence = 0
+        self._spill_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+
+        self.sent = 0
+        self.batches = 0
+        self.retries = 0
+        self.spilled = 0
+        self.unspilled = 0
+        self.dropped = 0
+        self._workers = [threading.Thread(target=self._run, name=f'webhook-{i}', daemon=True)
+                         for i in range(connections)]
+        self._spiller = threading.Thread(target=self._run_overflow, name='webhook-spill', daemon=True)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() + len(self._overflow)
+
+    def start(self):
+        self._recover_spill()
+        for worker in self._workers:
+            worker.start()
+        self._spiller.start()
+
+    def submit(self, record):
+        """Enfileira um registro (com ``to_json()``); nunca bloqueia nem grava em disco."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if len(self._overflow) >= self.max_overflow:
+                self.dropped += 1
+            else:
+                self._overflow.append(record)
+
+    # --- Envio -----------------------------------------------------------
+
+    def _connect(self):
+        return self._connection_class(self._host, self._port, timeout=self.timeout)
+
+    def _post(self, connection, body: bytes):
+        connection.request('POST', self._path, body=body,
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()  # libera a conexão para o próximo pedido
+        if response.status >= 300:
+            raise DeliveryError(f'HTTP {response.status}')
+
+    def _deliver(self, connection, payloads: List[bytes],
+                 spill: bool = True) -> Optional[http.client.HTTPConnection]:
+        """Envia um lote, com novas tentativas; devolve a conexão a reutilizar.
+
+        Se todas as tentativas falharem, devolve None e, com ``spill``, o
+        lote vai para o disco.
+        """
+        body = b'[' + b','.join(payloads) + b']'
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                if connection is None:
+                    connection = self._connect()
+                self._post(connection, body)
+                self.sent += len(payloads)
+                self.batches += 1
+                return connection
+            except (OSError, http.client.HTTPException, DeliveryError) as exc:
+                # Conexão em estado desconhecido: abre outra na próxima tentativa
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if attempt == self.max_retries:
+                    log.error('Webhook %s falhou após %d tentativas (%s); %d registros em disco',
+                              self.url, attempt + 1, exc, len(payloads))
+                    if spill:
+                        self._spill(payloads)
+                    return None
+                self.retries += 1
+                if self._abort.wait(delay * random.uniform(0.5, 1.0)):
+                    if spill:
+                        self._spill(payloads)
+                    return None
+                delay = min(delay * 2, self.max_backoff)
+
+    def _run(self):
+        connection = None
+        while not self._abort.is_set():
+            batch = []
+            stop = False
+            try:
+                item = self.queue.get(timeout=self.batch_interval)
+            except queue.Empty:
+                # Fila vazia: hora de reenviar o que ficou em disco
+                connection = self._drain_spill(connection)
+                continue
+            deadline = time.monotonic() + self.batch_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item.to_json())
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                connection = self._deliver(connection, batch)
+            if stop:
+                break
+        if connection is not None:
+            connection.close()
+
+    # --- Spill em disco --------------------------------------------------
+
+    def _run_overflow(self):
+        while not self._stop.wait(0.2):
+            try:
+                self._spill_overflow()
+            except OSError:
+                log.exception('Falha ao gravar o transbordo do webhook')
+
+    def _spill_overflow(self):
+        overflow = self._overflow
+        while overflow:
+            payloads = []
+            while overflow and len(payloads) < 1000:
+                payloads.append(overflow.popleft().to_json())
+            self._spill(payloads)
+
+    def _spill(self, payloads: List[bytes]):
+        if not payloads:
+            return
+        with self._spill_lock:
+            if self._spill_file is None or self._spill_size >= self.spill_bytes:
+                self._close_spill()
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                self._spill_sequence += 1
+                name = f"spill-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._spill_sequence:04d}"
+                self._spill_file = open(self.spill_dir / (name + '.part'), 'ab')
+                self._spill_size = 0
+            data = b'\n'.join(payloads) + b'\n'
+            self._spill_file.write(data)
+            self._spill_size += len(data)
+            self.spilled += len(payloads)
+
+    def _close_spill(self):
+        # Só arquivos fechados (.ndjson) são reenviados
+        if self._spill_file is not None:
+            path = Path(self._spill_file.name)
+            self._spill_file.close()
+            os.replace(path, path.with_suffix(SPILL_SUFFIX))
+            self._spill_file = None
+
+    def _recover_spill(self):
+        """Fecha os .part deixados por uma execução que caiu.
+
+        O diretório é exclusivo deste forwarder (um por processo), então
+        todo .part que existe antes do start() é de uma execução anterior.
+        Uma última linha cortada no meio é descartada.
+        """
+        try:
+            for path in sorted(self.spill_dir.glob('*.part')):
+                data = path.read_bytes()
+                complete = data[:data.rfind(b'\n') + 1]
+                if len(complete) < len(data):
+                    path.write_bytes(complete)
+                os.replace(path, path.with_suffix(SPILL_SUFFIX))
+                log.warning('Spill incompleto recuperado: %s', path.name)
+        except OSError:
+            log.exception('Falha ao recuperar o spill em %s', self.spill_dir)
+
+    def _drain_spill(self, connection):
+        if not self._drain_lock.acquire(blocking=False):
+            return connection
+        try:
+            with self._spill_lock:
+                self._close_spill()
+            for path in sorted(self.spill_dir.glob(f'*{SPILL_SUFFIX}')):
+                payloads = [line for line in path.read_bytes().splitlines() if line]
+                for start in range(0, len(payloads), self.batch_size):
+                    batch = payloads[start:start + self.batch_size]
+                    connection = self._deliver(connection, batch, spill=False)
+                    if connection is None:
+                        # Destino fora do ar: o arquivo fica só com o que falta
+                        temporary = path.with_suffix('.tmp')
+                        temporary.write_bytes(b'\n'.join(payloads[start:]) + b'\n')
+                        os.replace(temporary, path)
+                        return None
+                    self.unspilled += len(batch)
+                path.unlink()
+                if not self.queue.empty() or self._abort.is_set():
+                    break  # tráfego novo tem prioridade
+        except OSError:
+            log.exception('Falha ao reenviar o spill')
+        finally:
+            self._drain_lock.release()
+        return connection
+
+    def stop(self, timeout: float = 10.0):
+        """Envia o que está na fila e encerra as threads.
+
+        Espera no máximo ``timeout`` segundos: com o destino fora do ar a
+        fila pode estar cheia e sem ninguém esvaziando, e o encerramento
+        não pode travar o loop de eventos.
+        """
+        deadline = time.monotonic() + timeout
+        self._stop.set()
+        if self._spiller.is_alive():
+            self._spiller.join(timeout)
+        for _ in self._workers:
+            try:
+                self.queue.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join(max(0.0, deadline - time.monotonic()))
+        self._abort.set()
+        for worker in self._workers:
+            # Um POST em andamento ainda pode levar até self.timeout
+            if worker.is_alive():
+                worker.join(self.timeout)
+        # O que não foi enviado a tempo fica em disco para a próxima execução
+        leftovers = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftovers.append(item.to_json())
+        if leftovers:
+            self._spill(leftovers)
+        self._spill_overflow()
+        with self._spill_lock:
+            self._close_spill()
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'batches': self.batches,
+            'retries': self.retries,
+            'spilled': self.spilled,
+            'unspilled': self.unspilled,
+            'dropped': self.dropped,
+            'queue_depth': self.queue_depth,
+        }
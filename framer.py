@@ -0,0 +1,101 @@
+import struct
+from typing import List, Union
+
+# Estrutura fixa de todo pacote Sinocastel:
+# 0x4040 | protocol_length (U16 LE) | ... | crc (U16) | 0x0D0A
+HEADER = b'\x40\x40'
+TAIL = b'\x0d\x0a'
+# head(2) + length(2) + version(1) + device_id(20) + protocol_id(2) + crc(2) + tail(2)
+MIN_FRAME_LEN = 31
+# Nenhum pacote real chega perto disso (alertas têm 384 bytes). Um limite
+# baixo evita esperar dezenas de KB por um falso cabeçalho no meio do lixo.
+MAX_FRAME_LEN = 2048
+
+_LENGTH = struct.Struct('<H')
+
+BufferLike = Union[bytes, bytearray]
+
+
+class SinocastelFramer:
+    """Remonta pacotes Sinocastel a partir de um fluxo de bytes.
+
+    O TCP não preserva fronteiras de mensagem: um recv pode trazer meio
+    pacote ou vários pacotes colados. O framer acumula os bytes recebidos,
+    sincroniza no cabeçalho 0x4040, usa o protocol_length para cortar o
+    pacote e confere a cauda 0x0D0A antes de entregá-lo.
+
+    Os pacotes são devolvidos como fatias ``memoryview`` do buffer
+    recebido, sem cópia. O framer nunca altera um buffer depois de
+    entregar fatias dele, então as fatias continuam válidas enquanto o
+    chamador as mantiver.
+    """
+
+    def __init__(self, max_frame_len: int = MAX_FRAME_LEN):
+        self.max_frame_len = max_frame_len
+        self._pending = bytearray()
+        # Tamanho que o buffer pendente precisa atingir para fechar um pacote
+        self._needed = 0
+        self.frames = 0
+        self.discarded_bytes = 0
+        self.resyncs = 0
+
+    @property
+    def buffered(self) -> int:
+        """Quantidade de bytes aguardando o restante de um pacote."""
+        return len(self._pending)
+
+    def feed(self, data: BufferLike) -> List[memoryview]:
+        """Adiciona bytes recebidos e devolve os pacotes completos."""
+        if self._pending:
+            self._pending += data
+            if len(self._pending) < self._needed:
+                return []
+            # O buffer acumulado passa a ser só leitura; um novo assume as sobras
+            buf = self._pending
+            self._pending = bytearray()
+        else:
+            buf = data
+
+        frames = []
+        view = memoryview(buf)
+        end = len(buf)
+        pos = 0
+        self._needed = 0
+        while pos < end:
+            start = buf.find(HEADER, pos)
+            if start < 0:
+                # Um 0x40 solto no final pode ser a primeira metade do cabeçalho
+                keep = end - 1 if buf[end - 1] == 0x40 else end
+                self.discarded_bytes += keep - pos
+                pos = keep
+                break
+            if start > pos:
+                self.discarded_bytes += start - pos
+                pos = start
+            if end - pos < 4:
+                break
+            length = _LENGTH.unpack_from(buf, pos + 2)[0]
+            if length < MIN_FRAME_LEN or length > self.max_frame_len:
+                self._resync()
+                pos += 1
+                continue
+            if end - pos < length:
+                self._needed = length
+                break
+            frame_end = pos + length
+            if buf[frame_end - 2] != 0x0d or buf[frame_end - 1] != 0x0a:
+                # Cabeçalho falso (0x4040 dentro do payload) ou pacote corrompido
+                self._resync()
+                pos += 1
+                continue
+            frames.append(view[pos:frame_end])
+            pos = frame_end
+
+        if pos < end:
+            self._pending += view[pos:]
+        self.frames += len(frames)
+        return frames
+
+    def _resync(self):
+        self.resyncs += 1
+        self.discarded_bytes += 1
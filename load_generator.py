@@ -0,0 +1,329 @@
+"""Gerador de carga assíncrono (evolução de bkp/obd_simulator.py).
+
+Simula milhares de dispositivos, cada um com seu device_id, conectando
+por TCP puro (porta 29480) ou pelo WebSocket do servidor (porta 29479);
+``--port`` muda a porta do transporte escolhido. Cada dispositivo envia o login 0x1001, depois telemetria
+0x4001 periódica e, de tempos em tempos, uma rajada de alerta 0x4007 de
+256 ou 384 bytes (pacote base de 128 bytes repetido, como em
+documentacao/ALERT_PROTOCOLS_ANALYSIS.md). device_id, horário e crc são
+reescritos em cada pacote.
+
+    python load_generator.py --devices 5000 --transport ws --duration 60
+
+Ao final mostra a vazão obtida, os erros de conexão e a latência de
+ponta a ponta (p50/p99): o gerador assina ``/subscribe`` (pubsub.py) para
+uma amostra dos dispositivos (``--latency-devices``) e mede do envio do
+pacote até o registro decodificado chegar ao painel.
+"""
+import argparse
+import asyncio
+import calendar
+import json
+import random
+import struct
+import time
+from array import array
+from typing import Dict, Tuple
+
+from alerts import ALERT_PROTOCOL_ID, ALERT_TYPES
+from crc16 import seal
+from sinocastel import ACC_ON, GPS_ITEM, HEADER, LOGIN_FIXED, TRAILER
+
+# Pacote real de login enviado por bkp/obd_simulator.py
+LOGIN_TEMPLATE = bytes.fromhex(
+    "40408600043231384c534142323032353030303030320000001001508e7a68ed977a68fea31900459200002b"
+    "48000029010402040003382d441500831c0112071912341e40b6ec044ca84d09f6098a07ec42342e332e392e"
+    "325f42524c20323032342d30312d323520303100442d3231384c53412d4220204844432d333656000000ed6d0d0a"
+)
+
+TELEMETRY_PROTOCOL_ID = 0x4001
+ALERT_BASE_SIZE = 128
+# Bits de alerta no byte S3 do vstate (ALERTA_GERAL, ALTO_RPM, FRENAGEM, VELOCIDADE)
+ALERT_FLAGS = tuple(bit for bit, _ in ALERT_TYPES)
+
+DEVICE_ID = slice(5, 25)
+PROTOCOL_ID = slice(25, 27)
+DEFAULT_PORTS = {'ws': 29479, 'tcp': 29480}
+UTC_TIME_OFFSET = HEADER.size + 4
+_U32 = struct.Struct('<I')
+
+
+def build_packet(protocol_id: int, device_id: bytes, body: bytes, version: int = 4) -> bytearray:
+    length = HEADER.size + len(body) + TRAILER.size
+    packet = bytearray(HEADER.struct.pack(b'@@', length, version, device_id,
+                                          protocol_id.to_bytes(2, 'big')))
+    packet += body
+    packet += b'\x00\x00\r\n'
+    seal(packet)
+    return packet
+
+
+def stat_and_gps(now: int, mileage: int, vstate: int, lat: float, lon: float, speed: int) -> bytes:
+    """Bloco de estado (mesmo layout fixo do login) seguido de um GPS."""
+    stat = LOGIN_FIXED.struct.pack(now - 600, now, mileage, mileage % 50000, mileage // 10, 300,
+                                   vstate, 0x03, 0x38, 0x2d, 0x44, 0x15, 0x00, 0x1c83, 1)
+    t = time.gmtime(now)
+    # Bit 0 leste, bit 1 norte, bits 2-3 fix 3D, bits 4-7 satélites
+    flags = (0x00 if lat < 0 else 0x02) | (0x00 if lon < 0 else 0x01) | 0x0c | (10 << 4)
+    gps = GPS_ITEM.struct.pack(t.tm_mday, t.tm_mon, t.tm_year % 100, t.tm_hour, t.tm_min, t.tm_sec,
+                               int(abs(lat) * 3600000), int(abs(lon) * 3600000), speed, 1800, flags)
+    return stat + gps
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.connect_errors = 0
+        self.send_errors = 0
+        self.packets = 0
+        self.bytes = 0
+        self.latencies = array('d')
+
+    def percentile(self, fraction: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def device_name(number: int) -> str:
+    return f'LG{number:015d}'
+
+
+class LatencyProbe:
+    """Latência de ponta a ponta pelos registros que chegam em /subscribe.
+
+    Cada pacote enviado por um dispositivo da amostra é lembrado por
+    (device_id, protocol_id, utc_time) com o horário de envio; o registro
+    correspondente que chega ao painel fecha a medida. O painel guarda só
+    o último registro de cada (device_id, protocol_id), então pacotes
+    substituídos antes do envio ficam sem medida, e saem do dicionário
+    quando ele passa de ``capacity``.
+    """
+
+    def __init__(self, stats: Stats, devices: int, capacity: int = 100000):
+        self.stats = stats
+        self.devices = frozenset(device_name(number) for number in range(devices))
+        self.capacity = capacity
+        self.sent_at: Dict[Tuple[str, int, int], float] = {}
+        self.received = 0
+
+    def sent(self, device_id: str, packet, now: int):
+        key = (device_id, int.from_bytes(packet[PROTOCOL_ID], 'big'), now)
+        sent_at = self.sent_at
+        # Dois pacotes iguais no mesmo segundo: mede o primeiro
+        sent_at.setdefault(key, time.perf_counter())
+        if len(sent_at) > self.capacity:
+            del sent_at[next(iter(sent_at))]
+
+    def received_records(self, message):
+        now = time.perf_counter()
+        for record in json.loads(message):
+            payload = record.get('payload') or {}
+            try:
+                utc_time = calendar.timegm(time.strptime(payload['utc_time'], '%Y-%m-%d %H:%M:%S'))
+                key = (record['device_id'], int(record['protocol_id'], 16), utc_time)
+            except (KeyError, TypeError, ValueError):
+                continue
+            sent_at = self.sent_at.pop(key, None)
+            if sent_at is not None:
+                self.received += 1
+                self.stats.latencies.append(now - sent_at)
+
+    async def run(self, url: str, connected: asyncio.Event):
+        import websockets
+
+        url += '?device=' + ','.join(sorted(self.devices))
+        try:
+            async with websockets.connect(url, max_size=None) as websocket:
+                connected.set()
+                async for message in websocket:
+                    self.received_records(message)
+        except (OSError, websockets.WebSocketException) as exc:
+            print(f'Latência: falha em {url.partition("?")[0]}: {exc}')
+        finally:
+            connected.set()
+
+
+class VirtualDevice:
+    def __init__(self, number: int, stats: Stats, args, probe=None):
+        self.name = device_name(number)
+        self.device_id = self.name.encode('ascii').ljust(20, b'\x00')
+        self.stats = stats
+        self.args = args
+        # Só os dispositivos da amostra de latência
+        self.probe = probe if probe is not None and self.name in probe.devices else None
+        self.mileage = random.randint(10_000, 2_000_000)
+        self.lat = -22.9 + random.uniform(-0.5, 0.5)
+        self.lon = -43.3 + random.uniform(-0.5, 0.5)
+        self.login = bytearray(LOGIN_TEMPLATE)
+        self.login[DEVICE_ID] = self.device_id
+
+    def login_packet(self, now: int) -> bytearray:
+        _U32.pack_into(self.login, UTC_TIME_OFFSET, now)
+        seal(self.login)
+        return self.login
+
+    def telemetry_packet(self, now: int) -> bytearray:
+        self.mileage += random.randint(0, 300)
+        self.lat += random.uniform(-0.001, 0.001)
+        self.lon += random.uniform(-0.001, 0.001)
+        body = stat_and_gps(now, self.mileage, ACC_ON, self.lat, self.lon, random.randint(0, 3000))
+        return build_packet(TELEMETRY_PROTOCOL_ID, self.device_id, body)
+
+    def alert_burst(self, now: int) -> bytearray:
+        flags = 0
+        for flag in random.sample(ALERT_FLAGS, random.randint(1, 2)):
+            flags |= flag
+        body = stat_and_gps(now, self.mileage, ACC_ON | (flags << 24), self.lat, self.lon, 3000)
+        body += bytes(ALERT_BASE_SIZE - HEADER.size - len(body) - TRAILER.size)
+        base = build_packet(ALERT_PROTOCOL_ID, self.device_id, body)
+        return base * random.choice((2, 3))
+
+    def sequence(self):
+        """Gera (atraso, pacote) para a sessão inteira do dispositivo."""
+        args = self.args
+        yield 0, self.login_packet
+        next_alert = random.expovariate(1 / args.alert_interval) if args.alert_interval else None
+        elapsed = 0.0
+        while True:
+            delay = args.interval * random.uniform(0.9, 1.1)
+            elapsed += delay
+            if next_alert is not None and elapsed >= next_alert:
+                next_alert += random.expovariate(1 / args.alert_interval)
+                yield delay, self.alert_burst
+            else:
+                yield delay, self.telemetry_packet
+
+    def sending(self, packet, now: int):
+        """Chamado logo antes de enviar o pacote."""
+        if self.probe is not None:
+            self.probe.sent(self.name, packet, now)
+
+    def sent(self, size: int):
+        self.stats.packets += 1
+        self.stats.bytes += size
+
+
+async def run_tcp(device: VirtualDevice, deadline: float):
+    args = device.args
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port),
+                                                args.connect_timeout)
+    except (OSError, asyncio.TimeoutError):
+        device.stats.connect_errors += 1
+        return
+    device.stats.connected += 1
+    try:
+        for delay, make_packet in device.sequence():
+            if time.monotonic() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            now = int(time.time())
+            packet = make_packet(now)
+            device.sending(packet, now)
+            writer.write(packet)
+            await writer.drain()
+            device.sent(len(packet))
+    except OSError:
+        device.stats.send_errors += 1
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def run_websocket(device: VirtualDevice, deadline: float):
+    import websockets
+
+    args = device.args
+    url = f'ws://{args.host}:{args.port}'
+    try:
+        websocket = await asyncio.wait_for(websockets.connect(url), args.connect_timeout)
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+        device.stats.connect_errors += 1
+        return
+    device.stats.connected += 1
+    try:
+        for delay, make_packet in device.sequence():
+            if time.monotonic() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            now = int(time.time())
+            packet = make_packet(now)
+            device.sending(packet, now)
+            await websocket.send(bytes(packet))
+            device.sent(len(packet))
+    except (OSError, websockets.WebSocketException):
+        device.stats.send_errors += 1
+    finally:
+        await websocket.close()
+
+
+async def run(args) -> Stats:
+    stats = Stats()
+    probe = probe_task = None
+    if args.latency_devices:
+        probe = LatencyProbe(stats, min(args.latency_devices, args.devices))
+        connected = asyncio.Event()
+        probe_task = asyncio.create_task(probe.run(args.subscribe_url, connected))
+        await connected.wait()
+    start = time.monotonic()
+    deadline = start + args.duration
+    session = run_websocket if args.transport == 'ws' else run_tcp
+
+    async def start_device(number):
+        # Distribui as conexões ao longo do ramp-up
+        await asyncio.sleep(args.ramp * number / max(args.devices, 1))
+        await session(VirtualDevice(number, stats, args, probe), deadline)
+
+    await asyncio.gather(*(start_device(number) for number in range(args.devices)))
+    stats.elapsed = time.monotonic() - start
+    if probe_task is not None:
+        # Registros dos últimos pacotes ainda a caminho do painel
+        await asyncio.sleep(1.0)
+        probe_task.cancel()
+    return stats
+
+
+def report(stats: Stats):
+    print(f'Conexões: {stats.connected} ok, {stats.connect_errors} erros de conexão, '
+          f'{stats.send_errors} erros de envio')
+    print(f'Enviados: {stats.packets} pacotes, {stats.bytes} bytes em {stats.elapsed:.1f}s '
+          f'({stats.packets / stats.elapsed:,.0f} pacotes/s, {stats.bytes / stats.elapsed / 1024:,.0f} KiB/s)')
+    if stats.latencies:
+        print(f'Latência (envio até /subscribe): {len(stats.latencies)} amostras, '
+              f'p50 {stats.percentile(0.50) * 1000:.2f} ms, p99 {stats.percentile(0.99) * 1000:.2f} ms')
+    else:
+        print('Latência: nenhum registro recebido em /subscribe')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gerador de carga de dispositivos Sinocastel')
+    parser.add_argument('--devices', type=int, default=1000, help='dispositivos simulados')
+    parser.add_argument('--transport', choices=('tcp', 'ws'), default='ws')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='padrão: 29479 (ws) ou 29480 (tcp)')
+    parser.add_argument('--duration', type=float, default=60.0, help='segundos de teste')
+    parser.add_argument('--ramp', type=float, default=10.0, help='segundos para abrir todas as conexões')
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='segundos entre pacotes de telemetria de cada dispositivo')
+    parser.add_argument('--alert-interval', type=float, default=120.0,
+                        help='intervalo médio entre rajadas de alerta (0 desliga)')
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--latency-devices', type=int, default=50,
+                        help='dispositivos acompanhados em /subscribe para medir a latência (0 desliga)')
+    parser.add_argument('--subscribe-url', help='padrão: ws://HOST:29479/subscribe, ou --port com ws')
+    args = parser.parse_args(argv)
+    if args.port is None:
+        args.port = DEFAULT_PORTS[args.transport]
+    if args.subscribe_url is None:
+        ws_port = args.port if args.transport == 'ws' else DEFAULT_PORTS['ws']
+        args.subscribe_url = f'ws://{args.host}:{ws_port}/subscribe'
+    report(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Logging assíncrono em lote para os logs brutos e interpretados.
+
+O loop de eventos só coloca o LogRecord em uma fila limitada; a
+formatação (inclusive o f-string implícito de ``%s``) e a escrita em
+disco acontecem em uma thread de fundo, que agrupa vários registros por
+escrita e faz um único flush por arquivo em cada lote. Se a fila encher,
+o registro é descartado e contado em ``dropped``, em vez de bloquear a
+ingestão de pacotes. Uma falha de escrita (disco cheio, permissão) também
+conta as linhas em ``dropped``, é avisada uma vez no stderr e a thread
+continua, tentando de novo no lote seguinte.
+
+    pipeline = setup_logging(console=True)
+    logging.getLogger('obd.raw').info('RAW %s %s', remote, lazy_hex(data))
+"""
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+LOG_DIR = Path('logs')
+
+# Logger -> arquivo. O logger raiz (eventos do servidor, bibliotecas)
+# segue para o log bruto, como antes.
+STREAMS = {
+    'raw': 'raw_data.log',
+    'interpreted': 'interpreted_1001.log',
+}
+LOGGERS = {
+    '': 'raw',
+    'obd.raw': 'raw',
+    'obd.interpreted': 'interpreted',
+}
+
+LOG_FORMAT = '%(asctime)s %(message)s'
+
+_STOP = object()
+
+
+class lazy_hex:
+    """Formata bytes em hexadecimal só quando o log é escrito."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
+class RotatingFile:
+    """Arquivo de log com rotação por tamanho e por tempo.
+
+    Ao rotacionar, ``arquivo.log`` vira ``arquivo.log.1`` e os anteriores
+    são deslocados, mantendo ``backup_count`` cópias. O tamanho é contado
+    em bytes (UTF-8).
+    """
+
+    def __init__(self, path: Path, max_bytes: int, interval: float, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        self.opened_at = time.time()
+
+    def write(self, text: str):
+        data = text.encode('utf-8')
+        if self.file is None:
+            # Fechado por uma falha anterior (ver rotate)
+            self._open()
+        if self.size and (self.size + len(data) > self.max_bytes or
+                          time.time() - self.opened_at >= self.interval):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        file, self.file = self.file, None
+        file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f'{self.path.name}.{index}')
+            if source.exists():
+                os.replace(source, self.path.with_name(f'{self.path.name}.{index + 1}'))
+        if self.backup_count:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink()
+        self._open()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class _EnqueueHandler(logging.Handler):
+    """Handler do lado do loop de eventos: só enfileira o registro."""
+
+    def __init__(self, pipeline: 'LogPipeline', stream: str):
+        super().__init__()
+        self.pipeline = pipeline
+        self.stream = stream
+
+    def emit(self, record):
+        try:
+            self.pipeline.queue.put_nowait((self.stream, record))
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+
+class LogPipeline:
+    def __init__(self, log_dir: Path = LOG_DIR, console: bool = False,
+                 max_queue: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 0.5, max_bytes: int = 50 * 1024 * 1024,
+                 rotate_interval: float = 24 * 3600, backup_count: int = 7):
+        self.log_dir = Path(log_dir)
+        self.console = console
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.write_errors = 0
+        self.formatter = logging.Formatter(LOG_FORMAT)
+
+        self.log_dir.mkdir(exist_ok=True)
+        self.files: Dict[str, RotatingFile] = {
+            stream: RotatingFile(self.log_dir / filename, max_bytes, rotate_interval, backup_count)
+            for stream, filename in STREAMS.items()
+        }
+        self.handlers = {stream: _EnqueueHandler(self, stream) for stream in STREAMS}
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def install(self, level=logging.INFO):
+        """Liga os loggers do projeto às filas e inicia a thread de escrita."""
+        for name, stream in LOGGERS.items():
+            logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.addHandler(self.handlers[stream])
+            logger.setLevel(level)
+            # Os loggers de stream não repassam para o raiz (evita duplicar)
+            logger.propagate = not name
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch) -> bool:
+        lines: Dict[str, list] = {}
+        stop = False
+        for item in batch:
+            if item is _STOP:
+                stop = True
+                continue
+            stream, record = item
+            try:
+                text = self.formatter.format(record)
+            except Exception:
+                text = f'<erro ao formatar log: {record.msg!r}>'
+            lines.setdefault(stream, []).append(text)
+        for stream, stream_lines in lines.items():
+            text = '\n'.join(stream_lines) + '\n'
+            if self.console:
+                sys.stderr.write(text)
+            try:
+                self.files[stream].write(text)
+            except OSError as exc:
+                # Não dá para usar o logging aqui: ele passa por esta thread
+                self.dropped += len(stream_lines)
+                self.write_errors += 1
+                if self.write_errors == 1:
+                    sys.stderr.write(f'Falha ao gravar o log {self.files[stream].path}: {exc}; '
+                                     'linhas descartadas até a escrita voltar\n')
+        return stop
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """Esvazia a fila, fecha os arquivos e encerra a thread."""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+        for file in self.files.values():
+            file.close()
+
+
+def setup_logging(console: bool = False, **options) -> LogPipeline:
+    pipeline = LogPipeline(console=console, **options)
+    pipeline.install()
+    return pipeline
@@ -0,0 +1,294 @@
+"""Métricas do servidor no formato texto do Prometheus.
+
+Contadores (conexões, pacotes, bytes, erros de decode e falhas de crc
+por protocol_id), histogramas de latência por etapa do pipeline, filas
+e atraso do loop de eventos, servidos em um endpoint HTTP local:
+
+    curl http://127.0.0.1:29481/metrics
+
+``METRICS=0`` desliga tudo: ``ws_server.metrics`` fica None e o caminho
+dos pacotes não mede nada. Ligadas, cada etapa custa duas leituras de
+``perf_counter`` e uma busca binária nos limites do histograma.
+
+Os valores ficam em dicionários simples (rótulos já formatados como
+texto), o que permite juntar as métricas dos processos de trabalho
+(shards.py) somando os dicionários de ``snapshot()``.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from urllib.parse import parse_qsl
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from profiling import SlowPackets
+
+DEFAULT_PORT = 29481
+
+# Limites dos histogramas de latência, em segundos (1 µs a 1 s)
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                   1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+# frame: por leitura do socket; as demais: por pacote
+STAGES = ('frame', 'validate', 'decrypt', 'decode', 'session', 'log', 'store', 'publish', 'forward')
+
+PROTOCOL_ID_SLICE = slice(25, 27)
+
+log = logging.getLogger(__name__)
+
+
+def merge_counts(total: dict, counts: dict):
+    """Soma contagens (números e dicionários aninhados) em ``total``."""
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            merge_counts(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value == value and abs(value) != float('inf') else str(value)
+    return str(value)
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'values')
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        # rótulos já formatados ('protocol_id="0x1001"') -> valor
+        self.values: Dict[str, float] = {}
+
+    def inc(self, amount=1, labels: str = ''):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def snapshot(self) -> dict:
+        return dict(self.values)
+
+
+class Gauge:
+    """Valor lido na hora da coleta, por uma função."""
+
+    __slots__ = ('name', 'help', 'read')
+
+    def __init__(self, name: str, help: str, read: Callable[[], Dict[str, float]]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def snapshot(self) -> dict:
+        try:
+            return dict(self.read())
+        except Exception:
+            log.exception('Falha ao ler a métrica %s', self.name)
+            return {}
+
+
+class HistogramSeries:
+    """Uma série (um conjunto de rótulos) de um histograma."""
+
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # Contagem por faixa, com +Inf no fim
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'series')
+
+    def __init__(self, name: str, help: str, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.series: Dict[str, HistogramSeries] = {}
+
+    def labels(self, labels: str = '') -> HistogramSeries:
+        """Série dos rótulos; guardada pelo chamador no caminho quente."""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = HistogramSeries(self.bounds)
+        return series
+
+    def observe(self, value: float, labels: str = ''):
+        self.labels(labels).observe(value)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for labels, series in self.series.items():
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(self.bounds, series.counts):
+                cumulative += count
+                buckets[repr(bound)] = cumulative
+            cumulative += series.counts[-1]
+            buckets['+Inf'] = cumulative
+            result[labels] = {'buckets': buckets, 'sum': series.total, 'count': cumulative}
+        return result
+
+
+def protocol_label(frame, _cache: Dict[bytes, str] = {}) -> str:
+    """Rótulo ``protocol_id="0x1001"`` do pacote (formatado uma vez por ID)."""
+    key = bytes(frame[PROTOCOL_ID_SLICE])
+    label = _cache.get(key)
+    if label is None:
+        label = _cache[key] = f'protocol_id="0x{key.hex()}"' if len(key) == 2 else 'protocol_id="?"'
+    return label
+
+
+class Metrics:
+    """Métricas do servidor; ``render()`` gera o texto do endpoint."""
+
+    def __init__(self, slow_packets: int = 20):
+        self.connections = Counter('obd_connections_total', 'Conexões aceitas, por transporte')
+        self.connections_refused = Counter('obd_connections_refused_total',
+                                           'Conexões recusadas ou encerradas por limite')
+        self.bytes = Counter('obd_received_bytes_total', 'Bytes recebidos, por transporte')
+        self.frames = Counter('obd_frames_total', 'Pacotes recebidos, por protocol_id')
+        self.rejected = Counter('obd_frames_rejected_total',
+                                'Pacotes rejeitados (crc, tamanho, cauda), por protocol_id e motivo')
+        self.duplicates = Counter('obd_frames_duplicate_total', 'Retransmissões descartadas, por protocol_id')
+        self.decode_errors = Counter('obd_decode_errors_total', 'Falhas de decodificação, por protocol_id')
+        self.stage_seconds = Histogram('obd_stage_seconds', 'Tempo de cada etapa do pipeline '
+                                       '(frame: por leitura do socket; demais: por pacote)')
+        self.loop_lag = Histogram('obd_event_loop_lag_seconds', 'Atraso do loop de eventos')
+        self.gauges: List[Gauge] = []
+        # Séries de cada etapa, resolvidas uma vez: stages['decode'].observe(s)
+        self.stages = {stage: self.stage_seconds.labels(f'stage="{stage}"') for stage in STAGES}
+        self.slow = SlowPackets(slow_packets)
+        # Funções que devolvem snapshots de outros processos (shards)
+        self.sources: List[Callable[[], dict]] = []
+
+    def finish(self, frame, timings, remote=None):
+        """Registra os tempos ``[(etapa, segundos), ...]`` de um pacote."""
+        stages = self.stages
+        total = 0.0
+        for stage, seconds in timings:
+            total += seconds
+            series = stages.get(stage)
+            if series is not None:
+                series.observe(seconds)
+        if total > self.slow.threshold:
+            self.slow.offer(total, frame, timings, remote)
+
+    def gauge(self, name: str, help: str, read: Callable[[], Dict[str, float]]):
+        self.gauges.append(Gauge(name, help, read))
+
+    def add_source(self, read: Callable[[], dict]):
+        """Soma ao endpoint as métricas de outro processo (um ``snapshot()``)."""
+        self.sources.append(read)
+
+    def _instruments(self):
+        return [self.connections, self.connections_refused, self.bytes, self.frames, self.rejected,
+                self.duplicates, self.decode_errors, self.stage_seconds, self.loop_lag] + self.gauges
+
+    def snapshot(self) -> dict:
+        """{nome: {rótulos: valor}}, só com números: pode ser somado com merge_counts."""
+        return {instrument.name: instrument.snapshot() for instrument in self._instruments()}
+
+    def render(self) -> str:
+        values = self.snapshot()
+        for read in self.sources:
+            merge_counts(values, read())
+        lines = []
+        for instrument in self._instruments():
+            if isinstance(instrument, Histogram):
+                kind = 'histogram'
+            elif isinstance(instrument, Gauge):
+                kind = 'gauge'
+            else:
+                kind = 'counter'
+            name = instrument.name
+            lines.append(f'# HELP {name} {instrument.help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(values.get(name, {}).items()):
+                if kind == 'histogram':
+                    prefix = labels + ',' if labels else ''
+                    for bound, count in value['buckets'].items():
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                    suffix = f'{{{labels}}}' if labels else ''
+                    lines.append(f'{name}_sum{suffix} {_format_value(value["sum"])}')
+                    lines.append(f'{name}_count{suffix} {value["count"]}')
+                else:
+                    suffix = f'{{{labels}}}' if labels else ''
+                    lines.append(f'{name}{suffix} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# --- Atraso do loop de eventos --------------------------------------------------
+
+async def watch_loop_lag(metrics: Metrics, interval: float = 0.5):
+    """Mede quanto o loop demora a voltar de um sleep (tarefas que travam o loop)."""
+    clock = time.perf_counter
+    while True:
+        start = clock()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe(max(0.0, clock() - start - interval))
+
+
+# --- Endpoint HTTP --------------------------------------------------------------
+
+# Rota extra do endpoint: recebe os parâmetros da query e devolve
+# (status, content-type, corpo)
+Route = Callable[[Dict[str, str]], Awaitable[Tuple[str, str, bytes]]]
+
+TEXT_FORMAT = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+async def serve(metrics: Optional[Metrics], host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                routes: Optional[Dict[str, Route]] = None):
+    """Servidor HTTP mínimo: ``GET /metrics`` devolve o texto do Prometheus.
+
+    ``routes`` acrescenta caminhos (por exemplo os de diagnóstico, em
+    profiling.py, e as consultas de posição, em spatial.py). Com
+    ``metrics`` None só as rotas extras são servidas.
+    """
+    routes = dict(routes or {})
+
+    async def render(query):
+        return '200 OK', TEXT_FORMAT, metrics.render().encode()
+
+    if metrics is not None:
+        routes.setdefault('/metrics', render)
+
+    async def respond(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Cabeçalhos do pedido não interessam; só precisam ser consumidos
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.decode('latin-1').split()
+            route = None
+            if len(parts) >= 2 and parts[0] == 'GET':
+                path, _, query = parts[1].partition('?')
+                route = routes.get(path)
+            if route is None:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+            else:
+                try:
+                    status, content_type, body = await route(dict(parse_qsl(query)))
+                except Exception:
+                    log.exception('Falha na rota %s', path)
+                    status, content_type, body = '500 Internal Server Error', 'text/plain', b'erro\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(respond, host, port)
@@ -0,0 +1,180 @@
+"""Diagnóstico do servidor em produção, sem anexar um profiler externo.
+
+- ``SamplingProfiler``: amostra as pilhas de todas as threads em
+  intervalos fixos, por um tempo limitado, e grava o perfil agregado no
+  formato "folded" (uma linha por pilha, ``thread;f1;f2;... contagem``),
+  que o flamegraph.pl e o speedscope leem direto.
+- ``SlowPackets``: guarda os K pacotes mais lentos, com bytes crus,
+  device_id, protocol_id e o tempo de cada etapa do pipeline.
+
+Os dois ficam no endpoint local das métricas (metrics.py):
+
+    curl 'http://127.0.0.1:29481/debug/profile?seconds=10' > perfil.folded
+    curl http://127.0.0.1:29481/debug/slow
+"""
+import asyncio
+import heapq
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+PROFILE_DIR = Path('logs') / 'profiles'
+MAX_PROFILE_SECONDS = 300
+
+DEVICE_ID_SLICE = slice(5, 25)
+PROTOCOL_ID_SLICE = slice(25, 27)
+
+log = logging.getLogger(__name__)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename.rsplit('/', 1)[-1]
+    return f'{code.co_name} ({filename}:{frame.f_lineno})'
+
+
+class SamplingProfiler:
+    """Amostrador de pilhas em uma thread própria; custo zero quando parado."""
+
+    def __init__(self, interval: float = 0.005, directory: Path = PROFILE_DIR):
+        self.interval = interval
+        self.directory = Path(directory)
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('profiler já está rodando')
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+            self.samples += 1
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+    def dump(self) -> Path:
+        """Grava o perfil agregado; devolve o caminho do arquivo."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        path.write_text(self.folded(), encoding='utf-8')
+        return path
+
+    def folded(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 20) -> List[Tuple[str, int]]:
+        """Funções com mais amostras no topo da pilha (tempo próprio)."""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            thread, _, rest = stack.partition(';')
+            leaves[f'{thread}: {rest.rsplit(";", 1)[-1]}'] += count
+        return leaves.most_common(limit)
+
+
+class SlowPackets:
+    """Os ``capacity`` pacotes mais lentos desde o início (min-heap pelo tempo).
+
+    ``offer`` compara com o menor tempo guardado antes de copiar qualquer
+    coisa, então o custo por pacote normal é uma comparação.
+    """
+
+    def __init__(self, capacity: int = 20):
+        self.capacity = capacity
+        self._heap: list = []
+        self._sequence = 0
+        # Tempo mínimo para entrar (o menor guardado, quando cheio)
+        self.threshold = 0.0
+
+    def offer(self, seconds: float, frame, stages: Sequence[Tuple[str, float]], remote=None):
+        if seconds <= self.threshold:
+            return
+        self._sequence += 1
+        entry = (seconds, self._sequence, {
+            'seconds': seconds,
+            'time': time.time(),
+            'remote': str(remote),
+            'device_id': bytes(frame[DEVICE_ID_SLICE]).decode('ascii', errors='ignore').strip('\x00'),
+            'protocol_id': f'0x{bytes(frame[PROTOCOL_ID_SLICE]).hex()}',
+            'length': len(frame),
+            'stages': dict(stages),
+            'raw': bytes(frame).hex(),
+        })
+        if len(self._heap) < self.capacity:
+            heapq.heappush(self._heap, entry)
+        else:
+            heapq.heapreplace(self._heap, entry)
+        if len(self._heap) >= self.capacity:
+            self.threshold = self._heap[0][0]
+
+    def entries(self) -> List[dict]:
+        """Do mais lento para o mais rápido."""
+        return [entry for _, _, entry in sorted(self._heap, reverse=True)]
+
+
+def debug_routes(slow: Callable[[], List[dict]],
+                 profiler: Optional[SamplingProfiler] = None) -> dict:
+    """Rotas ``/debug/profile`` e ``/debug/slow`` para metrics.serve.
+
+    ``slow`` devolve os pacotes mais lentos (já juntando os shards, se houver).
+    """
+    profiler = profiler or SamplingProfiler()
+
+    async def profile(query):
+        try:
+            seconds = min(max(float(query.get('seconds', 10)), 0.1), MAX_PROFILE_SECONDS)
+        except ValueError:
+            return '400 Bad Request', 'text/plain', b'seconds invalido\n'
+        if profiler.running:
+            return '409 Conflict', 'text/plain', b'profiler ja esta rodando\n'
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        path = profiler.dump()
+        log.info('Perfil de %.1f s (%d amostras) gravado em %s; topo: %s',
+                 seconds, profiler.samples, path, profiler.top(5))
+        if query.get('format') == 'top':
+            body = ''.join(f'{count:8d}  {name}\n' for name, count in profiler.top(40))
+        else:
+            body = profiler.folded()
+        return '200 OK', 'text/plain; charset=utf-8', body.encode()
+
+    async def slow_packets(query):
+        return '200 OK', 'application/json', json.dumps(slow(), ensure_ascii=False, indent=1).encode()
+
+    return {'/debug/profile': profile, '/debug/slow': slow_packets}
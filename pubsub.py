@@ -0,0 +1,242 @@
+"""Distribuição dos registros decodificados para painéis (WebSocket).
+
+Painéis conectam no mesmo servidor WebSocket dos equipamentos, no
+caminho ``/subscribe``, com filtros opcionais na query:
+
+    ws://host:29479/subscribe?device=218LSAB2025000002,213GDP2018021343
+    ws://host:29479/subscribe?protocol=0x4007&alert=FRENAGEM_BRUSCA
+
+e recebem mensagens de texto com um array JSON de registros (o mesmo
+``to_json()`` do log e do webhook).
+
+Custo por pacote: sem assinantes, uma verificação de tamanho. Com
+assinantes, só os interessados no device_id são consultados; os sem
+filtro de dispositivo ficam indexados por protocol_id e máscara de
+alertas, e só os grupos que aceitam o pacote são visitados. O registro
+é serializado uma vez e os mesmos bytes vão para todos. Cada assinante tem uma fila própria que
+guarda só o último registro de cada (device_id, protocol_id): um painel
+lento recebe menos atualizações, nunca uma fila que cresce, e o envio
+para ele (uma tarefa por assinante) não segura a ingestão.
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from websockets.exceptions import ConnectionClosed
+
+from alerts import ALERT_TYPES
+
+SUBSCRIBE_PATH = '/subscribe'
+
+_ALERT_BITS = {name: bit for bit, name in ALERT_TYPES}
+
+log = logging.getLogger(__name__)
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _split(values: Iterable[str]) -> Set[str]:
+    return {item.strip() for value in values for item in value.split(',') if item.strip()}
+
+
+def parse_filters(query: str) -> Tuple[Optional[FrozenSet[str]], Optional[FrozenSet[int]], int]:
+    """``device=..&protocol=..&alert=..`` -> (devices, protocol_ids, máscara de alertas)."""
+    params = parse_qs(query)
+    devices = _split(params.get('device', ())) or None
+    protocols = None
+    if 'protocol' in params:
+        try:
+            protocols = {int(item, 16) for item in _split(params['protocol'])}
+        except ValueError:
+            raise FilterError('protocol deve ser hexadecimal (ex.: 0x4007)') from None
+    alert_mask = 0
+    for name in _split(params.get('alert', ())):
+        bit = _ALERT_BITS.get(name.upper())
+        if bit is None:
+            raise FilterError(f'alerta desconhecido: {name}')
+        alert_mask |= bit
+    return (frozenset(devices) if devices else None,
+            frozenset(protocols) if protocols else None,
+            alert_mask)
+
+
+class Subscriber:
+    """Um painel: filtros e a fila com o último registro por (device_id, protocol_id)."""
+
+    __slots__ = ('remote', 'devices', 'protocols', 'alert_mask', 'max_pending',
+                 'pending', 'ready', 'sent', 'coalesced', 'dropped')
+
+    def __init__(self, remote, devices: Optional[FrozenSet[str]] = None,
+                 protocols: Optional[FrozenSet[int]] = None, alert_mask: int = 0,
+                 max_pending: int = 10000):
+        self.remote = remote
+        self.devices = devices
+        self.protocols = protocols
+        self.alert_mask = alert_mask
+        self.max_pending = max_pending
+        self.pending: Dict[Tuple[str, int], bytes] = {}
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def accepts(self, protocol_id: int, alert_flags: int) -> bool:
+        if self.protocols is not None and protocol_id not in self.protocols:
+            return False
+        return not self.alert_mask or bool(alert_flags & self.alert_mask)
+
+    def push(self, key: Tuple[str, int], payload: bytes):
+        pending = self.pending
+        if key in pending:
+            self.coalesced += 1
+        elif len(pending) >= self.max_pending:
+            # Fila cheia de dispositivos distintos: sai o mais antigo
+            del pending[next(iter(pending))]
+            self.dropped += 1
+        pending[key] = payload
+        self.ready.set()
+
+    async def run(self, websocket):
+        """Envia o que estiver pendente, em um array JSON por mensagem."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            batch, self.pending = self.pending, {}
+            await websocket.send(b'[' + b','.join(batch.values()) + b']', text=True)
+            self.sent += len(batch)
+
+
+class Hub:
+    def __init__(self, max_subscribers: int = 1000, max_pending: int = 10000):
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.subscribers: Set[Subscriber] = set()
+        # device_id -> assinantes com esse dispositivo no filtro
+        self._by_device: Dict[str, Set[Subscriber]] = {}
+        # Assinantes sem filtro de dispositivo: protocol_id (None: todos) ->
+        # máscara de alertas (0: todos) -> assinantes
+        self._fleet: Dict[Optional[int], Dict[int, Set[Subscriber]]] = {}
+        # Avisado quando o número de assinantes muda (shards.py)
+        self.on_change: Optional[Callable[[int], None]] = None
+        self.published = 0
+
+    def subscribe(self, remote, query: str = '') -> Subscriber:
+        if len(self.subscribers) >= self.max_subscribers:
+            raise FilterError('limite de assinantes')
+        devices, protocols, alert_mask = parse_filters(query)
+        subscriber = Subscriber(remote, devices, protocols, alert_mask, self.max_pending)
+        self.subscribers.add(subscriber)
+        if devices is None:
+            for protocol_id in protocols or (None,):
+                masks = self._fleet.setdefault(protocol_id, {})
+                masks.setdefault(alert_mask, set()).add(subscriber)
+        else:
+            for device_id in devices:
+                self._by_device.setdefault(device_id, set()).add(subscriber)
+        self._changed()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        if subscriber.devices is None:
+            for protocol_id in subscriber.protocols or (None,):
+                masks = self._fleet.get(protocol_id)
+                group = masks.get(subscriber.alert_mask) if masks else None
+                if group is not None:
+                    group.discard(subscriber)
+                    if not group:
+                        del masks[subscriber.alert_mask]
+                        if not masks:
+                            del self._fleet[protocol_id]
+        for device_id in subscriber.devices or ():
+            interested = self._by_device.get(device_id)
+            if interested is not None:
+                interested.discard(subscriber)
+                if not interested:
+                    del self._by_device[device_id]
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(len(self.subscribers))
+
+    def publish(self, record):
+        """Entrega um registro decodificado aos assinantes interessados."""
+        alert_flags = getattr(record, 'alert_flags', 0)
+        self.publish_payload(record.device_id, record.protocol_id, alert_flags, record.to_json)
+
+    def publish_payload(self, device_id: str, protocol_id: int, alert_flags: int, payload):
+        """Como ``publish``; ``payload`` são os bytes JSON ou uma função que os gera."""
+        # Um assinante com filtro de dispositivo está só em _by_device; um
+        # sem filtro, em um grupo de _fleet por protocol_id do filtro
+        receivers = []
+        interested = self._by_device.get(device_id)
+        if interested:
+            receivers.extend(subscriber for subscriber in interested
+                             if subscriber.accepts(protocol_id, alert_flags))
+        fleet = self._fleet
+        if fleet:
+            for protocol_key in (None, protocol_id):
+                masks = fleet.get(protocol_key)
+                if not masks:
+                    continue
+                for alert_mask, group in masks.items():
+                    if not alert_mask or alert_flags & alert_mask:
+                        receivers.extend(group)
+        if not receivers:
+            return
+        # Serializado uma vez, só se alguém vai receber
+        key = (device_id, protocol_id)
+        if callable(payload):
+            payload = payload()
+        self.published += 1
+        for subscriber in receivers:
+            subscriber.push(key, payload)
+
+    def stats(self) -> dict:
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'sent': sum(subscriber.sent for subscriber in self.subscribers),
+            'coalesced': sum(subscriber.coalesced for subscriber in self.subscribers),
+            'dropped': sum(subscriber.dropped for subscriber in self.subscribers),
+        }
+
+
+async def serve_subscriber(hub: Hub, websocket, query: str):
+    """Atende um painel até ele desconectar."""
+    remote = websocket.remote_address
+    try:
+        subscriber = hub.subscribe(remote, query)
+    except FilterError as exc:
+        await websocket.close(1008, str(exc))
+        return
+    log.info('Novo assinante: %s (%s)', remote, query or 'sem filtro')
+    sender = asyncio.create_task(subscriber.run(websocket))
+
+    def sender_done(task):
+        # Envio interrompido por erro: o painel sai do índice na hora, em
+        # vez de continuar recebendo registros que ninguém envia
+        if task.cancelled():
+            return
+        exc = task.exception()
+        hub.unsubscribe(subscriber)
+        if not isinstance(exc, ConnectionClosed):
+            log.error('Falha no envio para o assinante %s', remote, exc_info=exc)
+            asyncio.ensure_future(websocket.close(1011, 'falha no envio'))
+
+    sender.add_done_callback(sender_done)
+    try:
+        # Painéis não mandam nada; a leitura só detecta o fechamento
+        async for _ in websocket:
+            pass
+    finally:
+        hub.unsubscribe(subscriber)
+        sender.cancel()
+        log.info('Assinante encerrado: %s (%d enviados, %d substituídos, %d descartados)',
+                 remote, subscriber.sent, subscriber.coalesced, subscriber.dropped)
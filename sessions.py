@@ -0,0 +1,363 @@
+"""Sessões por dispositivo: estado lembrado entre pacotes e conexões.
+
+Cada device_id (internado pelo SinocastelRecord) tem uma DeviceSession
+com a base do odômetro, as versões do último login, o último vstate e a
+última posição GPS. As sessões ficam em um LRU em memória, carregado com
+as mais recentes no start(); o SQLite só é consultado quando aparece um
+dispositivo que não está nele, por uma conexão só de leitura que não
+espera a gravação em andamento (WAL). As alterações são gravadas em lote
+por uma thread de fundo (write-behind), nunca no caminho do pacote: o
+loop de eventos tira uma cópia (tupla) da sessão a cada pacote e a
+thread grava só essas cópias.
+
+    registry = SessionRegistry()
+    registry.start()
+    session = registry.observe(record)   # ajusta record.base_odometer_km
+    ...
+    registry.stop()
+
+A base do odômetro de um veículo é configurada uma vez:
+
+    python sessions.py set-odometer 218LSAB2025000002 105826.41
+
+O servidor nunca grava a base por cima: o lote só atualiza as colunas
+observadas nos pacotes. A cada lote a thread de fundo procura bases
+alteradas (``odometer_updated``) e as aplica às sessões em memória, então
+o comando vale também com o servidor rodando.
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from sinocastel import LoginRecord, SinocastelRecord, StatRecord
+
+SESSIONS_DB = Path('logs') / 'sessions.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    device_id TEXT PRIMARY KEY,
+    odometer_base_km REAL NOT NULL DEFAULT 0,
+    software_version TEXT,
+    hardware_version TEXT,
+    last_login INTEGER,
+    vstate INTEGER,
+    last_gps TEXT,
+    last_seen REAL,
+    odometer_updated REAL
+)
+"""
+INDEX = 'CREATE INDEX IF NOT EXISTS sessions_odometer_updated ON sessions (odometer_updated)'
+COLUMNS = ('device_id', 'odometer_base_km', 'software_version', 'hardware_version',
+           'last_login', 'vstate', 'last_gps', 'last_seen')
+# Colunas que o servidor observa nos pacotes; a base do odômetro só é
+# gravada na criação da linha (e por set_odometer_base)
+OBSERVED = COLUMNS[2:]
+UPSERT = (f"INSERT INTO sessions ({', '.join(COLUMNS)}) "
+          f"VALUES ({', '.join('?' * len(COLUMNS))}) "
+          f"ON CONFLICT(device_id) DO UPDATE SET "
+          + ', '.join(f'{column} = excluded.{column}' for column in OBSERVED))
+SET_ODOMETER = ("INSERT INTO sessions (device_id, odometer_base_km, odometer_updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(device_id) DO UPDATE SET odometer_base_km = excluded.odometer_base_km, "
+                "odometer_updated = excluded.odometer_updated")
+CHANGED_ODOMETERS = ("SELECT device_id, odometer_base_km, odometer_updated FROM sessions "
+                     "WHERE odometer_updated > ?")
+SELECT = f"SELECT {', '.join(COLUMNS)} FROM sessions WHERE device_id = ?"
+RECENT = f"SELECT {', '.join(COLUMNS)} FROM sessions ORDER BY last_seen DESC"
+
+log = logging.getLogger(__name__)
+
+
+def session_row(snapshot: tuple) -> tuple:
+    """Linha do banco a partir de DeviceSession.snapshot() (roda na thread de fundo)."""
+    last_gps = snapshot[6]
+    return snapshot[:6] + (json.dumps(last_gps) if last_gps else None, snapshot[7])
+
+
+class DeviceSession:
+    __slots__ = ('device_id', 'odometer_base_km', 'software_version', 'hardware_version',
+                 'last_login', 'vstate', 'last_gps', 'last_seen', 'packets')
+
+    def __init__(self, device_id: str, odometer_base_km: float = 0.0):
+        # Internado, como no registro: a conexão compara por identidade
+        self.device_id = sys.intern(device_id)
+        self.odometer_base_km = odometer_base_km
+        self.software_version = None
+        self.hardware_version = None
+        self.last_login = None
+        self.vstate = None
+        self.last_gps = None
+        self.last_seen = None
+        # Só em memória: pacotes vistos desde que a sessão foi carregada
+        self.packets = 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot: tuple) -> 'DeviceSession':
+        session = cls(snapshot[0], snapshot[1])
+        (session.software_version, session.hardware_version, session.last_login,
+         session.vstate, session.last_gps, session.last_seen) = snapshot[2:]
+        return session
+
+    @classmethod
+    def from_row(cls, row) -> 'DeviceSession':
+        last_gps = row[6]
+        return cls.from_snapshot(row[:6] + (json.loads(last_gps) if last_gps else None, row[7]))
+
+    def snapshot(self) -> tuple:
+        """Valores das colunas, na ordem de COLUMNS, com last_gps ainda como dict.
+
+        Tirado no loop de eventos: a thread de fundo nunca lê a sessão viva,
+        que pode estar no meio de uma atualização.
+        """
+        return (self.device_id, self.odometer_base_km, self.software_version,
+                self.hardware_version, self.last_login, self.vstate, self.last_gps, self.last_seen)
+
+    def to_row(self) -> tuple:
+        return session_row(self.snapshot())
+
+    def to_dict(self) -> dict:
+        return dict(zip(COLUMNS, self.snapshot()))
+
+
+class SessionRegistry:
+    """LRU de sessões em memória com persistência write-behind em SQLite.
+
+    Pensado para o loop de eventos: ``get`` e ``observe`` não tocam no
+    banco depois do primeiro pacote de cada dispositivo. Sessões
+    expulsas do LRU com alterações pendentes continuam na fila de
+    gravação (como cópia) até o próximo lote.
+    """
+
+    def __init__(self, path: Path = SESSIONS_DB, capacity: int = 10000,
+                 flush_interval: float = 1.0, default_odometer_km: float = 0.0,
+                 owns: Optional[Callable[[str], bool]] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.default_odometer_km = default_odometer_km
+        # Com shards, só as sessões dos dispositivos deste processo são carregadas
+        self.owns = owns
+        self.sessions: 'OrderedDict[str, DeviceSession]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        # _dirty_lock só protege a troca do dict de pendentes (curta);
+        # _db_lock serializa o acesso à conexão de gravação. As pendentes
+        # são cópias (DeviceSession.snapshot), não as sessões vivas
+        self._dirty: Dict[str, tuple] = {}
+        self._inflight: Dict[str, tuple] = {}
+        self._dirty_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(sessions)')}
+        if 'odometer_updated' not in columns:
+            # Banco criado antes da coluna existir
+            self._db.execute('ALTER TABLE sessions ADD COLUMN odometer_updated REAL')
+        self._db.execute(INDEX)
+        self._db.commit()
+        # Bases alteradas depois disso são aplicadas às sessões em memória;
+        # as anteriores já vêm do banco quando a sessão é carregada
+        self._odometer_mark = self._db.execute(
+            'SELECT COALESCE(MAX(odometer_updated), 0) FROM sessions').fetchone()[0]
+        # Leituras do loop de eventos (dispositivo fora do LRU): conexão
+        # própria, sem _db_lock, que no WAL não espera um lote em gravação
+        self._reader = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='session-writer', daemon=True)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, device_id: str) -> DeviceSession:
+        session = self.sessions.get(device_id)
+        if session is not None:
+            self.hits += 1
+            self.sessions.move_to_end(device_id)
+            return session
+        self.misses += 1
+        return self._load(device_id)
+
+    def _load(self, device_id: str) -> DeviceSession:
+        # Expulsa do LRU mas ainda não gravada: a cópia pendente é a atual
+        snapshot = self._dirty.get(device_id) or self._inflight.get(device_id)
+        if snapshot is not None:
+            session = DeviceSession.from_snapshot(snapshot)
+        else:
+            row = self._reader.execute(SELECT, (device_id,)).fetchone()
+            if row is not None:
+                session = DeviceSession.from_row(row)
+            else:
+                session = DeviceSession(device_id, self.default_odometer_km)
+                self.mark_dirty(session)
+        self.sessions[device_id] = session
+        if len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+        return session
+
+    def mark_dirty(self, session: DeviceSession):
+        snapshot = session.snapshot()
+        with self._dirty_lock:
+            self._dirty[session.device_id] = snapshot
+
+    def observe(self, record: SinocastelRecord,
+                session: Optional[DeviceSession] = None) -> DeviceSession:
+        """Atualiza a sessão do dispositivo com um pacote decodificado.
+
+        Também ajusta ``record.base_odometer_km`` para a base da sessão.
+        A conexão pode passar a sessão que já tem em mãos para pular até
+        a busca no LRU.
+        """
+        device_id = record.device_id
+        if session is None or session.device_id is not device_id:
+            session = self.get(device_id)
+        record.base_odometer_km = session.odometer_base_km
+        session.packets += 1
+        session.last_seen = time.time()
+        if isinstance(record, StatRecord):
+            session.vstate = record.vstate
+            gps = record.latest_gps
+            if gps is not None:
+                session.last_gps = gps
+            if isinstance(record, LoginRecord):
+                session.software_version = record.software_version
+                session.hardware_version = record.hardware_version
+                session.last_login = record.utc_timestamp
+        self.mark_dirty(session)
+        return session
+
+    def set_odometer_base(self, device_id: str, odometer_base_km: float):
+        """Grava a base do odômetro direto no banco (a do lote nunca a substitui)."""
+        with self._db_lock, self._db:
+            self._db.execute(SET_ODOMETER, (device_id, odometer_base_km, time.time()))
+        self._apply_odometer(device_id, odometer_base_km)
+
+    def _apply_odometer(self, device_id: str, odometer_base_km: float):
+        # Uma atribuição de atributo: segura mesmo vinda da thread de fundo
+        session = self.sessions.get(device_id)
+        if session is not None:
+            session.odometer_base_km = odometer_base_km
+        # As cópias pendentes também, para uma sessão recarregada delas
+        with self._dirty_lock:
+            for pending in (self._dirty, self._inflight):
+                snapshot = pending.get(device_id)
+                if snapshot is not None:
+                    pending[device_id] = snapshot[:1] + (odometer_base_km,) + snapshot[2:]
+
+    def reload_odometers(self) -> int:
+        """Aplica às sessões em memória as bases alteradas por set-odometer."""
+        with self._db_lock:
+            rows = self._db.execute(CHANGED_ODOMETERS, (self._odometer_mark,)).fetchall()
+        for device_id, odometer_base_km, updated in rows:
+            self._apply_odometer(device_id, odometer_base_km)
+            self._odometer_mark = max(self._odometer_mark, updated)
+        return len(rows)
+
+    def stored(self, device_id: Optional[str] = None):
+        """Sessões gravadas no banco (todas ou só a de ``device_id``)."""
+        query = f"SELECT {', '.join(COLUMNS)} FROM sessions"
+        params = ()
+        if device_id:
+            query += ' WHERE device_id = ?'
+            params = (device_id,)
+        with self._db_lock:
+            rows = self._db.execute(query + ' ORDER BY device_id', params).fetchall()
+        return [DeviceSession.from_row(row) for row in rows]
+
+    def preload(self) -> int:
+        """Carrega no LRU as sessões vistas mais recentemente (até ``capacity``).
+
+        Depois de reiniciar o servidor, os equipamentos reconectam todos de
+        uma vez; com as sessões já em memória, nenhum deles vai ao banco.
+        """
+        owns = self.owns
+        rows = []
+        for row in self._reader.execute(RECENT):
+            if owns is None or owns(row[0]):
+                rows.append(row)
+                if len(rows) >= self.capacity:
+                    break
+        # Do mais antigo para o mais recente: o fim do LRU é o mais usado
+        for row in reversed(rows):
+            session = DeviceSession.from_row(row)
+            self.sessions[session.device_id] = session
+        return len(rows)
+
+    def start(self):
+        self.preload()
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.reload_odometers()
+            except sqlite3.Error:
+                log.exception('Falha ao gravar sessões')
+
+    def flush(self) -> int:
+        """Grava em uma transação todas as sessões alteradas."""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            # Na mesma trava: _load nunca vê a sessão fora dos dois dicts
+            self._inflight = dirty
+        rows = [session_row(snapshot) for snapshot in dirty.values()]
+        try:
+            with self._db_lock, self._db:
+                self._db.executemany(UPSERT, rows)
+        except sqlite3.Error:
+            # Devolve as pendentes para a próxima tentativa
+            with self._dirty_lock:
+                for device_id, snapshot in dirty.items():
+                    self._dirty.setdefault(device_id, snapshot)
+            raise
+        finally:
+            self._inflight = {}
+        self.writes += len(rows)
+        return len(rows)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        self._reader.close()
+        self._db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sessões dos dispositivos')
+    parser.add_argument('--db', type=Path, default=SESSIONS_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+    odometer = commands.add_parser('set-odometer', help='define a base do odômetro (km)')
+    odometer.add_argument('device_id')
+    odometer.add_argument('km', type=float)
+    show = commands.add_parser('show', help='mostra as sessões gravadas')
+    show.add_argument('device_id', nargs='?')
+    args = parser.parse_args(argv)
+
+    registry = SessionRegistry(args.db)
+    try:
+        if args.command == 'set-odometer':
+            registry.set_odometer_base(args.device_id, args.km)
+        else:
+            for session in registry.stored(args.device_id):
+                print(json.dumps(session.to_dict()))
+    finally:
+        registry.stop()
+
+
+if __name__ == '__main__':
+    main()
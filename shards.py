@@ -0,0 +1,458 @@
+"""Decodificação em vários processos, particionada por device_id.
+
+O processo principal (acceptor) continua com as conexões, o framing, a
+captura e a junção de alertas, que são baratos; a conferência de crc,
+as retransmissões, a decifragem, o decode e as saídas (logs, sessões,
+webhook) vão para processos de trabalho. O shard de cada pacote é
+``crc32(device_id) % workers``: todos os pacotes de um dispositivo vão
+para o mesmo processo, na ordem em que chegaram, e o estado do
+dispositivo (sessão, janela de retransmissões, contexto AES) fica só
+nele.
+
+    WORKERS=4 python ws_server.py
+
+Os pacotes de uma volta do loop de eventos são juntados em um lote por
+shard (``<HB`` tamanho e repetições, seguido do pacote) e enviados por
+um pipe, por uma thread por shard, com fila limitada: se um processo
+não dá conta, lotes são descartados e contados em ``dropped``, em vez
+de travar o loop. Um supervisor reinicia processos que caírem e junta
+as contagens que cada um envia periodicamente.
+
+Cada processo grava os próprios logs em ``logs/shard-<n>/``. Os
+registros para os painéis (pubsub.py) e as posições para o índice
+espacial (spatial.py) voltam ao acceptor por uma fila, em um lote por
+lote recebido.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+import threading
+import time
+import zlib
+from typing import List, Optional
+
+from log_pipeline import LOG_DIR
+from metrics import merge_counts
+from spatial import position_of
+
+DEVICE_ID_SLICE = slice(5, 25)
+# Cabeçalho de cada pacote no lote: tamanho e número de cópias (alertas)
+ENTRY = struct.Struct('<HB')
+
+log = logging.getLogger(__name__)
+
+
+def shard_of(frame, workers: int) -> int:
+    """Shard do pacote; estável entre execuções (não usa ``hash()``)."""
+    return zlib.crc32(frame[DEVICE_ID_SLICE]) % workers
+
+
+def shard_of_device(device_id: str, workers: int) -> int:
+    """Como ``shard_of``, a partir do device_id decodificado."""
+    return zlib.crc32(device_id.encode('ascii').ljust(20, b'\x00')) % workers
+
+
+# --- Processo de trabalho ------------------------------------------------------
+
+def _report(frames: int, connection) -> dict:
+    import ws_server
+
+    report = {
+        'frames': frames,
+        'rejected': connection.rejected,
+        'duplicates': connection.duplicates,
+        'rejected_by_reason': dict(ws_server.validator.rejected),
+        'decoders': ws_server.decoders.stats(),
+        'dedupe': ws_server.dedupe.stats(),
+    }
+    if ws_server.decryptor is not None:
+        report['decryption'] = dict(ws_server.decryptor.counts)
+    if ws_server.forwarder is not None:
+        report['webhook'] = ws_server.forwarder.stats()
+    if ws_server.store is not None:
+        report['store'] = ws_server.store.stats()
+    if ws_server.trips is not None:
+        report['trips'] = ws_server.trips.stats()
+    if ws_server.metrics is not None:
+        report['metrics'] = ws_server.metrics.snapshot()
+        report['slow'] = ws_server.metrics.slow.entries()
+    return report
+
+
+class ShardPublisher:
+    """Lado do processo de trabalho do pubsub.Hub.
+
+    Os painéis ficam no acceptor; o processo só sabe quantos há (valor
+    compartilhado). Havendo algum, cada registro vai serializado, com
+    device_id, protocol_id e alertas para o filtro, em um lote por
+    leitura do pipe.
+    """
+
+    kind = 'publish'
+
+    def __init__(self, subscribers, outbox):
+        self._subscribers = subscribers
+        self._outbox = outbox
+        self._items = []
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers.value
+
+    def publish(self, record):
+        self._items.append((record.device_id, record.protocol_id,
+                            getattr(record, 'alert_flags', 0), record.to_json()))
+
+    def flush(self):
+        if self._items:
+            self._outbox.put((self.kind, self._items))
+            self._items = []
+
+
+class ShardFleet(ShardPublisher):
+    """Lado do processo de trabalho do spatial.FleetIndex: só as posições novas."""
+
+    kind = 'positions'
+
+    def __init__(self, outbox):
+        super().__init__(None, outbox)
+
+    def observe(self, record):
+        position = position_of(record)
+        if position is not None:
+            self._items.append((record.device_id,) + position)
+
+
+def run_worker(index: int, inbox, results, subscribers, outbox, console: bool = False,
+               report_interval: float = 5.0, workers: int = 1):
+    """Laço de um processo de trabalho: lê lotes do pipe até receber um vazio."""
+    # O Ctrl+C (e o SIGTERM do systemd) chega a todo o grupo de processos;
+    # quem encerra os shards é o acceptor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import ws_server
+    from decryption import Decryptor
+    from forwarder import SPILL_DIR, WebhookForwarder
+    from log_pipeline import setup_logging
+    from sessions import SessionRegistry
+    from store import TelemetryStore
+    from trips import TripAggregator
+
+    log_dir = LOG_DIR / f'shard-{index}'
+    log_dir.mkdir(parents=True, exist_ok=True)
+    log_pipeline = setup_logging(console=console, log_dir=log_dir)
+
+    # Sessões e viagens de todos os processos ficam nos mesmos bancos; cada
+    # processo só carrega os dispositivos que são dele
+    def owns(device_id):
+        return shard_of_device(device_id, workers) == index
+
+    ws_server.sessions = SessionRegistry(owns=owns)
+    ws_server.sessions.start()
+    ws_server.decryptor = Decryptor()
+    if os.environ.get('STORE', '1') != '0':
+        ws_server.store = TelemetryStore()
+        ws_server.store.start()
+    if os.environ.get('TRIPS', '1') != '0':
+        # Todos os processos gravam em logs/trips.db; cada dispositivo só em um
+        ws_server.trips = TripAggregator(owns=owns)
+        ws_server.trips.start()
+    if os.environ.get('WEBHOOK_URL'):
+        # Spill próprio: cada processo só reenvia (e renomeia) os seus arquivos
+        ws_server.forwarder = WebhookForwarder(os.environ['WEBHOOK_URL'],
+                                               spill_dir=SPILL_DIR / f'shard-{index}')
+        ws_server.forwarder.start()
+    ws_server.hub = publisher = ShardPublisher(subscribers, outbox)
+    ws_server.fleet = positions = ShardFleet(outbox)
+    if os.environ.get('METRICS', '1') != '0':
+        ws_server.metrics = ws_server.install_metrics(log_pipeline)
+    # Só o pipeline de process(); framing e alertas já foram feitos no acceptor
+    connection = ws_server.DeviceConnection(f'shard-{index}')
+    process = connection.process
+    frames = 0
+    unpack = ENTRY.unpack_from
+    entry_size = ENTRY.size
+
+    next_report = time.monotonic() + report_interval
+    try:
+        while True:
+            if inbox.poll(report_interval):
+                try:
+                    batch = inbox.recv_bytes()
+                except EOFError:
+                    break  # acceptor caiu
+                if not batch:
+                    break
+                view = memoryview(batch)
+                end = len(batch)
+                pos = 0
+                while pos < end:
+                    size, repetitions = unpack(batch, pos)
+                    pos += entry_size
+                    frames += 1
+                    process(view[pos:pos + size], repetitions)
+                    pos += size
+                publisher.flush()
+                positions.flush()
+            now = time.monotonic()
+            if now >= next_report:
+                results.put((index, os.getpid(), _report(frames, connection)))
+                next_report = now + report_interval
+    finally:
+        if ws_server.forwarder is not None:
+            ws_server.forwarder.stop()
+        if ws_server.store is not None:
+            ws_server.store.stop()
+        if ws_server.trips is not None:
+            ws_server.trips.stop()
+        ws_server.sessions.stop()
+        ws_server.decryptor.keys.close()
+        results.put((index, os.getpid(), _report(frames, connection)))
+        log_pipeline.stop()
+
+
+# --- Supervisor (processo principal) --------------------------------------------
+
+class Shard:
+    __slots__ = ('index', 'process', 'inbox', 'queue', 'pending', 'pending_frames',
+                 'sender', 'dispatched', 'dropped', 'report')
+
+    def __init__(self, index: int, max_queue: int):
+        self.index = index
+        self.process = None
+        self.inbox = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        # Lote em montagem, enviado ao fim da volta do loop de eventos
+        self.pending = bytearray()
+        self.pending_frames = 0
+        self.sender = None
+        self.dispatched = 0
+        self.dropped = 0
+        # Última contagem recebida do processo atual
+        self.report = {}
+
+
+class ShardPool:
+    def __init__(self, workers: Optional[int] = None, max_queue: int = 1000,
+                 batch_bytes: int = 64 * 1024, console: bool = False,
+                 report_interval: float = 5.0, restart_delay: float = 1.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_bytes = batch_bytes
+        self.console = console
+        self.report_interval = report_interval
+        self.restart_delay = restart_delay
+        # spawn: o acceptor já tem threads rodando (logs, sessões) quando
+        # um processo é reiniciado, e fork com threads é arriscado
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        # Painéis (pubsub): quantos há, visto pelos processos. Os registros
+        # para o Hub e as posições para o FleetIndex do acceptor voltam
+        # pela mesma fila
+        self._subscribers = self._context.Value('i', 0, lock=False)
+        self._outbox = self._context.Queue()
+        self._hub = None
+        self._fleet = None
+        self._relay = None
+        self.shards: List[Shard] = [Shard(index, max_queue) for index in range(self.workers)]
+        self._lock = threading.Lock()
+        self._loop = None
+        self._flush_scheduled = False
+        self._stopping = False
+        self._supervisor = threading.Thread(target=self._supervise, name='shard-supervisor',
+                                            daemon=True)
+        self.restarts = 0
+        # Contagens dos processos que já saíram (reiniciados)
+        self._retired: dict = {}
+
+    def _spawn(self, shard: Shard):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=run_worker, name=f'shard-{shard.index}',
+            args=(shard.index, receiver, self._results, self._subscribers, self._outbox,
+                  self.console, self.report_interval, len(self.shards)),
+            daemon=True)
+        process.start()
+        receiver.close()
+        with self._lock:
+            shard.process, shard.inbox = process, sender
+
+    def start(self, loop=None):
+        import asyncio
+
+        self._loop = loop or asyncio.get_running_loop()
+        for shard in self.shards:
+            self._spawn(shard)
+            shard.sender = threading.Thread(target=self._send, args=(shard,),
+                                            name=f'shard-sender-{shard.index}', daemon=True)
+            shard.sender.start()
+        self._supervisor.start()
+
+    def attach_hub(self, hub):
+        """Entrega ao ``hub`` (pubsub.Hub) os registros decodificados nos processos."""
+        self._hub = hub
+        hub.on_change = self._subscribers_changed
+        self._start_relay()
+
+    def attach_fleet(self, fleet):
+        """Entrega ao ``fleet`` (spatial.FleetIndex) as posições lidas nos processos."""
+        self._fleet = fleet
+        self._start_relay()
+
+    def _subscribers_changed(self, count: int):
+        self._subscribers.value = count
+
+    def _start_relay(self):
+        if self._relay is None:
+            self._relay = threading.Thread(target=self._run_relay, name='shard-relay', daemon=True)
+            self._relay.start()
+
+    def _run_relay(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._deliver, *message)
+
+    def _deliver(self, kind: str, items):
+        if kind == 'positions':
+            if self._fleet is not None:
+                self._fleet.update_many(items)
+        elif self._hub is not None:
+            publish = self._hub.publish_payload
+            for device_id, protocol_id, alert_flags, payload in items:
+                publish(device_id, protocol_id, alert_flags, payload)
+
+    # --- Envio ---------------------------------------------------------
+
+    def submit(self, frame: memoryview, repetitions: int = 1):
+        """Coloca o pacote no lote do seu shard (chamado no loop de eventos)."""
+        shard = self.shards[shard_of(frame, self.workers)]
+        shard.pending += ENTRY.pack(len(frame), repetitions)
+        shard.pending += frame
+        shard.pending_frames += 1
+        if len(shard.pending) >= self.batch_bytes:
+            self._enqueue(shard)
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self.flush)
+
+    def flush(self):
+        self._flush_scheduled = False
+        for shard in self.shards:
+            if shard.pending:
+                self._enqueue(shard)
+
+    def _enqueue(self, shard: Shard):
+        batch, frames = bytes(shard.pending), shard.pending_frames
+        shard.pending.clear()
+        shard.pending_frames = 0
+        try:
+            shard.queue.put_nowait((batch, frames))
+            shard.dispatched += frames
+        except queue.Full:
+            shard.dropped += frames
+            if shard.dropped == frames:
+                log.warning('Shard %d não dá conta: descartando pacotes', shard.index)
+
+    def _send(self, shard: Shard):
+        while True:
+            batch, frames = shard.queue.get()
+            if batch is None:
+                return
+            while True:
+                with self._lock:
+                    inbox = shard.inbox
+                try:
+                    inbox.send_bytes(batch)
+                    break
+                except (OSError, ValueError):
+                    # Processo caiu: o lote vai para o processo que o supervisor
+                    # colocar no lugar
+                    if self._stopping:
+                        return
+                    time.sleep(0.1)
+
+    # --- Supervisão ----------------------------------------------------
+
+    def _collect(self, timeout: float):
+        try:
+            index, pid, report = self._results.get(timeout=timeout)
+        except queue.Empty:
+            return
+        shard = self.shards[index]
+        with self._lock:
+            if shard.process is not None and shard.process.pid == pid:
+                shard.report = report
+            else:
+                # Contagem final de um processo já substituído
+                merge_counts(self._retired, report)
+
+    def _supervise(self):
+        while not self._stopping:
+            self._collect(1.0)
+            for shard in self.shards:
+                process = shard.process
+                if self._stopping or process.is_alive():
+                    continue
+                log.error('Shard %d (pid %d) saiu com código %s; reiniciando',
+                          shard.index, process.pid, process.exitcode)
+                with self._lock:
+                    merge_counts(self._retired, shard.report)
+                    shard.report = {}
+                    shard.inbox.close()
+                time.sleep(self.restart_delay)
+                self._spawn(shard)
+                self.restarts += 1
+
+    def stop(self, timeout: float = 10.0):
+        """Envia o que falta, encerra os processos e junta as contagens finais."""
+        self.flush()
+        for shard in self.shards:
+            shard.queue.put((b'', 0))  # lote vazio: fim do processo
+            shard.queue.put((None, 0))
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            shard.sender.join(max(0.0, deadline - time.monotonic()))
+        self._stopping = True
+        self._supervisor.join(2.0)
+        if self._relay is not None:
+            self._outbox.put(None)
+            self._relay.join(2.0)
+        for shard in self.shards:
+            shard.process.join(max(0.0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                # SIGTERM é ignorado pelos processos de trabalho
+                shard.process.kill()
+        # Relatórios finais que ainda estão na fila
+        while True:
+            try:
+                index, pid, report = self._results.get(timeout=0.2)
+            except queue.Empty:
+                break
+            shard = self.shards[index]
+            if shard.process.pid == pid:
+                shard.report = report
+
+    def reports(self) -> List[dict]:
+        """Último relatório de cada processo em execução."""
+        with self._lock:
+            return [shard.report for shard in self.shards]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = {}
+            merge_counts(total, self._retired)
+            for shard in self.shards:
+                merge_counts(total, shard.report)
+            total.update({
+                'workers': self.workers,
+                'restarts': self.restarts,
+                'dispatched': sum(shard.dispatched for shard in self.shards),
+                'dropped': sum(shard.dropped for shard in self.shards),
+                'queue_depth': [shard.queue.qsize() for shard in self.shards],
+            })
+        return total
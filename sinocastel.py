@@ -0,0 +1,526 @@
+import json
+import re
+import struct
+import sys
+import time
+from typing import NamedTuple, Sequence, Union
+
+from alerts import ALERT_PROTOCOL_ID, alert_types, severity
+
+# Os layouts abaixo descrevem as partes de tamanho fixo dos pacotes
+# Sinocastel. Cada layout é compilado uma única vez em um struct.Struct,
+# então um bloco inteiro é lido com um só unpack_from sobre o buffer
+# original. Só as seções variáveis (GPS, strings, parâmetros) usam laço.
+
+LOGIN_PROTOCOL_ID = 0x1001
+GPS_PROTOCOL_ID = 0x4001
+ACC_ON = 0x00040000
+
+
+class Field(NamedTuple):
+    name: str
+    fmt: str
+
+
+class Layout:
+    """Sequência de campos little-endian compilada em um único struct."""
+
+    def __init__(self, name: str, fields: Sequence[Field]):
+        self.name = name
+        self.fields = tuple(fields)
+        self.names = tuple(field.name for field in self.fields)
+        self.struct = struct.Struct('<' + ''.join(field.fmt for field in self.fields))
+        self.size = self.struct.size
+
+    def unpack_from(self, buffer, offset: int = 0) -> tuple:
+        return self.struct.unpack_from(buffer, offset)
+
+    def __repr__(self):
+        return f'Layout({self.name!r}, size={self.size})'
+
+
+HEADER = Layout('header', [
+    Field('protocol_head', '2s'),
+    Field('protocol_length', 'H'),
+    Field('protocol_version', 'B'),
+    Field('device_id', '20s'),
+    # O protocol_id é o único campo escrito na ordem do manual (10 01 = 0x1001)
+    Field('protocol_id', '2s'),
+])
+
+LOGIN_FIXED = Layout('login_fixed', [
+    Field('last_accon_time', 'I'),
+    Field('utc_time', 'I'),
+    Field('total_trip_mileage', 'I'),
+    Field('current_trip_mileage', 'I'),
+    Field('total_fuel', 'I'),
+    Field('current_fuel', 'H'),
+    Field('vstate', 'I'),
+    # Bloco "reservado" de 8 bytes
+    Field('obd_protocol', 'B'),
+    Field('voltage_raw', 'B'),
+    Field('network_info', 'B'),
+    Field('hardware_code', 'B'),
+    Field('signal_strength', 'B'),
+    Field('ber', 'B'),
+    Field('status_flags', 'H'),
+    Field('gps_count', 'B'),
+])
+
+GPS_ITEM = Layout('gps_item', [
+    Field('day', 'B'),
+    Field('month', 'B'),
+    Field('year', 'B'),
+    Field('hour', 'B'),
+    Field('minute', 'B'),
+    Field('second', 'B'),
+    Field('latitude', 'I'),
+    Field('longitude', 'I'),
+    Field('speed', 'H'),
+    Field('direction', 'H'),
+    Field('flags', 'B'),
+])
+
+TRAILER = Layout('trailer', [
+    Field('crc', 'H'),
+    Field('protocol_tail', '2s'),
+])
+
+_U16 = struct.Struct('<H')
+# re aceita memoryview, então a busca do terminador não copia o buffer
+_NUL = re.compile(b'\x00')
+
+PacketData = Union[bytes, bytearray, memoryview]
+
+
+class CountError(struct.error):
+    """Contagem declarada no pacote (gps_count, new_parameter_count) que não cabe nele."""
+
+
+def _check_count(buffer, offset: int, count: int, item_size: int, name: str):
+    # Os itens precisam caber entre ``offset`` e o crc; um pacote corrompido
+    # não pode fazer o decoder ler (ou iterar) além do que foi recebido
+    available = len(buffer) - TRAILER.size - offset
+    if count * item_size > available:
+        raise CountError(f"{name}={count} excede os {max(available, 0)} bytes restantes do pacote.")
+
+FIX_TYPES = {0: "invalid", 1: "2D fix", 2: "3D fix", 3: "3D fix"}
+
+
+def format_timestamp(timestamp):
+    """Converte o timestamp do protocolo (epoch Unix, UTC) para texto."""
+    if not timestamp:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def decode_vstate(vstate):
+    """Decodifica o bitmask de status do veículo."""
+    if vstate & ACC_ON:
+        return "ACC ON"
+    return "No specific state detected"
+
+
+def decode_gps_item(buffer, offset: int) -> dict:
+    (day, month, year, hour, minute, second,
+     lat_raw, lon_raw, speed, direction, flags) = GPS_ITEM.unpack_from(buffer, offset)
+    lat = lat_raw / 3600000.0
+    lon = lon_raw / 3600000.0
+    return {
+        "date": f"{day:02d}/{month:02d}/20{year:02d}",
+        "time": f"{hour:02d}:{minute:02d}:{second:02d}",
+        "latitude": lat if flags & 0x02 else -lat,
+        "longitude": lon if flags & 0x01 else -lon,
+        "speed_cm_s": speed,
+        "direction_degrees": direction / 10.0,
+        "latitude_direction": "N" if flags & 0x02 else "S",
+        "longitude_direction": "E" if flags & 0x01 else "W",
+        "fix_type": FIX_TYPES[(flags >> 2) & 0x03],
+        "satellite_count": flags >> 4,
+    }
+
+
+_MISSING = object()
+
+
+class LazyField:
+    """Campo decodificado no primeiro acesso e guardado no registro.
+
+    Os valores ficam em uma lista por registro (``_values``), indexada na
+    ordem em que os campos são declarados na classe e nas subclasses.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.index = len(owner._lazy_fields)
+        owner._lazy_fields = owner._lazy_fields + (name,)
+
+    def __get__(self, record, owner=None):
+        if record is None:
+            return self
+        values = record._values
+        value = values[self.index]
+        if value is _MISSING:
+            value = values[self.index] = self.func(record)
+        return value
+
+
+class SinocastelRecord:
+    """Pacote decodificado sob demanda.
+
+    Guarda só o buffer do pacote; cada campo é lido do offset fixo na
+    primeira vez que é acessado. ``to_dict()`` monta a mesma estrutura
+    que o SinocastelParser devolvia e ``to_json()`` serializa para bytes.
+    """
+
+    __slots__ = ('buffer', 'base_odometer_km', '_values')
+    _lazy_fields = ()
+    truncated_error = "Pacote truncado."
+
+    def __init__(self, buffer: memoryview, base_odometer_km=0):
+        self.buffer = buffer
+        self.base_odometer_km = base_odometer_km
+        self._values = [_MISSING] * len(self._lazy_fields)
+
+    @LazyField
+    def _header(self):
+        return HEADER.unpack_from(self.buffer)
+
+    @LazyField
+    def _trailer(self):
+        return TRAILER.unpack_from(self.buffer, len(self.buffer) - TRAILER.size)
+
+    @property
+    def protocol_length(self):
+        return self._header[1]
+
+    @property
+    def protocol_version(self):
+        return self._header[2]
+
+    @LazyField
+    def device_id(self):
+        # Internado: o mesmo objeto str serve de chave em todas as tabelas
+        return sys.intern(self._header[3].decode("ascii", errors="ignore").strip("\x00"))
+
+    @LazyField
+    def protocol_id(self):
+        return int.from_bytes(self._header[4], 'big')
+
+    @property
+    def crc(self):
+        return self._trailer[0]
+
+    def hex(self) -> str:
+        return self.buffer.hex()
+
+    def payload_dict(self):
+        return f"Parser para o protocolo {hex(self.protocol_id)} não implementado."
+
+    def to_dict(self) -> dict:
+        header = self._header
+        data = {
+            "protocol_head": f"0x{header[0].hex()}",
+            "protocol_length": header[1],
+            "protocol_version": header[2],
+            "device_id": self.device_id,
+            "protocol_id": f"0x{self.protocol_id:04x}",
+        }
+        try:
+            data["payload"] = self.payload_dict()
+        except CountError as exc:
+            data["error"] = str(exc)
+        except struct.error:
+            data["error"] = self.truncated_error
+        crc, tail = self._trailer
+        data["crc"] = f"0x{crc:04x}"
+        data["protocol_tail"] = f"0x{tail.hex()}"
+        return data
+
+    @LazyField
+    def _json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':')).encode()
+
+    def to_json(self) -> bytes:
+        """Registro serializado em JSON (UTF-8), gerado uma única vez."""
+        return self._json
+
+    def __str__(self):
+        return self.to_json().decode()
+
+    def __repr__(self):
+        return f'<{type(self).__name__} device_id={self.device_id!r} protocol_id=0x{self.protocol_id:04x}>'
+
+
+class StatRecord(SinocastelRecord):
+    """Pacote que começa pelo bloco de estado fixo seguido dos itens GPS.
+
+    O login 0x1001 e os alertas 0x4007 usam o mesmo bloco (LOGIN_FIXED)
+    logo depois do cabeçalho.
+    """
+
+    __slots__ = ()
+
+    @LazyField
+    def _fixed(self):
+        return LOGIN_FIXED.unpack_from(self.buffer, HEADER.size)
+
+    @property
+    def last_accon_timestamp(self):
+        return self._fixed[0]
+
+    @property
+    def utc_timestamp(self):
+        return self._fixed[1]
+
+    @LazyField
+    def last_accon_time(self):
+        return format_timestamp(self._fixed[0])
+
+    @LazyField
+    def utc_time(self):
+        return format_timestamp(self._fixed[1])
+
+    @property
+    def device_reported_mileage_meters(self):
+        return self._fixed[2]
+
+    @property
+    def calculated_vehicle_odometer_km(self):
+        return round(self.base_odometer_km + self._fixed[2] / 1000.0, 2)
+
+    @property
+    def current_trip_mileage(self):
+        return self._fixed[3]
+
+    @property
+    def total_fuel(self):
+        return self._fixed[4]
+
+    @property
+    def current_fuel(self):
+        return self._fixed[5]
+
+    @property
+    def vstate(self):
+        return self._fixed[6]
+
+    @property
+    def gps_count(self):
+        return self._fixed[14]
+
+    @LazyField
+    def reserved(self):
+        (obd_protocol, voltage_raw, network_info, hardware_code,
+         signal_strength, ber, status_flags) = self._fixed[7:14]
+        return {
+            "protocol": "ISO9141" if obd_protocol == 0x07 else f"unknown({obd_protocol})",
+            "voltage_V": round(voltage_raw * 0.1 + 8, 1),
+            "network": "CDMA BC0" if network_info == 0x01 else f"unknown({network_info})",
+            "hardware_code": "SIM800L" if hardware_code == 0x07 else f"code_{hardware_code}",
+            "signal_strength": signal_strength,
+            "ber": ber,
+            "status_flags": {
+                "obd_connected": bool(status_flags & 0b0001),
+                "rpm_present": bool(status_flags & 0b0010),
+                "gps_error": bool(status_flags & 0b0100),
+                "rtc_error": bool(status_flags & 0b1000),
+                "voltage_error": bool(status_flags & 0b10000),
+            },
+        }
+
+    @LazyField
+    def _gps_end(self):
+        """Offset logo após o bloco GPS, conferido contra o tamanho do pacote."""
+        offset = HEADER.size + LOGIN_FIXED.size
+        count = self.gps_count
+        _check_count(self.buffer, offset, count, GPS_ITEM.size, 'gps_count')
+        return offset + count * GPS_ITEM.size
+
+    @LazyField
+    def gps_info(self):
+        offset = self._gps_end - self.gps_count * GPS_ITEM.size
+        return [decode_gps_item(self.buffer, offset + i * GPS_ITEM.size)
+                for i in range(self.gps_count)]
+
+    @LazyField
+    def latest_gps(self):
+        """Última posição do bloco GPS, sem decodificar as anteriores."""
+        if not self.gps_count:
+            return None
+        return decode_gps_item(self.buffer, self._gps_end - GPS_ITEM.size)
+
+    @LazyField
+    def latest_gps_item(self):
+        """Última posição como a tupla crua de GPS_ITEM (sem conversões)."""
+        if not self.gps_count:
+            return None
+        return GPS_ITEM.unpack_from(self.buffer, self._gps_end - GPS_ITEM.size)
+
+    def stat_dict(self) -> dict:
+        """Bloco de estado e GPS no formato do payload do SinocastelParser."""
+        fixed = self._fixed
+        device_meters = fixed[2]
+        vstate = fixed[6]
+        return {
+            "last_accon_time": self.last_accon_time,
+            "utc_time": self.utc_time,
+            "device_reported_mileage_meters": device_meters,
+            "device_reported_mileage_km": round(device_meters / 1000.0, 2),
+            "calculated_vehicle_odometer_km": round(self.base_odometer_km + device_meters / 1000.0, 2),
+            "current_trip_mileage": fixed[3],
+            "total_fuel": fixed[4],
+            "current_fuel": fixed[5],
+            "vstate_raw": f"0x{vstate:08x}",
+            "vstate_decoded": decode_vstate(vstate),
+            "reserved": self.reserved,
+            "gps_info": self.gps_info,
+        }
+
+
+class LoginRecord(StatRecord):
+    """Pacote de login 0x1001."""
+
+    __slots__ = ()
+    truncated_error = "Pacote de login truncado."
+
+    @LazyField
+    def _variable(self):
+        """Strings de versão e lista de parâmetros após o bloco GPS."""
+        buffer = self.buffer
+        offset = self._gps_end
+        software_version, offset = _read_variable_string(buffer, offset)
+        hardware_version, offset = _read_variable_string(buffer, offset)
+        (param_count,) = _U16.unpack_from(buffer, offset)
+        offset += 2
+        _check_count(buffer, offset, param_count, 2, 'new_parameter_count')
+        params_hex = buffer[offset:offset + 2 * param_count].hex().upper()
+        params = [params_hex[i:i + 4] for i in range(0, len(params_hex), 4)]
+        return software_version, hardware_version, param_count, params
+
+    @property
+    def software_version(self):
+        return self._variable[0]
+
+    @property
+    def hardware_version(self):
+        return self._variable[1]
+
+    def payload_dict(self):
+        software_version, hardware_version, param_count, params = self._variable
+        payload = self.stat_dict()
+        payload["software_version"] = software_version
+        payload["hardware_version"] = hardware_version
+        payload["new_parameter_count"] = param_count
+        payload["new_parameters"] = params
+        return payload
+
+
+class GpsRecord(StatRecord):
+    """Pacote periódico de GPS e telemetria 0x4001.
+
+    Mesmo bloco de estado e itens GPS do login; o que vem depois (RPM e
+    demais blocos) ainda não é decodificado.
+    """
+
+    __slots__ = ()
+    truncated_error = "Pacote de GPS truncado."
+
+    def payload_dict(self):
+        return self.stat_dict()
+
+
+class AlertRecord(StatRecord):
+    """Pacote de alerta 0x4007 (bloco de estado e GPS).
+
+    ``repetitions`` é o número de cópias idênticas recebidas em sequência
+    (ver alerts.AlertCollapser); o pacote é decodificado uma vez só.
+    """
+
+    __slots__ = ('repetitions',)
+    truncated_error = "Pacote de alerta truncado."
+
+    def __init__(self, buffer: memoryview, base_odometer_km=0, repetitions: int = 1):
+        super().__init__(buffer, base_odometer_km)
+        self.repetitions = repetitions
+
+    @property
+    def alert_flags(self):
+        # Byte S3 do vstate (o mais significativo, little-endian)
+        return self._fixed[6] >> 24
+
+    @property
+    def severity(self):
+        return severity(self.repetitions)
+
+    @property
+    def alert_types(self):
+        return alert_types(self.alert_flags)
+
+    def payload_dict(self):
+        payload = self.stat_dict()
+        payload["alert"] = {
+            "repetitions": self.repetitions,
+            "severity": self.severity,
+            "flags": f"0x{self.alert_flags:02x}",
+            "types": self.alert_types,
+        }
+        return payload
+
+
+RECORD_TYPES = {
+    LOGIN_PROTOCOL_ID: LoginRecord,
+    GPS_PROTOCOL_ID: GpsRecord,
+    ALERT_PROTOCOL_ID: AlertRecord,
+}
+
+
+def _read_variable_string(buffer: memoryview, offset: int):
+    """Lê uma string terminada pelo caractere nulo; devolve (valor, novo offset)."""
+    match = _NUL.search(buffer, offset)
+    if match is None:
+        return None, offset
+    end_index = match.start()
+    return str(buffer[offset:end_index], 'ascii', 'ignore'), end_index + 1
+
+
+def decode_record(data: PacketData, base_odometer_km=0) -> SinocastelRecord:
+    """Cria o registro sob demanda adequado ao protocol_id do pacote."""
+    buffer = memoryview(data)
+    if len(buffer) < HEADER.size + TRAILER.size:
+        raise ValueError("Pacote de dados inválido ou muito curto.")
+    protocol_id = int.from_bytes(buffer[HEADER.size - 2:HEADER.size], 'big')
+    record_type = RECORD_TYPES.get(protocol_id, SinocastelRecord)
+    return record_type(buffer, base_odometer_km)
+
+
+class SinocastelParser:
+    """Interface antiga: decodifica o pacote inteiro em um dicionário.
+
+    Aceita ``bytes``, ``bytearray`` ou ``memoryview`` (por exemplo, os
+    pacotes devolvidos pelo SinocastelFramer); strings hexadecimais ainda
+    são aceitas por compatibilidade com os scripts antigos. Quem precisa
+    só de alguns campos deve usar ``decode_record``.
+    """
+
+    def __init__(self, data: Union[PacketData, str], base_odometer_km=0):
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        self.buffer = memoryview(data)
+        self.base_odometer_km = base_odometer_km
+
+    def hex(self) -> str:
+        """Forma hexadecimal do pacote, gerada só quando solicitada."""
+        return self.buffer.hex()
+
+    def record(self) -> SinocastelRecord:
+        return decode_record(self.buffer, self.base_odometer_km)
+
+    def parse(self):
+        if len(self.buffer) < HEADER.size + TRAILER.size:
+            return {"error": "Pacote de dados inválido ou muito curto."}
+        return self.record().to_dict()
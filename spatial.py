@@ -0,0 +1,388 @@
+"""Índice espacial das últimas posições dos veículos.
+
+Cada veículo ocupa uma posição fixa ("slot") em arrays paralelos
+(latitude, longitude, velocidade, direção, horário) e está em uma célula
+de uma grade uniforme de ``cell_degrees`` graus. A grade guarda só as
+células ocupadas (dicionário célula -> array de slots), e cada slot sabe
+onde está no array da sua célula: atualizar uma posição, mesmo mudando de
+célula, é O(1).
+
+Consultas (no endpoint local, ver ``fleet_routes``):
+
+    curl 'http://127.0.0.1:29481/fleet/bbox?min_lat=-23.1&min_lon=-43.8&max_lat=-22.7&max_lon=-43.1'
+    curl 'http://127.0.0.1:29481/fleet/radius?lat=-22.9&lon=-43.2&km=5'
+    curl 'http://127.0.0.1:29481/fleet/nearest?lat=-22.9&lon=-43.2&n=10'
+
+Retângulo e raio visitam só as células que os cobrem (ou só as ocupadas,
+quando são menos); os mais próximos percorrem anéis de células em volta
+do ponto até que nenhum veículo fora deles possa estar mais perto.
+"""
+import json
+import math
+from array import array
+from heapq import nsmallest
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sinocastel import StatRecord
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+# cm/s (GPS do pacote) -> km/h
+CM_S_TO_KM_H = 0.036
+
+DEFAULT_LIMIT = 1000
+
+# Posições fora da faixa vêm de um item de GPS corrompido: não são
+# indexadas (store.py também as recusa)
+MAX_LATITUDE = 90.0
+MAX_LONGITUDE = 180.0
+
+Position = Tuple[float, float, float, float, int]
+
+
+class QueryError(ValueError):
+    pass
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def position_of(record) -> Optional[Position]:
+    """(latitude, longitude, km/h, direção, utc_timestamp) do último GPS válido do registro."""
+    if not isinstance(record, StatRecord):
+        return None
+    # latest_gps fica guardado no registro; a sessão normalmente já o leu
+    gps = record.latest_gps
+    if gps is None or gps['fix_type'] == 'invalid':
+        return None
+    return (gps['latitude'], gps['longitude'], gps['speed_cm_s'] * CM_S_TO_KM_H,
+            gps['direction_degrees'], record.utc_timestamp)
+
+
+class FleetIndex:
+    """Última posição de cada dispositivo, em uma grade uniforme."""
+
+    def __init__(self, cell_degrees: float = 0.01):
+        self.cell_degrees = cell_degrees
+        self.rows = math.ceil(180.0 / cell_degrees)
+        self.columns = math.ceil(360.0 / cell_degrees)
+        self.device_ids: List[str] = []
+        self._slots: Dict[str, int] = {}
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.speeds = array('f')
+        self.directions = array('f')
+        self.timestamps = array('L')
+        # Célula de cada slot e posição dele no array da célula
+        self._cells = array('q')
+        self._positions = array('l')
+        self._grid: Dict[int, array] = {}
+        self.updates = 0
+        self.invalid = 0
+
+    def __len__(self) -> int:
+        return len(self.device_ids)
+
+    # --- Atualização ---------------------------------------------------
+
+    def _row(self, latitude: float) -> int:
+        return min(max(int((latitude + 90.0) / self.cell_degrees), 0), self.rows - 1)
+
+    def _column(self, longitude: float) -> int:
+        return math.floor((longitude + 180.0) / self.cell_degrees) % self.columns
+
+    def observe(self, record):
+        """Atualiza o índice com um registro decodificado, se ele trouxer GPS."""
+        position = position_of(record)
+        if position is not None:
+            self.update(record.device_id, *position)
+
+    def update(self, device_id: str, latitude: float, longitude: float,
+               speed_kmh: float = 0.0, direction: float = 0.0, timestamp: int = 0):
+        # Escrito assim para recusar também NaN
+        if not (-MAX_LATITUDE <= latitude <= MAX_LATITUDE and -MAX_LONGITUDE <= longitude <= MAX_LONGITUDE):
+            self.invalid += 1
+            return
+        cell = self._row(latitude) * self.columns + self._column(longitude)
+        slot = self._slots.get(device_id)
+        if slot is None:
+            slot = self._slots[device_id] = len(self.device_ids)
+            self.device_ids.append(device_id)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+            self.speeds.append(speed_kmh)
+            self.directions.append(direction)
+            self.timestamps.append(timestamp)
+            self._cells.append(cell)
+            self._positions.append(0)
+            self._add(slot, cell)
+        else:
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+            self.speeds[slot] = speed_kmh
+            self.directions[slot] = direction
+            self.timestamps[slot] = timestamp
+            if self._cells[slot] != cell:
+                self._remove(slot)
+                self._add(slot, cell)
+        self.updates += 1
+
+    def update_many(self, positions):
+        """``[(device_id, latitude, longitude, km/h, direção, timestamp), ...]``"""
+        update = self.update
+        for item in positions:
+            update(*item)
+
+    def _add(self, slot: int, cell: int):
+        members = self._grid.get(cell)
+        if members is None:
+            members = self._grid[cell] = array('l')
+        self._positions[slot] = len(members)
+        members.append(slot)
+        self._cells[slot] = cell
+
+    def _remove(self, slot: int):
+        # Troca com o último do array da célula: O(1)
+        cell = self._cells[slot]
+        members = self._grid[cell]
+        last = members.pop()
+        if last != slot:
+            index = self._positions[slot]
+            members[index] = last
+            self._positions[last] = index
+        if not members:
+            del self._grid[cell]
+
+    # --- Consultas -----------------------------------------------------
+
+    def _column_ranges(self, min_lon: float, max_lon: float) -> List[Tuple[int, int]]:
+        if max_lon - min_lon >= 360.0:
+            return [(0, self.columns - 1)]
+        first, last = self._column(min_lon), self._column(max_lon)
+        if first <= last:
+            return [(first, last)]
+        # Atravessa o antimeridiano
+        return [(first, self.columns - 1), (0, last)]
+
+    def _cells_in(self, min_lat: float, min_lon: float,
+                  max_lat: float, max_lon: float) -> Iterator[array]:
+        grid = self._grid
+        columns = self.columns
+        first_row, last_row = self._row(min_lat), self._row(max_lat)
+        ranges = self._column_ranges(min_lon, max_lon)
+        covered = (last_row - first_row + 1) * sum(last - first + 1 for first, last in ranges)
+        if covered > len(grid):
+            # Retângulo grande: mais barato conferir as células ocupadas
+            for cell, members in grid.items():
+                row, column = divmod(cell, columns)
+                if first_row <= row <= last_row and any(first <= column <= last for first, last in ranges):
+                    yield members
+            return
+        for row in range(first_row, last_row + 1):
+            base = row * columns
+            for first, last in ranges:
+                for column in range(first, last + 1):
+                    members = grid.get(base + column)
+                    if members is not None:
+                        yield members
+
+    def bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+             limit: int = DEFAULT_LIMIT) -> List[int]:
+        """Slots dentro do retângulo; ``min_lon > max_lon`` atravessa o antimeridiano."""
+        latitudes, longitudes = self.latitudes, self.longitudes
+        wraps = min_lon > max_lon
+        found = []
+        for members in self._cells_in(min_lat, min_lon, max_lat, max_lon):
+            for slot in members:
+                latitude = latitudes[slot]
+                longitude = longitudes[slot]
+                if not min_lat <= latitude <= max_lat:
+                    continue
+                if wraps:
+                    if not (longitude >= min_lon or longitude <= max_lon):
+                        continue
+                elif not min_lon <= longitude <= max_lon:
+                    continue
+                found.append(slot)
+                if len(found) >= limit:
+                    return found
+        return found
+
+    def radius(self, latitude: float, longitude: float, km: float,
+               limit: int = DEFAULT_LIMIT) -> List[Tuple[float, int]]:
+        """(distância em km, slot) dentro do raio, do mais perto ao mais longe."""
+        delta_lat = km / KM_PER_DEGREE
+        min_lat, max_lat = max(latitude - delta_lat, -90.0), min(latitude + delta_lat, 90.0)
+        widest = max(abs(min_lat), abs(max_lat))
+        if widest >= 89.9:
+            min_lon, max_lon = -180.0, 180.0
+        else:
+            delta_lon = min(delta_lat / math.cos(math.radians(widest)), 180.0)
+            min_lon, max_lon = longitude - delta_lon, longitude + delta_lon
+            if delta_lon >= 180.0:
+                min_lon, max_lon = -180.0, 180.0
+        latitudes, longitudes = self.latitudes, self.longitudes
+        found = []
+        for members in self._cells_in(min_lat, min_lon, max_lat, max_lon):
+            for slot in members:
+                distance = haversine_km(latitude, longitude, latitudes[slot], longitudes[slot])
+                if distance <= km:
+                    found.append((distance, slot))
+        found.sort()
+        return found[:limit]
+
+    def _ring(self, row: int, column: int, k: int) -> Iterator[int]:
+        """Células a exatamente ``k`` células (Chebyshev) de (row, column)."""
+        columns = self.columns
+        for r in range(row - k, row + k + 1):
+            if not 0 <= r < self.rows:
+                continue
+            base = r * columns
+            if r in (row - k, row + k):
+                for c in range(column - k, column + k + 1):
+                    yield base + c % columns
+            elif k:
+                yield base + (column - k) % columns
+                yield base + (column + k) % columns
+
+    def _occupied_rings(self, row: int, column: int) -> Dict[int, List[array]]:
+        """Células ocupadas agrupadas pelo anel em que estão em volta de (row, column)."""
+        columns = self.columns
+        rings: Dict[int, List[array]] = {}
+        for cell, members in self._grid.items():
+            r, c = divmod(cell, columns)
+            distance = abs(c - column)
+            ring = max(abs(r - row), min(distance, columns - distance))
+            rings.setdefault(ring, []).append(members)
+        return rings
+
+    def nearest(self, latitude: float, longitude: float, n: int = 10,
+                max_km: Optional[float] = None) -> List[Tuple[float, int]]:
+        """Os ``n`` veículos mais próximos: (distância em km, slot), do mais perto ao mais longe."""
+        if n <= 0 or not self.device_ids:
+            return []
+        grid = self._grid
+        latitudes, longitudes = self.latitudes, self.longitudes
+        row, column = self._row(latitude), self._column(longitude)
+        found = []
+        # Anel -> células ocupadas; montado quando os anéis ficam maiores que a
+        # grade ocupada (frota esparsa, ou ponto longe dela), para pular os vazios
+        rings = None
+        pending = None
+        k = 0
+        while True:
+            if rings is None:
+                cells = (grid.get(cell) for cell in self._ring(row, column, k))
+            else:
+                cells = rings[k]
+            for members in cells:
+                if members is None:
+                    continue
+                for slot in members:
+                    found.append((haversine_km(latitude, longitude, latitudes[slot], longitudes[slot]), slot))
+            # Quem está fora do anel k fica a pelo menos k células de distância
+            # (em longitude, medidas na latitude mais alta que o anel alcança)
+            edge = k * self.cell_degrees
+            reach = KM_PER_DEGREE * edge * math.cos(math.radians(min(abs(latitude) + edge, 90.0)))
+            if len(found) >= n and nsmallest(n, found)[-1][0] <= reach:
+                break
+            if max_km is not None and reach > max_km:
+                break
+            if rings is None and (2 * k + 3) ** 2 > len(grid):
+                rings = self._occupied_rings(row, column)
+                pending = iter(sorted(ring for ring in rings if ring > k))
+            if pending is None:
+                k += 1
+            else:
+                k = next(pending, None)
+                if k is None:
+                    break
+        if max_km is not None:
+            found = [item for item in found if item[0] <= max_km]
+        return nsmallest(n, found)
+
+    def describe(self, slot: int, distance: Optional[float] = None) -> dict:
+        vehicle = {
+            'device_id': self.device_ids[slot],
+            'latitude': self.latitudes[slot],
+            'longitude': self.longitudes[slot],
+            'speed_kmh': round(self.speeds[slot], 1),
+            'direction_degrees': round(self.directions[slot], 1),
+            'utc_timestamp': self.timestamps[slot],
+        }
+        if distance is not None:
+            vehicle['distance_km'] = round(distance, 3)
+        return vehicle
+
+    def get(self, device_id: str) -> Optional[dict]:
+        slot = self._slots.get(device_id)
+        return None if slot is None else self.describe(slot)
+
+    def stats(self) -> dict:
+        return {'vehicles': len(self.device_ids), 'cells': len(self._grid), 'updates': self.updates,
+                'invalid': self.invalid}
+
+
+# --- Endpoint local -------------------------------------------------------------
+
+def _number(query: Dict[str, str], name: str, default=None, kind=float):
+    value = query.get(name)
+    if value is None:
+        if default is None:
+            raise QueryError(f'{name} obrigatório')
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise QueryError(f'{name} inválido: {value}') from None
+
+
+def fleet_routes(fleet: FleetIndex) -> dict:
+    """Rotas ``/fleet/*`` para metrics.serve; respostas em JSON."""
+
+    def reply(vehicles: List[dict]):
+        body = json.dumps({'count': len(vehicles), 'vehicles': vehicles}, ensure_ascii=False)
+        return '200 OK', 'application/json', body.encode()
+
+    def route(handle):
+        async def respond(query):
+            try:
+                return handle(query)
+            except QueryError as exc:
+                return '400 Bad Request', 'text/plain; charset=utf-8', f'{exc}\n'.encode()
+        return respond
+
+    @route
+    def bbox(query):
+        slots = fleet.bbox(_number(query, 'min_lat'), _number(query, 'min_lon'),
+                           _number(query, 'max_lat'), _number(query, 'max_lon'),
+                           _number(query, 'limit', DEFAULT_LIMIT, int))
+        return reply([fleet.describe(slot) for slot in slots])
+
+    @route
+    def radius(query):
+        found = fleet.radius(_number(query, 'lat'), _number(query, 'lon'), _number(query, 'km'),
+                             _number(query, 'limit', DEFAULT_LIMIT, int))
+        return reply([fleet.describe(slot, distance) for distance, slot in found])
+
+    @route
+    def nearest(query):
+        max_km = _number(query, 'max_km', 0.0) or None
+        found = fleet.nearest(_number(query, 'lat'), _number(query, 'lon'),
+                              min(_number(query, 'n', 10, int), DEFAULT_LIMIT), max_km)
+        return reply([fleet.describe(slot, distance) for distance, slot in found])
+
+    @route
+    def device(query):
+        vehicle = fleet.get(query.get('id', ''))
+        if vehicle is None:
+            return '404 Not Found', 'text/plain', b'dispositivo sem posicao\n'
+        return reply([vehicle])
+
+    return {'/fleet/bbox': bbox, '/fleet/radius': radius,
+            '/fleet/nearest': nearest, '/fleet/device': device}
@@ -0,0 +1,505 @@
+"""Armazenamento colunar dos registros decodificados, particionado por dia.
+
+Os registros com bloco de estado (login 0x1001, GPS 0x4001, alertas
+0x4007) viram linhas com colunas de tamanho fixo (``COLUMNS``); linhas com
+coordenadas impossíveis são contadas em ``invalid``. O caminho dos pacotes
+só acrescenta o registro a uma fila limitada; uma thread de fundo monta
+as linhas e as separa por partição (dia do utc_time e ``crc32(device_id) %
+partições``) e grava um segmento quando a partição junta
+``segment_rows`` linhas ou fica ``flush_interval`` segundos sem gravar:
+
+    logs/store/20261017/p03/<min_time>-<max_time>-<pid>-<seq>.sncol
+
+Cada segmento é imutável:
+
+    MAGIC
+    bloco*           zlib de até ``block_rows`` valores de uma coluna
+    rodapé           JSON: colunas (tipo e blocos), faixa de linhas e de
+                     horário de cada device_id, horário mínimo e máximo
+    footer_offset(u64) FOOTER_MAGIC
+
+As linhas do segmento são ordenadas por (device_id, utc_time). Uma
+consulta abre só os segmentos dos dias e da partição do dispositivo
+cujo nome (min/max do horário) cruza o intervalo, lê o rodapé via mmap e
+descomprime só os blocos das colunas pedidas que cobrem as linhas do
+dispositivo. O custo acompanha o tamanho do resultado, não o do log.
+
+    python store.py query 218LSAB2025000002 --start 2026-10-13 --end 2026-10-14
+    python store.py query 218LSAB2025000002 --start 2026-10-13 --columns latitude,longitude,speed_cm_s
+    python store.py stats
+"""
+import argparse
+import calendar
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sinocastel import StatRecord, format_timestamp
+
+STORE_DIR = Path('logs') / 'store'
+META_FILE = 'store.json'
+MAGIC = b'SNCCOL01'
+FOOTER_MAGIC = b'SNCCIX01'
+SEGMENT_SUFFIX = '.sncol'
+FOOTER_TRAILER = struct.Struct('<Q8s')
+
+DAY_SECONDS = 86400
+
+# (nome, typecode do array); a linha guardada é (device_id,) + colunas.
+# latitude/longitude em milésimos de segundo de arco com sinal (graus *
+# 3.600.000), como no pacote; speed em cm/s; direction em décimos de grau.
+COLUMNS = (
+    ('utc_time', 'I'),
+    ('protocol_id', 'H'),
+    ('mileage_meters', 'I'),
+    ('trip_mileage_meters', 'I'),
+    ('total_fuel', 'I'),
+    ('current_fuel', 'H'),
+    ('vstate', 'I'),
+    ('latitude', 'i'),
+    ('longitude', 'i'),
+    ('speed_cm_s', 'H'),
+    ('direction', 'H'),
+    ('gps_flags', 'B'),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+COORDINATE_SCALE = 3600000.0
+# Maiores valores válidos (90° e 180°); acima disso o pacote está errado e
+# não caberia na coluna 'i'
+MAX_LATITUDE = 90 * 3600000
+MAX_LONGITUDE = 180 * 3600000
+
+log = logging.getLogger(__name__)
+
+
+def partition_of(device_id: str, partitions: int) -> int:
+    return zlib.crc32(device_id.encode('ascii', errors='ignore')) % partitions
+
+
+def day_name(day: int) -> str:
+    return time.strftime('%Y%m%d', time.gmtime(day * DAY_SECONDS))
+
+
+def record_row(record) -> Optional[tuple]:
+    """Linha do armazenamento para um registro, ou None se ele não tiver bloco de estado.
+
+    Coordenadas fora de ±90°/±180° levantam ValueError.
+    """
+    if not isinstance(record, StatRecord):
+        return None
+    gps = record.latest_gps_item
+    if gps is None:
+        latitude = longitude = speed = direction = flags = 0
+    else:
+        latitude, longitude, speed, direction, flags = gps[6:]
+        if latitude > MAX_LATITUDE or longitude > MAX_LONGITUDE:
+            raise ValueError(f'coordenada fora da faixa: {latitude}, {longitude}')
+        if not flags & 0x02:
+            latitude = -latitude
+        if not flags & 0x01:
+            longitude = -longitude
+    return (record.device_id, record.utc_timestamp, record.protocol_id,
+            record.device_reported_mileage_meters, record.current_trip_mileage,
+            record.total_fuel, record.current_fuel, record.vstate,
+            latitude, longitude, speed, direction, flags)
+
+
+# --- Gravação -------------------------------------------------------------------
+
+class TelemetryStore:
+    """Grava as linhas em segmentos colunares, por uma thread de fundo."""
+
+    def __init__(self, directory: Path = STORE_DIR, partitions: int = 16,
+                 segment_rows: int = 65536, block_rows: int = 4096,
+                 flush_interval: float = 60.0, max_pending: int = 100000,
+                 compression: int = 6):
+        self.directory = Path(directory)
+        self.partitions = partitions
+        self.segment_rows = segment_rows
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.compression = compression
+        # deque: append no loop de eventos e popleft na thread, sem trava
+        self._pending = deque()
+        # (dia, partição) -> linhas ainda não gravadas, e quando a primeira chegou
+        self._buffers: Dict[Tuple[int, int], List[tuple]] = {}
+        self._opened: Dict[Tuple[int, int], float] = {}
+        self._partition_cache: Dict[str, int] = {}
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='store', daemon=True)
+        self.appended = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.rows_written = 0
+        self.segments = 0
+        self.bytes_written = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta_path = self.directory / META_FILE
+        try:
+            # 'x': com WORKERS=n vários processos podem chegar aqui juntos
+            with open(meta_path, 'x', encoding='utf-8') as meta_file:
+                json.dump({'partitions': self.partitions, 'columns': COLUMNS}, meta_file)
+        except FileExistsError:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            if meta['partitions'] != self.partitions:
+                raise ValueError(f'{self.directory} usa {meta["partitions"]} partições, '
+                                 f'não {self.partitions}')
+        self._thread.start()
+
+    def append(self, record):
+        """Enfileira um registro decodificado; nunca bloqueia.
+
+        A linha (``record_row``) é montada na thread de fundo, como o JSON
+        do webhook em forwarder.py.
+        """
+        if not isinstance(record, StatRecord):
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(record)
+        self.appended += 1
+
+    def _run(self):
+        while not self._stop.wait(0.5):
+            self._step()
+        self._step(force=True)
+
+    def _step(self, force: bool = False):
+        # Um segmento com problema não pode parar a thread: a fila encheria
+        # e todo registro seguinte seria descartado em silêncio
+        try:
+            self._drain()
+            self._flush(force)
+        except Exception:
+            log.exception('Falha no armazenamento colunar')
+
+    def _drain(self):
+        pending = self._pending
+        buffers = self._buffers
+        cache = self._partition_cache
+        now = time.monotonic()
+        while pending:
+            try:
+                row = record_row(pending.popleft())
+            except (struct.error, ValueError):
+                # Bloco GPS inconsistente (ver sinocastel.CountError) ou
+                # coordenada impossível
+                self.invalid += 1
+                continue
+            device_id = row[0]
+            partition = cache.get(device_id)
+            if partition is None:
+                partition = cache[device_id] = partition_of(device_id, self.partitions)
+            key = (row[1] // DAY_SECONDS, partition)
+            rows = buffers.get(key)
+            if rows is None:
+                rows = buffers[key] = []
+                self._opened[key] = now
+            rows.append(row)
+            if len(rows) >= self.segment_rows:
+                self._write_segment(key, buffers.pop(key))
+                del self._opened[key]
+
+    def _flush(self, force: bool = False):
+        deadline = time.monotonic() - self.flush_interval
+        for key, opened in list(self._opened.items()):
+            if force or opened <= deadline:
+                del self._opened[key]
+                self._write_segment(key, self._buffers.pop(key))
+
+    def _write_segment(self, key: Tuple[int, int], rows: List[tuple]):
+        day, partition = key
+        rows.sort(key=itemgetter(0, 1))
+        directory = self.directory / day_name(day) / f'p{partition:02d}'
+        min_time = min(row[1] for row in rows)
+        max_time = max(row[1] for row in rows)
+        self._sequence += 1
+        name = f'{min_time}-{max_time}-{os.getpid()}-{self._sequence:05d}{SEGMENT_SUFFIX}'
+        devices = {}
+        start = 0
+        for device_id, group in groupby(rows, key=itemgetter(0)):
+            group = list(group)
+            devices[device_id] = [start, start + len(group), group[0][1], group[-1][1]]
+            start += len(group)
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            temporary = directory / (name + '.part')
+            columns = {}
+            with open(temporary, 'wb') as segment:
+                segment.write(MAGIC)
+                offset = len(MAGIC)
+                for index, (column, typecode) in enumerate(COLUMNS, start=1):
+                    values = array(typecode, [row[index] for row in rows])
+                    blocks = []
+                    for first in range(0, len(values), self.block_rows):
+                        data = zlib.compress(values[first:first + self.block_rows].tobytes(),
+                                             self.compression)
+                        segment.write(data)
+                        blocks.append([offset, len(data)])
+                        offset += len(data)
+                    columns[column] = {'type': typecode, 'blocks': blocks}
+                footer = json.dumps({
+                    'rows': len(rows),
+                    'block_rows': self.block_rows,
+                    'min_time': min_time,
+                    'max_time': max_time,
+                    'columns': columns,
+                    'devices': devices,
+                }, separators=(',', ':')).encode('utf-8')
+                segment.write(footer)
+                segment.write(FOOTER_TRAILER.pack(offset, FOOTER_MAGIC))
+                offset += len(footer) + FOOTER_TRAILER.size
+            # Leitores só enxergam segmentos completos
+            os.replace(temporary, directory / name)
+        except OSError:
+            log.exception('Falha ao gravar o segmento %s (%d linhas perdidas)', name, len(rows))
+            return
+        self.segments += 1
+        self.rows_written += len(rows)
+        self.bytes_written += offset
+
+    def stop(self, timeout: float = 10.0):
+        """Grava o que estiver pendente e encerra a thread."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'appended': self.appended,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+            'rows_written': self.rows_written,
+            'segments': self.segments,
+            'bytes_written': self.bytes_written,
+            'queue_depth': self.queue_depth,
+        }
+
+
+# --- Leitura --------------------------------------------------------------------
+
+class Segment:
+    """Um segmento lido via mmap; só o rodapé é interpretado ao abrir."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        try:
+            if view[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{self.path} não é um segmento colunar')
+            offset, magic = FOOTER_TRAILER.unpack_from(view, len(view) - FOOTER_TRAILER.size)
+            if magic != FOOTER_MAGIC:
+                raise ValueError(f'{self.path} sem rodapé')
+            self.footer = json.loads(bytes(view[offset:len(view) - FOOTER_TRAILER.size]))
+        finally:
+            view.release()
+        self.devices: Dict[str, list] = self.footer['devices']
+        self.block_rows = self.footer['block_rows']
+        # (coluna, bloco) -> valores; o segmento vive só durante uma consulta
+        self._blocks: Dict[Tuple[str, int], array] = {}
+
+    def column(self, name: str, start: int, end: int) -> array:
+        """Valores da coluna nas linhas [start, end), descomprimindo só os blocos delas."""
+        info = self.footer['columns'][name]
+        values = array(info['type'])
+        if start >= end:
+            return values
+        first = start // self.block_rows
+        last = (end - 1) // self.block_rows
+        for block in range(first, last + 1):
+            key = (name, block)
+            decoded = self._blocks.get(key)
+            if decoded is None:
+                offset, length = info['blocks'][block]
+                decoded = self._blocks[key] = array(info['type'], zlib.decompress(self._map[offset:offset + length]))
+            values.extend(decoded)
+        base = first * self.block_rows
+        return values[start - base:end - base]
+
+    def select(self, device_id: str, start_time: int, end_time: int,
+               columns: Sequence[str]) -> Optional[Dict[str, array]]:
+        """Colunas das linhas do dispositivo com ``start_time <= utc_time <= end_time``."""
+        entry = self.devices.get(device_id)
+        if entry is None:
+            return None
+        first, last, min_time, max_time = entry
+        if max_time < start_time or min_time > end_time:
+            return None
+        times = self.column('utc_time', first, last)
+        low = bisect_left(times, start_time)
+        high = bisect_right(times, end_time)
+        if low >= high:
+            return None
+        selected = {'utc_time': times[low:high]}
+        for name in columns:
+            if name not in selected:
+                selected[name] = self.column(name, first + low, first + high)
+        return selected
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _segment_times(path: Path) -> Tuple[int, int]:
+    min_time, max_time, _ = path.name.split('-', 2)
+    return int(min_time), int(max_time)
+
+
+class StoreReader:
+    def __init__(self, directory: Path = STORE_DIR):
+        self.directory = Path(directory)
+        meta = json.loads((self.directory / META_FILE).read_text(encoding='utf-8'))
+        self.partitions = meta['partitions']
+
+    def segment_paths(self, start_time: int, end_time: int,
+                      device_id: Optional[str] = None) -> Iterator[Path]:
+        """Segmentos que podem ter linhas no intervalo (pelo nome, sem abrir)."""
+        if device_id is None:
+            partitions = range(self.partitions)
+        else:
+            partitions = [partition_of(device_id, self.partitions)]
+        for day in range(start_time // DAY_SECONDS, end_time // DAY_SECONDS + 1):
+            day_directory = self.directory / day_name(day)
+            if not day_directory.is_dir():
+                continue
+            for partition in partitions:
+                for path in sorted((day_directory / f'p{partition:02d}').glob(f'*{SEGMENT_SUFFIX}')):
+                    min_time, max_time = _segment_times(path)
+                    if max_time >= start_time and min_time <= end_time:
+                        yield path
+
+    def query(self, device_id: Optional[str], start_time: int, end_time: int,
+              columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Linhas (dicionários) no intervalo, ordenadas por dispositivo e utc_time.
+
+        Sem ``device_id``, todos os dispositivos (todas as partições).
+        """
+        columns = list(columns or COLUMN_NAMES)
+        unknown = set(columns) - set(COLUMN_NAMES)
+        if unknown:
+            raise ValueError(f'colunas desconhecidas: {", ".join(sorted(unknown))}')
+        rows = []
+        for path in self.segment_paths(start_time, end_time, device_id):
+            segment = Segment(path)
+            try:
+                devices = [device_id] if device_id is not None else list(segment.devices)
+                for device in devices:
+                    selected = segment.select(device, start_time, end_time, columns)
+                    if selected is not None:
+                        rows.extend(_rows(device, selected, columns))
+            finally:
+                segment.close()
+        # Segmentos diferentes podem se sobrepor no tempo (retransmissões)
+        rows.sort(key=itemgetter('device_id', 'utc_time'))
+        return rows
+
+    def stats(self) -> dict:
+        days = {}
+        for path in self.directory.glob(f'*/p*/*{SEGMENT_SUFFIX}'):
+            day = days.setdefault(path.parent.parent.name, {'segments': 0, 'rows': 0, 'bytes': 0})
+            segment = Segment(path)
+            day['segments'] += 1
+            day['rows'] += segment.footer['rows']
+            day['bytes'] += path.stat().st_size
+            segment.close()
+        return dict(sorted(days.items()))
+
+
+def _rows(device_id: str, selected: Dict[str, array], columns: Sequence[str]) -> Iterator[dict]:
+    values = [selected[name] for name in columns]
+    if 'utc_time' not in columns:
+        columns = list(columns) + ['utc_time']
+        values.append(selected['utc_time'])
+    for items in zip(*values):
+        row = {'device_id': device_id}
+        row.update(zip(columns, items))
+        for name in ('latitude', 'longitude'):
+            if name in row:
+                row[name] /= COORDINATE_SCALE
+        yield row
+
+
+# --- Linha de comando -----------------------------------------------------------
+
+def parse_time(value: str) -> int:
+    """Epoch ou ``AAAA-MM-DD[ HH:MM[:SS]]`` em UTC."""
+    if value.isdigit():
+        return int(value)
+    for pattern in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, pattern))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f'horário inválido: {value}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Consultas ao armazenamento colunar')
+    parser.add_argument('--directory', type=Path, default=STORE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='linhas de um dispositivo (ou de todos) em um intervalo')
+    query.add_argument('device_id', help="device_id, ou '*' para todos")
+    query.add_argument('--start', type=parse_time, required=True, help='início (UTC)')
+    query.add_argument('--end', type=parse_time, help='fim (UTC); sem ele, um dia depois do início')
+    query.add_argument('--columns', help=f'colunas separadas por vírgula ({",".join(COLUMN_NAMES)})')
+    query.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    commands.add_parser('stats', help='segmentos, linhas e bytes por dia')
+    args = parser.parse_args(argv)
+
+    reader = StoreReader(args.directory)
+    if args.command == 'stats':
+        for day, stats in reader.stats().items():
+            print(day, json.dumps(stats))
+        return
+
+    end = args.end if args.end is not None else args.start + DAY_SECONDS - 1
+    columns = args.columns.split(',') if args.columns else None
+    device_id = None if args.device_id == '*' else args.device_id
+    start = time.perf_counter()
+    try:
+        rows = reader.query(device_id, args.start, end, columns)
+    except ValueError as exc:
+        parser.error(str(exc))
+    elapsed = time.perf_counter() - start
+    if args.format == 'csv':
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        for row in rows:
+            row['utc'] = format_timestamp(row['utc_time'])
+            print(json.dumps(row))
+    print(f'{len(rows)} linhas em {elapsed * 1000:.1f} ms', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
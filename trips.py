@@ -0,0 +1,503 @@
+"""Agregação contínua de viagens, distância e consumo por dispositivo.
+
+Cada pacote com bloco de estado (0x1001, 0x4001, 0x4007) atualiza, em
+O(1), o estado do dispositivo (``TripState``):
+
+- viagem: começa quando o vstate passa a ter ACC ON e termina quando o
+  ACC desliga (ou depois de ``trip_timeout`` segundos sem pacotes);
+- distância e combustível: diferenças do odômetro do equipamento
+  (total_trip_mileage, em metros) e do total_fuel entre pacotes
+  seguidos. Diferenças negativas ou impossíveis (equipamento zerado)
+  são ignoradas;
+- velocidade máxima, tempo parado (ACC ON abaixo de 5 km/h) e em
+  movimento, a partir do último item GPS de cada pacote.
+
+Os totais ficam por viagem e por dia (UTC, pelo utc_time do pacote).
+Uma thread de fundo grava no SQLite (``logs/trips.db``), a cada
+``checkpoint_interval`` segundos, as viagens encerradas, os totais dos
+dias e o estado de cada dispositivo alterado, do qual a agregação
+continua depois de reiniciar o servidor (os estados são carregados todos
+na partida, para que o caminho do pacote nunca consulte o banco). O
+estado é copiado (``snapshot``) no próprio loop a cada pacote; a thread
+só lê as cópias. Os relatórios leem esses totais, sem reprocessar
+pacotes:
+
+    python trips.py daily 218LSAB2025000002 --day 2026-10-17
+    python trips.py trips 218LSAB2025000002 --start 2026-10-13 --end 2026-10-17
+
+ou no endpoint local (``trip_routes``):
+
+    curl 'http://127.0.0.1:29481/trips/daily?device=218LSAB2025000002&day=2026-10-17'
+    curl 'http://127.0.0.1:29481/trips/list?device=218LSAB2025000002&start=2026-10-13'
+"""
+import argparse
+import calendar
+import json
+import logging
+import sqlite3
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from sinocastel import ACC_ON, StatRecord
+
+TRIPS_DB = Path('logs') / 'trips.db'
+
+DAY_SECONDS = 86400
+# Abaixo disso, com ACC ON, o veículo está parado (5 km/h em cm/s)
+IDLE_SPEED_CM_S = 139
+# Intervalos maiores entre pacotes não contam como parado nem em movimento
+MAX_GAP = 600
+# Diferença de odômetro acima disso por segundo é um reset, não distância
+MAX_METERS_PER_SECOND = 100
+# O mesmo para o total_fuel (unidades do equipamento por segundo)
+MAX_FUEL_PER_SECOND = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trip_state (
+    device_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trips (
+    device_id TEXT NOT NULL,
+    started INTEGER NOT NULL,
+    ended INTEGER NOT NULL,
+    distance_m INTEGER NOT NULL,
+    fuel_used INTEGER NOT NULL,
+    max_speed_cm_s INTEGER NOT NULL,
+    idle_seconds INTEGER NOT NULL,
+    moving_seconds INTEGER NOT NULL,
+    packets INTEGER NOT NULL,
+    start_latitude REAL,
+    start_longitude REAL,
+    end_latitude REAL,
+    end_longitude REAL,
+    PRIMARY KEY (device_id, started)
+);
+CREATE TABLE IF NOT EXISTS daily (
+    device_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    distance_m INTEGER NOT NULL,
+    fuel_used INTEGER NOT NULL,
+    max_speed_cm_s INTEGER NOT NULL,
+    idle_seconds INTEGER NOT NULL,
+    moving_seconds INTEGER NOT NULL,
+    trips INTEGER NOT NULL,
+    packets INTEGER NOT NULL,
+    PRIMARY KEY (device_id, day)
+);
+"""
+TRIP_COLUMNS = ('device_id', 'started', 'ended', 'distance_m', 'fuel_used', 'max_speed_cm_s',
+                'idle_seconds', 'moving_seconds', 'packets', 'start_latitude', 'start_longitude',
+                'end_latitude', 'end_longitude')
+DAILY_COLUMNS = ('device_id', 'day', 'distance_m', 'fuel_used', 'max_speed_cm_s',
+                 'idle_seconds', 'moving_seconds', 'trips', 'packets')
+# Acumuladores de cada período (viagem e dia), na ordem das colunas
+TOTALS = ('distance_m', 'fuel_used', 'max_speed_cm_s', 'idle_seconds', 'moving_seconds', 'packets')
+
+log = logging.getLogger(__name__)
+
+
+def day_name(day: int) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(day * DAY_SECONDS))
+
+
+class TripState:
+    """Estado corrente de um dispositivo: último pacote, viagem aberta e totais do dia."""
+
+    __slots__ = ('device_id', 'last_time', 'acc_on', 'speed', 'mileage', 'fuel',
+                 'latitude', 'longitude', 'trip_started', 'trip_start_latitude',
+                 'trip_start_longitude', 'trip', 'day', 'daily', 'day_trips')
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.last_time = None
+        self.acc_on = False
+        self.speed = 0
+        self.mileage = None
+        self.fuel = None
+        self.latitude = None
+        self.longitude = None
+        # Viagem aberta (trip_started não None) e seus totais
+        self.trip_started = None
+        self.trip_start_latitude = None
+        self.trip_start_longitude = None
+        self.trip = [0] * len(TOTALS)
+        # Totais do dia corrente (dias desde a época, UTC)
+        self.day = None
+        self.daily = [0] * len(TOTALS)
+        self.day_trips = 0
+
+    def snapshot(self) -> tuple:
+        """Cópia imutável, na ordem de __slots__, para o checkpoint."""
+        return (self.device_id, self.last_time, self.acc_on, self.speed, self.mileage, self.fuel,
+                self.latitude, self.longitude, self.trip_started, self.trip_start_latitude,
+                self.trip_start_longitude, tuple(self.trip), self.day, tuple(self.daily),
+                self.day_trips)
+
+    @classmethod
+    def snapshot_json(cls, snapshot: tuple) -> str:
+        return json.dumps(dict(zip(cls.__slots__, snapshot)))
+
+    @classmethod
+    def from_json(cls, text: str) -> 'TripState':
+        values = json.loads(text)
+        state = cls(values['device_id'])
+        for name in cls.__slots__:
+            if name in values:
+                setattr(state, name, values[name])
+        return state
+
+    def trip_row(self, ended: int) -> tuple:
+        return ((self.device_id, self.trip_started, ended) + tuple(self.trip)
+                + (self.trip_start_latitude, self.trip_start_longitude, self.latitude, self.longitude))
+
+    def daily_row(self) -> tuple:
+        return daily_row(self.device_id, self.day, self.daily, self.day_trips)
+
+    @staticmethod
+    def snapshot_daily_row(snapshot: tuple) -> Optional[tuple]:
+        device_id, day, daily, day_trips = snapshot[0], snapshot[12], snapshot[13], snapshot[14]
+        return None if day is None else daily_row(device_id, day, daily, day_trips)
+
+
+def daily_row(device_id: str, day: int, daily, day_trips: int) -> tuple:
+    distance, fuel, max_speed, idle, moving, packets = daily
+    return (device_id, day_name(day), distance, fuel, max_speed, idle, moving, day_trips, packets)
+
+
+class TripReader:
+    """Relatórios a partir do que já foi gravado no banco."""
+
+    def __init__(self, path: Path = TRIPS_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def _query(self, sql: str, params=()) -> list:
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def daily(self, device_id: str, first_day: str, last_day: Optional[str] = None) -> List[dict]:
+        """Totais por dia (``AAAA-MM-DD``, UTC) de ``first_day`` a ``last_day``."""
+        rows = self._query(f"SELECT {', '.join(DAILY_COLUMNS)} FROM daily "
+                           "WHERE device_id = ? AND day BETWEEN ? AND ? ORDER BY day",
+                           (device_id, first_day, last_day or first_day))
+        return [dict(zip(DAILY_COLUMNS, row)) for row in rows]
+
+    def trips(self, device_id: str, start: int, end: int) -> List[dict]:
+        """Viagens encerradas que começaram entre ``start`` e ``end`` (epoch UTC)."""
+        rows = self._query(f"SELECT {', '.join(TRIP_COLUMNS)} FROM trips "
+                           "WHERE device_id = ? AND started BETWEEN ? AND ? ORDER BY started",
+                           (device_id, start, end))
+        return [dict(zip(TRIP_COLUMNS, row)) for row in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class TripAggregator(TripReader):
+    """Estado de todos os dispositivos em memória, com checkpoint periódico."""
+
+    def __init__(self, path: Path = TRIPS_DB, checkpoint_interval: float = 30.0,
+                 trip_timeout: int = 1800, owns: Optional[Callable[[str], bool]] = None):
+        super().__init__(path)
+        self.checkpoint_interval = checkpoint_interval
+        self.trip_timeout = trip_timeout
+        # Estados gravados, carregados de uma vez (``owns`` filtra os
+        # dispositivos de outro shard)
+        self.states: Dict[str, TripState] = {}
+        for device_id, text in self._query('SELECT device_id, state FROM trip_state'):
+            if owns is None or owns(device_id):
+                self.states[device_id] = TripState.from_json(text)
+        # Cópias dos estados alterados desde o último checkpoint; as viagens
+        # e os dias encerrados são tuplas prontas para o banco.
+        # _pending_lock protege as três estruturas
+        self._dirty: Dict[str, tuple] = {}
+        self._closed_trips: List[tuple] = []
+        self._closed_days: List[tuple] = []
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='trip-checkpoint', daemon=True)
+        self.packets = 0
+        self.late = 0
+        self.invalid = 0
+        self.trips_closed = 0
+        self.checkpoints = 0
+
+    def start(self):
+        self._thread.start()
+
+    def _state(self, device_id: str) -> TripState:
+        state = self.states.get(device_id)
+        if state is None:
+            state = self.states[device_id] = TripState(device_id)
+        return state
+
+    def observe(self, record):
+        """Atualiza o estado do dispositivo com um registro decodificado."""
+        if not isinstance(record, StatRecord):
+            return
+        try:
+            utc_time = record.utc_timestamp
+            mileage = record.device_reported_mileage_meters
+            fuel = record.total_fuel
+            acc_on = bool(record.vstate & ACC_ON)
+            gps = record.latest_gps_item
+        except struct.error:
+            # Bloco GPS inconsistente (ver sinocastel.CountError)
+            self.invalid += 1
+            return
+        state = self._state(record.device_id)
+        last_time = state.last_time
+        if last_time is not None and utc_time < last_time:
+            # Pacote antigo (reenviado depois de uma reconexão): os totais já
+            # passaram por esse trecho
+            self.late += 1
+            return
+        self.packets += 1
+
+        day = utc_time // DAY_SECONDS
+        if state.day != day:
+            if state.day is not None:
+                with self._pending_lock:
+                    self._closed_days.append(state.daily_row())
+            state.day = day
+            state.daily = [0] * len(TOTALS)
+            state.day_trips = 0
+        trip = state.trip if state.trip_started is not None else None
+        daily = state.daily
+
+        if last_time is not None:
+            gap = utc_time - last_time
+            if trip is not None and gap > self.trip_timeout:
+                # Sem pacotes por muito tempo: a viagem acabou no último pacote
+                self._close_trip(state, last_time)
+                trip = None
+            if state.acc_on and gap <= MAX_GAP:
+                index = 3 if state.speed < IDLE_SPEED_CM_S else 4
+                daily[index] += gap
+                if trip is not None:
+                    trip[index] += gap
+            seconds = max(gap, 1)
+            if state.mileage is not None and 0 < mileage - state.mileage <= seconds * MAX_METERS_PER_SECOND:
+                daily[0] += mileage - state.mileage
+                if trip is not None:
+                    trip[0] += mileage - state.mileage
+            if state.fuel is not None and 0 < fuel - state.fuel <= seconds * MAX_FUEL_PER_SECOND:
+                daily[1] += fuel - state.fuel
+                if trip is not None:
+                    trip[1] += fuel - state.fuel
+
+        if gps is not None:
+            (*_, latitude, longitude, speed, _direction, flags) = gps
+            state.speed = speed
+            state.latitude = (latitude if flags & 0x02 else -latitude) / 3600000.0
+            state.longitude = (longitude if flags & 0x01 else -longitude) / 3600000.0
+            if speed > daily[2]:
+                daily[2] = speed
+            if trip is not None and speed > trip[2]:
+                trip[2] = speed
+        daily[5] += 1
+        if trip is not None:
+            trip[5] += 1
+
+        if acc_on and state.trip_started is None:
+            state.trip_started = utc_time
+            state.trip_start_latitude = state.latitude
+            state.trip_start_longitude = state.longitude
+            state.trip = [0, 0, state.speed if gps is not None else 0, 0, 0, 1]
+            state.day_trips += 1
+        elif not acc_on and state.trip_started is not None:
+            self._close_trip(state, utc_time)
+
+        state.acc_on = acc_on
+        state.last_time = utc_time
+        state.mileage = mileage
+        state.fuel = fuel
+        snapshot = state.snapshot()
+        with self._pending_lock:
+            self._dirty[state.device_id] = snapshot
+
+    def _close_trip(self, state: TripState, ended: int):
+        row = state.trip_row(ended)
+        with self._pending_lock:
+            self._closed_trips.append(row)
+        state.trip_started = None
+        state.trip_start_latitude = state.trip_start_longitude = None
+        state.trip = [0] * len(TOTALS)
+        self.trips_closed += 1
+
+    # --- Checkpoint ----------------------------------------------------
+
+    def _run(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                # A thread não pode parar: o estado deixaria de ser gravado
+                log.exception('Falha no checkpoint das viagens')
+
+    def checkpoint(self) -> int:
+        """Grava em uma transação as viagens e dias encerrados e os estados alterados."""
+        with self._pending_lock:
+            dirty, self._dirty = self._dirty, {}
+            trips, self._closed_trips = self._closed_trips, []
+            days, self._closed_days = self._closed_days, []
+        if not (dirty or trips or days):
+            return 0
+        states = [(device_id, TripState.snapshot_json(snapshot)) for device_id, snapshot in dirty.items()]
+        current_days = [row for row in map(TripState.snapshot_daily_row, dirty.values()) if row is not None]
+        try:
+            with self._db_lock, self._db:
+                self._db.executemany(f"INSERT OR REPLACE INTO trips ({', '.join(TRIP_COLUMNS)}) "
+                                     f"VALUES ({', '.join('?' * len(TRIP_COLUMNS))})", trips)
+                self._db.executemany(f"INSERT OR REPLACE INTO daily ({', '.join(DAILY_COLUMNS)}) "
+                                     f"VALUES ({', '.join('?' * len(DAILY_COLUMNS))})",
+                                     days + current_days)
+                self._db.executemany('INSERT OR REPLACE INTO trip_state (device_id, state) VALUES (?, ?)',
+                                     states)
+        except sqlite3.Error:
+            # Devolve o que não foi gravado para o próximo checkpoint
+            with self._pending_lock:
+                for device_id, snapshot in dirty.items():
+                    self._dirty.setdefault(device_id, snapshot)
+                self._closed_trips[:0] = trips
+                self._closed_days[:0] = days
+            raise
+        self.checkpoints += 1
+        return len(states)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.checkpoint()
+        self.close()
+
+    # --- Relatórios ----------------------------------------------------
+
+    def daily(self, device_id: str, first_day: str, last_day: Optional[str] = None) -> List[dict]:
+        """Como em TripReader, com o dia corrente tirado da memória."""
+        reports = {report['day']: report for report in super().daily(device_id, first_day, last_day)}
+        state = self.states.get(device_id)
+        if state is not None and state.day is not None:
+            today = day_name(state.day)
+            if first_day <= today <= (last_day or first_day):
+                reports[today] = dict(zip(DAILY_COLUMNS, state.daily_row()))
+        return [reports[day] for day in sorted(reports)]
+
+    def trips(self, device_id: str, start: int, end: int) -> List[dict]:
+        """Como em TripReader, mais as viagens ainda não gravadas e a aberta."""
+        reports = {report['started']: report for report in super().trips(device_id, start, end)}
+        with self._pending_lock:
+            pending = [row for row in self._closed_trips if row[0] == device_id]
+        for row in pending:
+            if start <= row[1] <= end:
+                reports[row[1]] = dict(zip(TRIP_COLUMNS, row))
+        state = self.states.get(device_id)
+        if state is not None and state.trip_started is not None and start <= state.trip_started <= end:
+            report = dict(zip(TRIP_COLUMNS, state.trip_row(state.last_time)))
+            report['open'] = True
+            reports[state.trip_started] = report
+        return [reports[started] for started in sorted(reports)]
+
+    def stats(self) -> dict:
+        return {
+            'devices': len(self.states),
+            'packets': self.packets,
+            'late': self.late,
+            'invalid': self.invalid,
+            'trips_closed': self.trips_closed,
+            'checkpoints': self.checkpoints,
+        }
+
+
+# --- Endpoint local e linha de comando ------------------------------------------
+
+def parse_day(value: str) -> str:
+    time.strptime(value, '%Y-%m-%d')
+    return value
+
+
+def parse_time(value: str) -> int:
+    """Epoch ou ``AAAA-MM-DD[ HH:MM[:SS]]`` em UTC."""
+    if value.isdigit():
+        return int(value)
+    for pattern in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, pattern))
+        except ValueError:
+            continue
+    raise ValueError(f'horário inválido: {value}')
+
+
+def trip_routes(reports: TripReader) -> dict:
+    """Rotas ``/trips/daily`` e ``/trips/list`` para metrics.serve."""
+
+    def reply(rows):
+        return '200 OK', 'application/json', json.dumps(rows, ensure_ascii=False).encode()
+
+    def bad_request(message: str):
+        return '400 Bad Request', 'text/plain; charset=utf-8', f'{message}\n'.encode()
+
+    async def daily(query):
+        if 'device' not in query:
+            return bad_request('device obrigatório')
+        try:
+            first_day = parse_day(query.get('day') or query.get('start') or day_name(int(time.time()) // DAY_SECONDS))
+            last_day = parse_day(query['end']) if 'end' in query else first_day
+        except ValueError:
+            return bad_request('dia inválido (AAAA-MM-DD)')
+        return reply(reports.daily(query['device'], first_day, last_day))
+
+    async def trips(query):
+        if 'device' not in query:
+            return bad_request('device obrigatório')
+        try:
+            start = parse_time(query['start']) if 'start' in query else int(time.time()) // DAY_SECONDS * DAY_SECONDS
+            end = parse_time(query['end']) if 'end' in query else start + DAY_SECONDS - 1
+        except ValueError as exc:
+            return bad_request(str(exc))
+        return reply(reports.trips(query['device'], start, end))
+
+    return {'/trips/daily': daily, '/trips/list': trips}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Relatórios de viagens e consumo')
+    parser.add_argument('--db', type=Path, default=TRIPS_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+    daily = commands.add_parser('daily', help='totais por dia (UTC)')
+    daily.add_argument('device_id')
+    daily.add_argument('--day', type=parse_day, default=day_name(int(time.time()) // DAY_SECONDS),
+                       help='AAAA-MM-DD (padrão: hoje)')
+    daily.add_argument('--until', type=parse_day, help='último dia do intervalo')
+    trips = commands.add_parser('trips', help='viagens encerradas em um intervalo')
+    trips.add_argument('device_id')
+    trips.add_argument('--start', type=parse_time, required=True, help='início (UTC)')
+    trips.add_argument('--end', type=parse_time, help='fim (UTC); sem ele, um dia depois do início')
+    args = parser.parse_args(argv)
+
+    reader = TripReader(args.db)
+    try:
+        if args.command == 'daily':
+            rows = reader.daily(args.device_id, args.day, args.until)
+        else:
+            end = args.end if args.end is not None else args.start + DAY_SECONDS - 1
+            rows = reader.trips(args.device_id, args.start, end)
+        for row in rows:
+            print(json.dumps(row))
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
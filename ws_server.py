@@ -1,52 +1,464 @@
 import asyncio
+import os
+import signal
 import websockets
 import logging
-from datetime import datetime
-from pathlib import Path
-from decoder_1001 import Decoder1001
-
-# Configuração de logging
-log_dir = Path('logs')
-log_dir.mkdir(exist_ok=True)
-raw_log_file = log_dir / 'raw_data.log'
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    handlers=[
-        logging.FileHandler(raw_log_file, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-
-# Placeholder para decodificadores de protocolo
-class ProtocolDecoder:
-    def decode(self, data: bytes) -> dict:
-        # Implementação futura para múltiplos protocolos
-        return {"hex": data.hex(), "raw": data}
-
-decoders = {
-    '1001': Decoder1001(),
-}
-
-def get_decoder(protocol_id: str):
-    return decoders.get(protocol_id, ProtocolDecoder())
-
-async def handler(websocket, path):
-    logging.info(f'Nova conexão: {websocket.remote_address}')
-    async for message in websocket:
-        now = datetime.now().isoformat()
-        # Registro do dado bruto
-        logging.info(f'RAW: {message}')
-        # Exemplo de uso do decoder 1001
-        decoder = get_decoder('1001')
-        decoded = decoder.decode(message.encode() if isinstance(message, str) else message)
-        logging.info(f'DECODED: {decoded}')
+import struct
+from time import perf_counter
+from alerts import AlertCollapser
+from capture import CaptureWriter
+from crc16 import FrameValidator
+from decoders import registry as decoders
+from dedupe import DuplicateFilter
+from decryption import Decryptor
+from forwarder import WebhookForwarder
+from framer import SinocastelFramer
+from log_pipeline import lazy_hex, setup_logging
+from metrics import DEFAULT_PORT as METRICS_PORT, Metrics, protocol_label, serve as serve_metrics, watch_loop_lag
+from profiling import debug_routes
+from pubsub import SUBSCRIBE_PATH, Hub, serve_subscriber
+from sessions import SessionRegistry
+from shards import ShardPool
+from spatial import FleetIndex, fleet_routes
+from store import TelemetryStore
+from trips import TripAggregator, TripReader, trip_routes
+
+# Logs brutos e interpretados; a configuração (fila, arquivos, rotação)
+# é feita por setup_logging em main()
+raw_log = logging.getLogger('obd.raw')
+interpreted_log = logging.getLogger('obd.interpreted')
+
+# Captura binária dos pacotes recebidos (logs/capture); CAPTURE=0 desliga.
+# Criada em main()
+capture = None
+
+# Pacotes com crc, tamanho ou cauda inválidos são descartados antes da
+# decodificação; validator.rejected conta os descartes por motivo
+validator = FrameValidator()
+
+# Retransmissões (mesmo device_id, protocol_id, utc_time e crc) são
+# descartadas antes da decodificação; ver dedupe.py
+dedupe = DuplicateFilter()
+
+# Decifragem AES dos pacotes versão 0x04 de dispositivos com chave; criada em main()
+decryptor = None
+
+# Envio dos registros para um webhook (WEBHOOK_URL); criado em main()
+forwarder = None
+
+# Estado por dispositivo (base do odômetro, último login, GPS); criado em main()
+sessions = None
+
+# Armazenamento colunar por dia (store.py); STORE=0 desliga. Criado em main()
+store = None
+
+# Viagens e totais diários por dispositivo (trips.py); TRIPS=0 desliga.
+# Criado em main()
+trips = None
+
+# Contadores e histogramas por etapa (metrics.py); METRICS=0 deixa None e
+# o caminho dos pacotes não mede nada. Criado em main()
+metrics = None
+
+# Com WORKERS > 0 a decodificação vai para processos separados (shards.py)
+# e as etapas depois dos alertas rodam neles; criado em main()
+shards = None
+
+# Portas e limites; valem para as duas entradas (WebSocket e TCP puro)
+WS_PORT = int(os.environ.get('WS_PORT', 29479))
+TCP_PORT = int(os.environ.get('TCP_PORT', 29480))
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 20000))
+# Painéis em /subscribe (pubsub.py); contados à parte dos equipamentos
+MAX_SUBSCRIBERS = int(os.environ.get('MAX_SUBSCRIBERS', 1000))
+# Lado da célula do índice espacial, em graus (0,01° ≈ 1,1 km)
+FLEET_CELL_DEGREES = float(os.environ.get('FLEET_CELL', 0.01))
+# Conexão TCP sem nenhum byte nesse intervalo é encerrada (o equipamento
+# manda telemetria a cada poucos segundos; ACC OFF ainda manda heartbeat)
+IDLE_TIMEOUT = float(os.environ.get('IDLE_TIMEOUT', 300))
+# A memória por conexão é limitada na leitura: o TCP lê até READ_SIZE
+# bytes por vez, a mensagem WebSocket tem no máximo MAX_MESSAGE bytes (o
+# websockets fecha a conexão com 1009 acima disso) e o framer guarda no
+# máximo um pacote incompleto (framer.MAX_FRAME_LEN)
+READ_SIZE = 4096
+MAX_MESSAGE = 64 * 1024
+
+# Registros decodificados para os painéis conectados em /subscribe; nos
+# processos de trabalho vira um shards.ShardPublisher
+hub = Hub(MAX_SUBSCRIBERS)
+
+# Última posição de cada veículo, para as consultas /fleet/* do endpoint
+# local; nos processos de trabalho vira um shards.ShardFleet
+fleet = FleetIndex(FLEET_CELL_DEGREES)
+
+connections = 0
+
+class DeviceConnection:
+    """Pipeline de uma conexão, independente do transporte.
+
+    Recebe os bytes como chegaram (mensagem WebSocket ou leitura do
+    socket) e os leva por framing, captura, alertas, conferência,
+    retransmissões, decifragem, decode e saídas (log, sessões, webhook).
+    """
+
+    def __init__(self, remote, transport: str = 'ws'):
+        self.remote = remote
+        self.transport = f'transport="{transport}"'
+        # Uma mensagem pode conter vários pacotes (ou só parte de um)
+        self.framer = SinocastelFramer()
+        # Em geral uma conexão é um só dispositivo: a sessão fica à mão
+        self.session = None
+        self.rejected = 0
+        self.duplicates = 0
+        self.decode_errors = 0
+        # Cópias repetidas de um alerta 0x4007 são decodificadas uma vez só
+        self.alerts = AlertCollapser()
+
+    def feed(self, data):
+        m = metrics
+        if m is not None:
+            m.bytes.inc(len(data), self.transport)
+            start = perf_counter()
+        frames = self.framer.feed(data)
+        if m is not None:
+            m.stages['frame'].observe(perf_counter() - start)
+        # Registro do dado bruto, com todas as cópias
+        if capture is not None:
+            for frame in frames:
+                capture.write(frame, self.remote)
+        process = self.process if shards is None else shards.submit
+        for frame, repetitions in self.alerts.feed(frames, self.framer.buffered):
+            process(frame, repetitions)
+
+    def process(self, frame, repetitions):
+        # Com métricas ligadas, cada etapa é cronometrada e o pacote passa
+        # pelo anel dos mais lentos (Metrics.finish); os descartes são
+        # contados por protocol_id
+        m = metrics
+        if m is not None:
+            protocol = protocol_label(frame)
+            m.frames.inc(1, protocol)
+            timings = []
+            start = perf_counter()
+        reason = validator.reject_reason(frame)
+        if reason is not None:
+            self.rejected += 1
+            if m is not None:
+                m.rejected.inc(1, f'{protocol},reason="{reason}"')
+            return
+        if not dedupe.check(frame):
+            self.duplicates += 1
+            if m is not None:
+                m.duplicates.inc(1, protocol)
+            return
+        if m is not None:
+            now = perf_counter()
+            timings.append(('validate', now - start))
+            start = now
+        if decryptor is not None:
+            frame = decryptor.process(frame)
+            if frame is None:
+                return
+            if m is not None:
+                now = perf_counter()
+                timings.append(('decrypt', now - start))
+                start = now
+        # Os campos são lidos sob demanda: um pacote corrompido pode falhar
+        # só na sessão, quando o GPS e as versões são lidos
+        decoded = None
+        try:
+            # Decoder escolhido por (protocol_version, protocol_id); ver decoders.py
+            decoded = decoders.decode(frame)
+            if repetitions > 1:
+                decoded.repetitions = repetitions
+            if m is not None:
+                now = perf_counter()
+                timings.append(('decode', now - start))
+                start = now
+            if sessions is not None:
+                self.session = sessions.observe(decoded, self.session)
+            fleet.observe(decoded)
+            if trips is not None:
+                trips.observe(decoded)
+            if m is not None:
+                now = perf_counter()
+                timings.append(('session', now - start))
+                start = now
+        except Exception as exc:
+            self.decode_errors += 1
+            if m is not None:
+                now = perf_counter()
+                timings.append(('error', now - start))
+                start = now
+                m.decode_errors.inc(1, protocol)
+            if decoded is None or not isinstance(exc, struct.error):
+                if m is not None:
+                    m.finish(frame, timings, self.remote)
+                raw_log.exception('Falha ao decodificar pacote de %s: %s', self.remote, lazy_hex(frame))
+                return
+            # Pacote inconsistente (truncado, contagem além do buffer): o
+            # registro segue para o log e o webhook com o "error" de to_dict()
+            raw_log.warning('Pacote inconsistente de %s: %s', self.remote, exc)
+        interpreted_log.info('INTERPRETED: %s', decoded)
+        if m is not None:
+            now = perf_counter()
+            timings.append(('log', now - start))
+            start = now
+        if store is not None:
+            store.append(decoded)
+            if m is not None:
+                now = perf_counter()
+                timings.append(('store', now - start))
+                start = now
+        if hub.subscribers:
+            hub.publish(decoded)
+            if m is not None:
+                now = perf_counter()
+                timings.append(('publish', now - start))
+                start = now
+        if forwarder is not None:
+            forwarder.submit(decoded)
+            if m is not None:
+                timings.append(('forward', perf_counter() - start))
+        if m is not None:
+            m.finish(frame, timings, self.remote)
+
+    def close(self):
+        process = self.process if shards is None else shards.submit
+        for frame, repetitions in self.alerts.flush():
+            process(frame, repetitions)
+        framer = self.framer
+        if shards is not None:
+            # Rejeitados e duplicados são contados nos shards
+            raw_log.info('Conexão encerrada: %s (%d pacotes, %d bytes descartados)',
+                         self.remote, framer.frames, framer.discarded_bytes)
+            return
+        raw_log.info('Conexão encerrada: %s (%d pacotes, %d rejeitados, %d duplicados, %d bytes descartados)',
+                     self.remote, framer.frames, self.rejected, self.duplicates, framer.discarded_bytes)
+
+async def handler(websocket, path=None):
+    global connections
+    request_path, _, query = (websocket.request.path if path is None else path).partition('?')
+    if request_path == SUBSCRIBE_PATH:
+        await serve_subscriber(hub, websocket, query)
+        return
+    remote = websocket.remote_address
+    if connections >= MAX_CONNECTIONS:
+        raw_log.warning('Conexão recusada (limite de %d): %s', MAX_CONNECTIONS, remote)
+        await websocket.close(1013, 'limite de conexões')
+        if metrics is not None:
+            metrics.connections_refused.inc(1, 'reason="limit"')
+        return
+    connections += 1
+    if metrics is not None:
+        metrics.connections.inc(1, 'transport="ws"')
+    logging.info('Nova conexão: %s', remote)
+    connection = DeviceConnection(remote)
+    try:
+        async for message in websocket:
+            connection.feed(message.encode() if isinstance(message, str) else message)
+    finally:
+        connections -= 1
+        connection.close()
+
+async def tcp_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Entrada TCP puro (como bkp/obd_server.py): mesmo pipeline do WebSocket."""
+    global connections
+    remote = writer.get_extra_info('peername')
+    if connections >= MAX_CONNECTIONS:
+        raw_log.warning('Conexão recusada (limite de %d): %s', MAX_CONNECTIONS, remote)
+        writer.close()
+        if metrics is not None:
+            metrics.connections_refused.inc(1, 'reason="limit"')
+        return
+    connections += 1
+    if metrics is not None:
+        metrics.connections.inc(1, 'transport="tcp"')
+    logging.info('Nova conexão TCP: %s', remote)
+    connection = DeviceConnection(remote, 'tcp')
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(READ_SIZE), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raw_log.info('Conexão ociosa por %.0f s: %s', IDLE_TIMEOUT, remote)
+                if metrics is not None:
+                    metrics.connections_refused.inc(1, 'reason="idle"')
+                break
+            if not data:
+                break
+            connection.feed(data)
+    except ConnectionError:
+        pass
+    finally:
+        connections -= 1
+        connection.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+def install_metrics(log_pipeline) -> Metrics:
+    """Cria as métricas com os medidores deste processo (acceptor ou shard)."""
+    m = Metrics()
+    m.gauge('obd_connections', 'Conexões abertas', lambda: {'': connections} if connections else {})
+
+    def queue_depths():
+        depths = {'queue="log"': log_pipeline.queue_depth}
+        if capture is not None:
+            depths['queue="capture"'] = capture.queue_depth
+        if forwarder is not None:
+            depths['queue="webhook"'] = forwarder.queue_depth
+        if store is not None:
+            depths['queue="store"'] = store.queue_depth
+        if isinstance(hub, Hub) and hub.subscribers:
+            depths['queue="subscribers"'] = sum(len(subscriber.pending) for subscriber in hub.subscribers)
+        if shards is not None:
+            for shard in shards.shards:
+                depths[f'queue="shard-{shard.index}"'] = shard.queue.qsize()
+        return depths
+
+    def queue_dropped():
+        dropped = {'queue="log"': log_pipeline.dropped}
+        if capture is not None:
+            dropped['queue="capture"'] = capture.dropped
+        if forwarder is not None:
+            dropped['queue="webhook"'] = forwarder.spilled + forwarder.dropped
+        if store is not None:
+            dropped['queue="store"'] = store.dropped
+        if isinstance(hub, Hub) and hub.subscribers:
+            dropped['queue="subscribers"'] = sum(subscriber.dropped for subscriber in hub.subscribers)
+        if shards is not None:
+            for shard in shards.shards:
+                dropped[f'queue="shard-{shard.index}"'] = shard.dropped
+        return dropped
+
+    def subscribers():
+        # Nos shards o hub é só um ShardPublisher; os painéis ficam no acceptor
+        return {'': len(hub.subscribers)} if isinstance(hub, Hub) else {}
+
+    m.gauge('obd_subscribers', 'Painéis conectados em /subscribe', subscribers)
+    # Idem: o índice espacial fica no acceptor
+    m.gauge('obd_fleet_vehicles', 'Veículos com posição no índice espacial',
+            lambda: {'': len(fleet)} if isinstance(fleet, FleetIndex) else {})
+    m.gauge('obd_queue_depth', 'Itens aguardando em cada fila', queue_depths)
+    m.gauge('obd_queue_overflow', 'Itens que não couberam na fila (log e shards: descartados; '
+            'webhook: enviados ao disco)', queue_dropped)
+    return m
+
+def slow_packets() -> list:
+    """Pacotes mais lentos deste processo e dos shards, do mais lento ao mais rápido."""
+    entries = metrics.slow.entries()
+    if shards is not None:
+        for report in shards.reports():
+            entries.extend(report.get('slow', ()))
+    entries.sort(key=lambda entry: entry['seconds'], reverse=True)
+    return entries[:metrics.slow.capacity]
 
 async def main():
-    async with websockets.serve(handler, "0.0.0.0", 29479):
-        print("Servidor WebSocket escutando na porta 29479...")
-        await asyncio.Future()  # run forever
+    # LOG_CONSOLE=0 desliga o eco dos logs no terminal; WORKERS=n liga os shards;
+    # METRICS=0 desliga as métricas
+    global capture, decryptor, forwarder, metrics, sessions, shards, store, trips
+    # SIGTERM (systemd, timeout) e Ctrl+C encerram pelo mesmo caminho: o
+    # finally abaixo, que grava o que está pendente nas filas
+    main_task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, main_task.cancel)
+    console = os.environ.get('LOG_CONSOLE', '1') != '0'
+    log_pipeline = setup_logging(console=console)
+    if os.environ.get('CAPTURE', '1') != '0':
+        # CAPTURE_KEEP: segmentos mantidos (de até 64 MB ou 1 h cada)
+        capture = CaptureWriter(keep_segments=int(os.environ.get('CAPTURE_KEEP', 48)))
+        capture.start()
+    tasks = []
+    workers = int(os.environ.get('WORKERS', 0))
+    trip_reports = None
+    if os.environ.get('TRIPS', '1') != '0':
+        if workers > 0:
+            # A agregação roda nos processos de trabalho; aqui só se lê o banco
+            trip_reports = TripReader()
+        else:
+            trips = trip_reports = TripAggregator()
+            trips.start()
+    # Endpoint local: consultas de posição sempre; viagens, métricas e
+    # diagnóstico se ligados
+    routes = fleet_routes(fleet)
+    if trip_reports is not None:
+        routes.update(trip_routes(trip_reports))
+    if os.environ.get('METRICS', '1') != '0':
+        metrics = install_metrics(log_pipeline)
+        tasks.append(asyncio.create_task(watch_loop_lag(metrics)))
+        routes.update(debug_routes(slow_packets))
+    local_server = await serve_metrics(metrics, os.environ.get('METRICS_HOST', '127.0.0.1'),
+                                       int(os.environ.get('METRICS_PORT', METRICS_PORT)), routes=routes)
+    if workers > 0:
+        # Sessões, chaves e webhook ficam em cada processo de trabalho
+        shards = ShardPool(workers, console=console)
+        shards.start()
+        shards.attach_hub(hub)
+        shards.attach_fleet(fleet)
+        if metrics is not None:
+            metrics.add_source(lambda: shards.stats().get('metrics', {}))
+    else:
+        sessions = SessionRegistry()
+        sessions.start()
+        decryptor = Decryptor()
+        if os.environ.get('STORE', '1') != '0':
+            store = TelemetryStore()
+            store.start()
+        if os.environ.get('WEBHOOK_URL'):
+            forwarder = WebhookForwarder(os.environ['WEBHOOK_URL'])
+            forwarder.start()
+    try:
+        tcp_server = await asyncio.start_server(tcp_handler, "0.0.0.0", TCP_PORT)
+        async with tcp_server, websockets.serve(handler, "0.0.0.0", WS_PORT, max_size=MAX_MESSAGE):
+            print(f"Servidor WebSocket escutando na porta {WS_PORT} e TCP na porta {TCP_PORT}...")
+            await asyncio.Future()  # run forever
+    finally:
+        for task in tasks:
+            task.cancel()
+        local_server.close()
+        if capture is not None:
+            capture.close()
+            raw_log.info('Captura: %d pacotes, %d descartados', capture.frames, capture.dropped)
+        if shards is not None:
+            shards.stop()
+            stats = shards.stats()
+            stats.pop('metrics', None)
+            raw_log.info('Shards: %s', stats)
+            if trip_reports is not None:
+                trip_reports.close()
+        else:
+            raw_log.info('Pacotes por decoder: %s', decoders.stats())
+            raw_log.info('Retransmissões: %s', dedupe.stats())
+            if forwarder is not None:
+                forwarder.stop()
+                raw_log.info('Webhook: %s', forwarder.stats())
+            if store is not None:
+                store.stop()
+                raw_log.info('Armazenamento: %s', store.stats())
+            if trips is not None:
+                trips.stop()
+                raw_log.info('Viagens: %s', trips.stats())
+            sessions.stop()
+            decryptor.keys.close()
+        log_pipeline.stop()
+
+def run():
+    # uvloop, se instalado, troca o loop de eventos padrão por um mais rápido
+    try:
+        import uvloop
+    except ImportError:
+        loop_factory = None
+    else:
+        loop_factory = uvloop.new_event_loop
+    try:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
+    except asyncio.CancelledError:
+        # Encerrado por sinal (ver main)
+        pass
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    run() 
\ No newline at end of file